@@ -0,0 +1,72 @@
+"""Login throughput and tail latency of /auth/login under concurrency.
+
+    python -m benchmarks.bench_auth --logins 200 --concurrency 32
+"""
+from src.utils import sqlite
+import argparse
+import asyncio
+import json
+import logging
+import statistics
+import tempfile
+import time
+import httpx
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(p * len(values)), len(values) - 1)] if values else 0.0
+
+
+async def bench(logins: int, concurrency: int):
+    # a throwaway database so the benchmark never touches app.db
+    sqlite.engine = sqlite.create_sqlite_engine(f"sqlite:///{tempfile.mkdtemp()}/bench.db")
+    from src.main import app
+    from src.services.spotify_services import spotify_tokens
+
+    # no background token refresh against the real Spotify, login never needs it
+    spotify_tokens.client_id = spotify_tokens.client_secret = None
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            credentials = {"username": "bench", "password": "bench-password"}
+            await client.post("/auth/register", json=credentials)
+            # warm up the worker processes before timing
+            await asyncio.gather(*[client.post("/auth/login", json=credentials) for _ in range(4)])
+
+            latencies = []
+            statuses = {}
+            slots = asyncio.Semaphore(concurrency)
+
+            async def login():
+                async with slots:
+                    started = time.perf_counter()
+                    r = await client.post("/auth/login", json=credentials)
+                    latencies.append(time.perf_counter() - started)
+                    statuses[r.status_code] = statuses.get(r.status_code, 0) + 1
+
+            started = time.perf_counter()
+            await asyncio.gather(*[login() for _ in range(logins)])
+            elapsed = time.perf_counter() - started
+
+    return {
+        "logins": logins,
+        "concurrency": concurrency,
+        "logins_per_sec": round(statuses.get(200, 0) / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "statuses": statuses
+    }
+
+
+def main():
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(bench(args.logins, args.concurrency))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""Throughput, tail latency and upstream calls of every /anisong route against the fake upstream.
+
+    python -m benchmarks.bench_endpoints --concurrency 1,8,32 --requests 100 --output bench_endpoints.json
+    python -m benchmarks.bench_endpoints --latency 0.2 --jitter 0.1 --error-rate 0.02 --quota-rate 0.1
+    python -m benchmarks.bench_endpoints --cold --baseline bench_endpoints.json --output after.json
+"""
+from benchmarks.fake_upstream import FakeUpstream
+from src.utils import sqlite
+from src.utils.http_client import UpstreamClients, get_http_clients
+import argparse
+import asyncio
+import json
+import logging
+import statistics
+import tempfile
+import time
+import httpx
+
+# (name, method, path, params), the search runs first so the database has songs to look at
+ROUTES = [
+    ("search", "POST", "/anisong/search", [("q", "Guilty Crown"), ("q", "EGOIST")]),
+    ("themes", "GET", "/anisong/themes", {"theme_type": "OP", "limit": 25}),
+    ("names", "GET", "/anisong/names", {"name": "Guilty Crown", "provider": "both"}),
+    ("artists", "GET", "/anisong/artists", {"artist": "EGOIST", "limit": 25}),
+    ("criteria", "GET", "/anisong/criteria", {"year": 2011, "limit": 25}),
+    ("suggest", "GET", "/anisong/suggest", {"q": "guilty crwn"}),
+    ("similar", "GET", "/anisong/1/similar", {"limit": 10}),
+    ("save", "POST", "/anisong/save", {
+        "title": "oath sign", "artist": "LiSA", "anime": "Fate/Zero",
+        "spotify_url": "https://open.spotify.com/track/bench", "popularity": 60,
+        "youtube_url": "https://www.youtube.com/watch?v=bench"
+    })
+]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(p * len(values)), len(values) - 1)] if values else 0.0
+
+
+async def login(client: httpx.AsyncClient) -> dict:
+    credentials = {"username": "bench", "password": "bench-password"}
+    await client.post("/auth/register", json=credentials)
+    r = await client.post("/auth/login", json=credentials)
+    return {"Authorization": f"Bearer {r.json()['access_token']}"}
+
+
+async def run_level(client, fake: FakeUpstream, route: tuple, headers: dict, concurrency: int, requests: int) -> dict:
+    name, method, path, params = route
+    latencies = []
+    statuses = {}
+    slots = asyncio.Semaphore(concurrency)
+
+    async def call():
+        async with slots:
+            started = time.perf_counter()
+            r = await client.request(method, path, params=params, headers=headers)
+            latencies.append(time.perf_counter() - started)
+            statuses[r.status_code] = statuses.get(r.status_code, 0) + 1
+
+    calls_before = fake.snapshot()
+    started = time.perf_counter()
+    await asyncio.gather(*[call() for _ in range(requests)])
+    elapsed = time.perf_counter() - started
+    calls = {
+        upstream: count - calls_before.get(upstream, 0)
+        for upstream, count in fake.snapshot().items()
+        if count - calls_before.get(upstream, 0)
+    }
+
+    return {
+        "route": name,
+        "concurrency": concurrency,
+        "requests": requests,
+        "throughput_rps": round(requests / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "statuses": statuses,
+        "upstream_calls": calls,
+        "upstream_calls_per_request": round(sum(calls.values()) / requests, 2)
+    }
+
+
+def compare(results: list[dict], baseline: dict) -> list[dict]:
+    # relative change against an earlier report, negative latency and positive throughput are better
+    previous = {(entry["route"], entry["concurrency"]): entry for entry in baseline.get("results", [])}
+    for entry in results:
+        before = previous.get((entry["route"], entry["concurrency"]))
+        if before is None:
+            continue
+        entry["change_vs_baseline"] = {
+            key: round((entry[key] - before[key]) / before[key] * 100, 1) if before[key] else None
+            for key in ("throughput_rps", "p50_ms", "p95_ms", "p99_ms")
+        }
+    return results
+
+
+async def bench(levels: list[int], requests: int, fake: FakeUpstream, cold: bool, routes: list[str]) -> list[dict]:
+    # a throwaway database so the benchmark never touches app.db
+    sqlite.engine = sqlite.create_sqlite_engine(f"sqlite:///{tempfile.mkdtemp()}/bench.db")
+    from src.main import app
+    from src.services import enrichment_cache
+    from src.services.anisong_services import animethemes_cache
+    from src.services.spotify_services import spotify_tokens
+
+    enrichment_cache._cache = enrichment_cache.EnrichmentCache(engine=sqlite.engine, enabled=not cold)
+    if cold:
+        animethemes_cache.ttl = 0
+    # no background token refresh against the real Spotify while the app starts
+    spotify_tokens.client_id = spotify_tokens.client_secret = None
+    fake_clients = UpstreamClients(transport=fake.transport())
+    app.dependency_overrides[get_http_clients] = lambda: fake_clients
+
+    results = []
+    async with app.router.lifespan_context(app):
+        spotify_tokens.client_id = spotify_tokens.client_secret = "bench"
+        # an unhandled upstream error is counted as the 500 a client would get
+        transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+            headers = await login(client)
+            for route in ROUTES:
+                if route[0] not in routes:
+                    continue
+                # one unmeasured call, so the first level does not pay for filling the caches alone
+                await client.request(route[1], route[2], params=route[3], headers=headers)
+                for concurrency in levels:
+                    results.append(await run_level(client, fake, route, headers, concurrency, requests))
+                    logging.info(json.dumps(results[-1]))
+    await fake_clients.aclose()
+    app.dependency_overrides.pop(get_http_clients, None)
+    return results
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", default="1,8,32", help="comma separated levels")
+    parser.add_argument("--requests", type=int, default=100, help="requests per route and level")
+    parser.add_argument("--routes", default=",".join(route[0] for route in ROUTES))
+    parser.add_argument("--latency", type=float, default=0.05, help="upstream latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.02, help="+/- seconds around the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of upstream calls answered 503")
+    parser.add_argument("--quota-rate", type=float, default=0.0, help="share of YouTube calls answered 403 quotaExceeded")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--cold", action="store_true", help="turn the AnimeThemes and enrichment caches off")
+    parser.add_argument("--baseline", help="earlier report to compare against")
+    parser.add_argument("--output", default="bench_endpoints.json")
+    args = parser.parse_args()
+
+    levels = [int(level) for level in args.concurrency.split(",")]
+    fake = FakeUpstream(args.latency, args.jitter, args.error_rate, args.quota_rate, args.seed)
+    results = asyncio.run(bench(levels, args.requests, fake, args.cold, args.routes.split(",")))
+    if args.baseline:
+        with open(args.baseline) as f:
+            results = compare(results, json.load(f))
+
+    report = {
+        "config": {
+            "concurrency": levels,
+            "requests": args.requests,
+            "latency": args.latency,
+            "jitter": args.jitter,
+            "error_rate": args.error_rate,
+            "quota_rate": args.quota_rate,
+            "seed": args.seed,
+            "cold": args.cold
+        },
+        "upstream_errors": dict(fake.errors),
+        "results": results
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report))
+
+
+if __name__ == "__main__":
+    main()
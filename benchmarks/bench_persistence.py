@@ -0,0 +1,83 @@
+"""Write cost of persisting one /anisong/search result set, before and after the bulk path.
+
+    python -m benchmarks.bench_persistence --songs 20 --rounds 20
+"""
+from sqlalchemy import event
+from sqlmodel import SQLModel, Session, create_engine
+from src.services.anisong_services import save_anisong, save_search_results, save_user_history
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+
+def make_songs(count: int, offset: int = 0):
+    return [{
+        "anime": f"Anime {i}",
+        "song_title": f"Song {i}",
+        "artists": [f"Artist {i}"],
+        "youtube_url": f"https://www.youtube.com/watch?v={i}",
+        "spotify_url": {"spotify_url": f"https://open.spotify.com/track/{i}", "popularity": i}
+    } for i in range(offset, offset + count)]
+
+
+async def per_row(session: Session, songs: list[dict], user_id: int):
+    # what search_and_resolve_anisong + search_anisong_route did before: every song saved twice,
+    # two history rows, a commit for each
+    for _ in range(2):
+        for song in songs:
+            spotify = song["spotify_url"]
+            saved = save_anisong(session, song["song_title"], song["artists"][0], song["anime"],
+                                 spotify["spotify_url"], spotify["popularity"], song["youtube_url"])
+            await save_user_history(session, user_id, saved.id)
+
+
+async def bulk(session: Session, songs: list[dict], user_id: int):
+    save_search_results(session, songs, user_id)
+
+
+def run(name, writer, songs_per_search: int, rounds: int):
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    engine = create_engine(f"sqlite:///{path}")
+    SQLModel.metadata.create_all(engine)
+    counts = {"statements": 0, "commits": 0}
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def count_statement(*args):
+        counts["statements"] += 1
+
+    @event.listens_for(engine, "commit")
+    def count_commit(*args):
+        counts["commits"] += 1
+
+    timings = []
+    with Session(engine) as session:
+        for i in range(rounds):
+            # half of every search is songs already in the catalog, like repeat traffic
+            songs = make_songs(songs_per_search, offset=i * songs_per_search // 2)
+            started = time.perf_counter()
+            asyncio.run(writer(session, songs, 1))
+            timings.append(time.perf_counter() - started)
+
+    return {
+        "path": name,
+        "ms_per_search": round(statistics.mean(timings) * 1000, 2),
+        "statements_per_search": counts["statements"] / rounds,
+        "commits_per_search": counts["commits"] / rounds
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--songs", type=int, default=20)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    for name, writer in (("per_row", per_row), ("bulk", bulk)):
+        print(run(name, writer, args.songs, args.rounds))
+
+
+if __name__ == "__main__":
+    main()
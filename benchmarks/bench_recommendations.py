@@ -0,0 +1,98 @@
+"""Latency of /recommendations scoring over a synthetic catalog.
+
+    python -m benchmarks.bench_recommendations --songs 100000 --rounds 200
+"""
+from sqlmodel import SQLModel, Session
+from src.models.anisong_model import AnisongDB
+from src.models.user_model import UserPreference
+from src.services import recommendation_service
+from src.services.recommendation_service import RecommendationIndex, recommend_for_user
+from src.utils.sqlite import create_sqlite_engine
+import argparse
+import json
+import random
+import statistics
+import tempfile
+import time
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(p * len(values)), len(values) - 1)] if values else 0.0
+
+
+def make_rows(songs: int, artists: int, animes: int):
+    rng = random.Random(7)
+    return [
+        (i, f"Artist {rng.randrange(artists)}", f"Anime {rng.randrange(animes)}", rng.randrange(100))
+        for i in range(1, songs + 1)
+    ]
+
+
+def timed(func, rounds: int):
+    latencies = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        func()
+        latencies.append((time.perf_counter() - started) * 1000)
+    return {"p50_ms": round(statistics.median(latencies), 3), "p99_ms": round(percentile(latencies, 0.99), 3)}
+
+
+def bench(songs: int, rounds: int, tags: int, limit: int):
+    rows = make_rows(songs, artists=songs // 20, animes=songs // 10)
+    rng = random.Random(11)
+    preferences = {
+        (f"Artist {rng.randrange(songs // 20)}" if i % 2 else f"Anime {rng.randrange(songs // 10)}"): rng.uniform(1, 20)
+        for i in range(tags)
+    }
+    seen = [rng.randrange(1, songs) for _ in range(200)]
+
+    index = RecommendationIndex()
+    started = time.perf_counter()
+    index.extend(rows)
+    build_ms = (time.perf_counter() - started) * 1000
+
+    def python_loop():
+        # the per song loop a plain implementation would run
+        weights = {tag: weight for tag, weight in preferences.items()}
+        scored = sorted(((weights.get(artist, 0) + weights.get(anime, 0), song_id) for song_id, artist, anime, _ in rows), reverse=True)
+        return scored[:limit]
+
+    # the whole request path on a database with the same catalog
+    engine = create_sqlite_engine(f"sqlite:///{tempfile.mkdtemp()}/bench.db")
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.execute(AnisongDB.__table__.insert(), [
+            {"id": i, "title": f"Song {i}", "artist": artist, "anime": anime, "spotify_popularity": popularity}
+            for i, artist, anime, popularity in rows
+        ])
+        session.execute(UserPreference.__table__.insert(), [
+            {"user_id": 1, "tag": tag, "weight": weight} for tag, weight in preferences.items()
+        ])
+        session.commit()
+        recommendation_service.recommendation_index = RecommendationIndex()
+        recommend_for_user(session, 1, limit)
+
+        return {
+            "songs": songs,
+            "preference_tags": tags,
+            "limit": limit,
+            "index_build_ms": round(build_ms, 1),
+            "python_loop": timed(python_loop, max(rounds // 20, 3)),
+            "top_k": timed(lambda: index.top_k(preferences, limit, exclude=seen), rounds),
+            "recommend_for_user": timed(lambda: recommend_for_user(session, 1, limit), rounds)
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--songs", type=int, default=100000)
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--tags", type=int, default=50)
+    parser.add_argument("--limit", type=int, default=10)
+    args = parser.parse_args()
+    print(json.dumps(bench(args.songs, args.rounds, args.tags, args.limit)))
+
+
+if __name__ == "__main__":
+    main()
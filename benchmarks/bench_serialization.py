@@ -0,0 +1,81 @@
+"""Encoding cost of a 50 song /anisong response: FastAPI's default jsonable_encoder + JSONResponse
+against FastJSONResponse, with and without a fields= projection.
+
+    python -m benchmarks.bench_serialization --songs 50 --calls 2000
+"""
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from src.services.anisong_services import song_result
+from src.utils.responses import FastJSONResponse
+import argparse
+import json
+import statistics
+import time
+
+
+def enriched_songs(count: int) -> list[dict]:
+    # what enrich_songs hands the routes, Spotify match included
+    return [
+        {
+            "anime": f"Benchmark Anime {i}",
+            "song_title": f"Benchmark Song {i}",
+            "theme_type": "OP" if i % 2 else "ED",
+            "artists": [f"Benchmark Artist {i}", f"Featured Artist {i % 7}"],
+            "youtube_url": f"https://www.youtube.com/watch?v={i:011d}",
+            "spotify_url": {
+                "spotify_url": f"https://open.spotify.com/track/{i:022d}",
+                "name": f"Benchmark Song {i}",
+                "artists": f"Benchmark Artist {i}",
+                "popularity": i % 100
+            }
+        }
+        for i in range(count)
+    ]
+
+
+def default_response(songs: list[dict]) -> bytes:
+    return JSONResponse(jsonable_encoder({"count": len(songs), "results": songs})).body
+
+
+def fast_response(songs: list[dict], fields=None) -> bytes:
+    results = [song_result(song, fields) for song in songs]
+    return FastJSONResponse({"count": len(results), "results": results}).body
+
+
+def per_call_us(func, calls: int) -> tuple[float, float]:
+    timings = []
+    for _ in range(calls):
+        started = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started) * 1e6)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.99) - 1]
+
+
+def bench(songs: int, calls: int):
+    data = enriched_songs(songs)
+    variants = {
+        "default": lambda: default_response(data),
+        "fast": lambda: fast_response(data),
+        "fast_projected": lambda: fast_response(data, ("song_title", "spotify_url"))
+    }
+
+    report = {"songs": songs, "calls": calls}
+    for name, func in variants.items():
+        p50, p99 = per_call_us(func, calls)
+        report[name] = {"p50_us": round(p50, 1), "p99_us": round(p99, 1), "bytes": len(func())}
+    report["speedup"] = round(report["default"]["p50_us"] / report["fast"]["p50_us"], 1)
+    report["projected_speedup"] = round(report["default"]["p50_us"] / report["fast_projected"]["p50_us"], 1)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--songs", type=int, default=50)
+    parser.add_argument("--calls", type=int, default=2000)
+    args = parser.parse_args()
+    print(json.dumps(bench(args.songs, args.calls)))
+
+
+if __name__ == "__main__":
+    main()
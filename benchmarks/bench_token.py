@@ -0,0 +1,52 @@
+"""Per request cost of the auth dependency, full JWT decode against a cache hit.
+
+    python -m benchmarks.bench_token --calls 20000
+"""
+from src.routers.auth import get_current_user
+from src.services.auth_services import authenticate, create_token, decode_token, token_cache
+import argparse
+import asyncio
+import json
+import time
+
+
+def per_call_us(func, calls: int) -> float:
+    started = time.perf_counter()
+    for _ in range(calls):
+        func()
+    return (time.perf_counter() - started) / calls * 1e6
+
+
+async def dependency_us(token: str, calls: int) -> float:
+    started = time.perf_counter()
+    for _ in range(calls):
+        await get_current_user(token)
+    return (time.perf_counter() - started) / calls * 1e6
+
+
+def bench(calls: int):
+    token = create_token(1)
+    token_cache.clear()
+    decode = per_call_us(lambda: decode_token(token), calls)
+    authenticate(token)
+    cached = per_call_us(lambda: authenticate(token), calls)
+    dependency = asyncio.run(dependency_us(token, calls))
+
+    return {
+        "calls": calls,
+        "decode_us": round(decode, 2),
+        "cache_hit_us": round(cached, 2),
+        "dependency_us": round(dependency, 2),
+        "speedup": round(decode / cached, 1)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=20000)
+    args = parser.parse_args()
+    print(json.dumps(bench(args.calls)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""In-process stand-in for the AnimeThemes, Spotify and YouTube APIs.
+
+Answers from recorded fixtures (benchmarks/fixtures/upstream.json) with configurable latency,
+jitter, error rate and YouTube quota (403) rate. Seeded, so two runs see the same sequence.
+
+    fake = FakeUpstream(latency=0.05, jitter=0.02, error_rate=0.01)
+    clients = UpstreamClients(transport=fake.transport())
+"""
+from collections import Counter
+from typing import Optional
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import httpx
+
+FIXTURES_PATH = os.path.join(os.path.dirname(__file__), "fixtures", "upstream.json")
+
+UPSTREAM_HOSTS = {
+    "api.animethemes.moe": "animethemes",
+    "accounts.spotify.com": "spotify_token",
+    "api.spotify.com": "spotify",
+    "www.googleapis.com": "youtube"
+}
+
+
+def load_fixtures(path: str = FIXTURES_PATH) -> dict:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _digest(value: str) -> str:
+    return hashlib.sha1(value.encode()).hexdigest()[:11]
+
+
+class FakeUpstream:
+    def __init__(
+        self,
+        latency: float = 0.05,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        quota_rate: float = 0.0,
+        seed: int = 7,
+        fixtures: Optional[dict] = None
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.quota_rate = quota_rate
+        self.fixtures = fixtures or load_fixtures()
+        self.calls = Counter()
+        self.errors = Counter()
+        self._rng = random.Random(seed)
+
+    def transport(self) -> httpx.MockTransport:
+        return httpx.MockTransport(self.handle)
+
+    def snapshot(self) -> dict:
+        return dict(self.calls)
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        upstream = UPSTREAM_HOSTS.get(request.url.host)
+        if upstream is None:
+            return httpx.Response(404)
+        self.calls[upstream] += 1
+
+        # every random draw happens in request order, the sleep comes after them
+        delay = max(self.latency + self._rng.uniform(-self.jitter, self.jitter), 0)
+        failed = self._rng.random() < self.error_rate
+        over_quota = upstream == "youtube" and self._rng.random() < self.quota_rate
+        await asyncio.sleep(delay)
+
+        if failed:
+            self.errors[upstream] += 1
+            return httpx.Response(503, json={"message": "Service Unavailable"})
+        if over_quota:
+            self.errors["youtube_quota"] += 1
+            return httpx.Response(403, json=self.fixtures["youtube_quota"])
+        return httpx.Response(200, json=self._body(upstream, request))
+
+    def _body(self, upstream: str, request: httpx.Request) -> dict:
+        if upstream == "animethemes":
+            return self.fixtures["animethemes"].get(request.url.path, {})
+        if upstream == "spotify_token":
+            return self.fixtures["spotify_token"]
+        if upstream == "youtube":
+            return {"items": [{"id": {"kind": "youtube#video", "videoId": _digest(request.url.params.get("q", ""))}}]}
+
+        # the recorded track, renamed after whatever was searched for
+        q = request.url.params.get("q", "")
+        title = re.search(r"track:(.+?)(?: artist:|$)", q)
+        artist = re.search(r"artist:(.+)$", q)
+        track = dict(self.fixtures["spotify_track"])
+        track["external_urls"] = {"spotify": track["external_urls"]["spotify"] + _digest(q)}
+        track["name"] = title.group(1) if title else q
+        track["artists"] = [{"name": artist.group(1) if artist else "Unknown"}]
+        return {"tracks": {"items": [track]}}
@@ -1,20 +1,56 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from src.routers import anisong, auth, preferences
-from src.utils.sqlite import create_db_and_tables
+from src.routers import anisong, auth, jobs, metrics, preferences, profiles, recommendations
+from src.utils.sqlite import create_db_and_tables, shutdown_db_executor
+from src.utils.http_client import clients
+from src.services.spotify_services import spotify_tokens
+from src.services.auth_services import password_pool
+from src.services.similarity_service import similarity_updater
+from src.services.recommendation_cache import recommendation_cache
+from src.services.job_queue import job_queue
+from src.services.profiling import ProfileMiddleware
+from src.utils.http_cache import ConditionalGetMiddleware
+from src.utils.metrics import MetricsMiddleware
+from src.utils.responses import FastJSONResponse
+from src.utils.timing import ServerTimingMiddleware
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    create_db_and_tables()
+    clients.open()
+    spotify_tokens.start(clients.spotify)
+    similarity_updater.start()
+    job_queue.start()
+    yield
+    await job_queue.stop()
+    await similarity_updater.stop()
+    await recommendation_cache.stop()
+    await spotify_tokens.stop()
+    await clients.aclose()
+    shutdown_db_executor()
+    password_pool.shutdown()
 
 app = FastAPI(
     title="Best Anisongs Gathering And Searching",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse
 )
 
 app.include_router(preferences.router)
 app.include_router(anisong.router)
 app.include_router(auth.router)
+app.include_router(recommendations.router)
+app.include_router(jobs.router)
+app.include_router(metrics.router)
+app.include_router(profiles.router)
+
+# the last one added runs first
+app.add_middleware(ConditionalGetMiddleware)
+app.add_middleware(ProfileMiddleware)
+app.add_middleware(ServerTimingMiddleware)
+app.add_middleware(MetricsMiddleware)
 
-@app.on_event("startup")
-def on_start():
-    create_db_and_tables()
-    
 @app.get("/")
 def main():
-    return {"message": "Welcome to Best Anisongs Gathering And Searching!"}
\ No newline at end of file
+    return {"message": "Welcome to Best Anisongs Gathering And Searching!"}
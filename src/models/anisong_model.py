@@ -1,7 +1,10 @@
 from typing import Optional
 
+from sqlalchemy import Index
 from sqlmodel import Field, SQLModel
 class AnisongDB(SQLModel, table=True):
+    __table_args__ = (Index("uq_anisongdb_title_artist", "title", "artist", unique=True),)
+
     id: Optional[int] = Field(default=None, primary_key=True)
     title: str
     artist: str
@@ -0,0 +1,25 @@
+from typing import Optional
+
+from sqlalchemy import UniqueConstraint
+from sqlmodel import Field, SQLModel
+
+class EnrichmentCacheEntry(SQLModel, table=True):
+    __table_args__ = (UniqueConstraint("provider", "cache_key"),)
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    provider: str
+    cache_key: str
+    value: Optional[str]
+    created_at: float
+    accessed_at: float = Field(index=True)
+
+class RecommendationCacheEntry(SQLModel, table=True):
+    __table_args__ = (UniqueConstraint("user_id", "mode", "exclude_seen"),)
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    user_id: int = Field(index=True)
+    mode: str
+    exclude_seen: bool
+    results: str
+    computed_at: float
+    stale: bool = False
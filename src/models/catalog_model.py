@@ -0,0 +1,45 @@
+from typing import Optional
+
+from sqlmodel import Field, SQLModel
+
+# local mirror of the AnimeThemes catalog, ids are the upstream ids
+
+class CatalogAnime(SQLModel, table=True):
+    id: int = Field(primary_key=True)
+    name: str
+    name_key: str = Field(index=True)
+    slug: Optional[str] = None
+    year: Optional[int] = Field(default=None, index=True)
+    season: Optional[str] = Field(default=None, index=True)
+    updated_at: Optional[str] = None
+
+class CatalogTheme(SQLModel, table=True):
+    id: int = Field(primary_key=True)
+    anime_id: int = Field(index=True)
+    song_id: Optional[int] = Field(default=None, index=True)
+    type: Optional[str] = Field(default=None, index=True)
+    sequence: Optional[int] = None
+    updated_at: Optional[str] = None
+
+class CatalogSong(SQLModel, table=True):
+    id: int = Field(primary_key=True)
+    title: Optional[str] = None
+    updated_at: Optional[str] = None
+
+class CatalogArtist(SQLModel, table=True):
+    id: int = Field(primary_key=True)
+    name: str
+    name_key: str = Field(index=True)
+    updated_at: Optional[str] = None
+
+class CatalogSongArtist(SQLModel, table=True):
+    song_id: int = Field(primary_key=True)
+    artist_id: int = Field(primary_key=True, index=True)
+    position: int = 0
+
+class CatalogSyncState(SQLModel, table=True):
+    resource: str = Field(primary_key=True)
+    next_url: Optional[str] = None
+    synced_until: Optional[str] = None
+    run_max: Optional[str] = None
+    pages: int = 0
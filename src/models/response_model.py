@@ -0,0 +1,23 @@
+from pydantic import BaseModel
+from typing import Optional
+
+class AnisongResult(BaseModel):
+    anime: Optional[str] = None
+    song_title: Optional[str] = None
+    theme_type: Optional[str] = None
+    artists: Optional[list[Optional[str]]] = None
+    youtube_url: Optional[str] = None
+    spotify_url: Optional[str] = None
+    spotify_popularity: Optional[int] = None
+
+class AnisongList(BaseModel):
+    count: int
+    results: list[AnisongResult]
+    next_cursor: Optional[str] = None
+
+class QueuedAnisongList(AnisongList):
+    job_id: str
+    status_url: str
+
+# what fields= can pick from
+ANISONG_FIELDS = tuple(AnisongResult.model_fields)
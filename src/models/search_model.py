@@ -0,0 +1,18 @@
+from typing import Optional
+
+from sqlalchemy import UniqueConstraint
+from sqlmodel import Field, SQLModel
+
+class SearchDocument(SQLModel, table=True):
+    __table_args__ = (UniqueConstraint("kind", "key"),)
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    kind: str
+    name: str
+    key: str
+    grams: int
+    weight: int = 1
+
+class SearchGram(SQLModel, table=True):
+    gram: str = Field(primary_key=True)
+    doc_id: int = Field(primary_key=True, index=True)
@@ -1,3 +1,5 @@
+from dataclasses import dataclass
+from sqlalchemy import Index
 from sqlmodel import SQLModel, Field
 from typing import Optional
 from datetime import datetime
@@ -9,6 +11,8 @@ class User(SQLModel, table=True):
     created_at: datetime = Field(default_factory=datetime.utcnow)
     
 class UserPreference(SQLModel, table=True):
+    __table_args__ = (Index("uq_userpreference_user_tag", "user_id", "tag", unique=True),)
+
     id: Optional[int] = Field(default=None, primary_key=True)
     user_id: int = Field(foreign_key="user.id")
     tag: str
@@ -18,4 +22,9 @@ class UserHistory(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     user_id: int = Field(foreign_key="user.id")
     song_id: int = Field(foreign_key="anisongdb.id")
-    score: float
\ No newline at end of file
+    score: float
+
+@dataclass(frozen=True, slots=True)
+class Principal:
+    user_id: int
+    expires_at: int
@@ -1,241 +1,258 @@
-from fastapi import APIRouter, Query, Depends
+from fastapi import APIRouter, HTTPException, Query, Depends, Request
+from functools import partial
 from sqlmodel import Session
-from src.services.anisong_services import fetch_anisong_artist, fetch_anisong_list, fetch_anisong_name, fetch_anisong_criteria, save_anisong, save_user_history, search_and_resolve_anisong
-from src.services.preferences_service import update_preference_from_history
-from src.services.youtube_services import search_youtube
-from src.services.spotify_services import search_spotify
+from src.services.anisong_services import fetch_anisong_artist, fetch_anisong_list, fetch_anisong_name, fetch_anisong_criteria, save_anisong, save_search_results, search_and_resolve_anisong, stream_search_and_resolve
+from src.services.anisong_services import decode_cursor, encode_cursor, fetch_listing_page, iter_listing, listing_url, search_candidates, song_result
+from src.services.anisong_services import STREAM_MAX_PAGES, STREAM_MAX_SONGS
+from src.services.preferences_service import update_preferences_from_songs
+from src.services.enrichment_service import enrich_songs, enrich_songs_as_completed
+from src.services.search_index import suggest
+from src.services.similarity_service import similar_songs
+from src.services.job_queue import Job, JobQueueFull, job_queue
 from src.routers.auth import get_current_user
-from src.utils.sqlite import get_session
+from src.models.user_model import Principal
+from src.models.response_model import ANISONG_FIELDS, AnisongList, AnisongResult, QueuedAnisongList
+from src.utils.sqlite import get_session, run_db
+from src.utils.http_client import UpstreamClients, get_http_clients
+from src.utils.responses import FastJSONResponse
+from src.utils.streaming import stream_format, stream_results
+from src.utils.timing import phase
 from typing import Optional
-import asyncio
 
 router = APIRouter(
     prefix="/anisong",
     tags=["anisong"]
 )
 
-@router.get("/themes")
-async def search_anisongs_by_theme(theme_type: str = Query(..., regex="^(OP|ED|INS)$"), limit: int = Query(5, ge=1, le=50)):
-    anisongs = await fetch_anisong_list(theme_type, limit)
-    anisongs_results = []
-    
-    for song in anisongs:
-        title = song["song_title"]
-        artists = song["artists"]
-        query_yt = f"{title} {song['anime']}"
-    
-        yt_task = search_youtube(query_yt)
-        sp_task = search_spotify(title, artists)
-        
-        yt_url, sp_url = await asyncio.gather(yt_task, sp_task, return_exceptions=True)
-        
-        if isinstance(yt_url, Exception):
-            yt_url = None
-            
-        if isinstance(sp_url, Exception):
-            sp_url = None
-            
-        anisongs_results.append({
-            "anime": song["anime"],
-            "theme_type": song["theme_type"],
-            "song_title": song["song_title"],
-            "artists": song["artists"],
-            "youtube_url": yt_url,
-            "spotify_url": sp_url
-        })
+# background=true answers 202 with a job id
+QUEUED = {202: {"model": QueuedAnisongList}}
+
+def result_fields(
+    fields: Optional[str] = Query(None, description="Comma separated result fields to send, e.g. song_title,spotify_url")
+) -> Optional[tuple[str, ...]]:
+    if fields is None:
+        return None
+    selected = tuple(dict.fromkeys(field.strip() for field in fields.split(",") if field.strip()))
+    unknown = [field for field in selected if field not in ANISONG_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}, pick from {', '.join(ANISONG_FIELDS)}")
+    return selected or None
+
+def _results(songs: list[dict], fields: Optional[tuple[str, ...]], status_code: int = 200, **extra) -> FastJSONResponse:
+    # serialized straight from the dicts, the response models on the routes are for the docs
+    results = [song_result(song, fields) for song in songs]
+    return FastJSONResponse({"count": len(results), "results": results, **extra}, status_code=status_code)
+
+def _stream(stream: str, results, fields: Optional[tuple[str, ...]]):
+    return stream_results(stream, results, shape=partial(song_result, fields=fields))
+
+@router.get("/themes", response_model=AnisongList, responses=QUEUED)
+async def search_anisongs_by_theme(
+    request: Request,
+    theme_type: str = Query(..., regex="^(OP|ED|INS)$"),
+    limit: int = Query(5, ge=1, le=50),
+    cursor: Optional[str] = Query(None, description="next_cursor of the previous page"),
+    paginate: bool = Query(False, description="Answer with a next_cursor, streamed responses walk every page"),
+    background: bool = Query(False, description="Answer with the AnimeThemes data right away, enrichment runs as a job"),
+    fields: Optional[tuple[str, ...]] = Depends(result_fields),
+    clients: UpstreamClients = Depends(get_http_clients)
+):
+    if cursor or paginate:
+        return await _listing(request, "themes", listing_url("themes", limit, theme_type=theme_type), cursor, fields, clients)
+
+    anisongs = await fetch_anisong_list(theme_type, limit, client=clients.animethemes)
+    if background:
+        return _queued(anisongs, fields, clients)
+    if stream := stream_format(request):
+        return _stream(stream, enrich_songs_as_completed(anisongs, clients=clients), fields)
+
+    anisongs_results = await enrich_songs(anisongs, clients=clients)
     
-    return {"count": len(anisongs_results), "results": anisongs_results}
+    return _results(anisongs_results, fields)
 
-@router.get("/names")
+@router.get("/names", response_model=AnisongList, responses=QUEUED)
 async def search_anisong_by_name(
     name: str = Query(..., description="Name of anisong or anime title"),
-    provider: str = Query("spotify", regex="^(spotify|youtube|both)$")
+    provider: str = Query("spotify", regex="^(spotify|youtube|both)$"),
+    background: bool = Query(False, description="Answer with the AnimeThemes data right away, enrichment runs as a job"),
+    fields: Optional[tuple[str, ...]] = Depends(result_fields),
+    clients: UpstreamClients = Depends(get_http_clients)
 ):
 
-    anisong_names = await fetch_anisong_name(name=name, limit=5)    
+    anisong_names = await fetch_anisong_name(name=name, limit=5, client=clients.animethemes)
     
     if not anisong_names:
-        return {"count": 0, "results": []}
+        return _results([], fields)
+    if background:
+        return _queued(anisong_names, fields, clients, provider=provider)
     
-    anisongs_only = []
-    for song in anisong_names:
-        song_title = song.get("song_title", "")
-        artists = song.get("artists", [])
-        
-        main_artist = artists[0] if artists else ""
-        query = f"{song_title} {main_artist} {song['anime']}"
-        
-        raw_yt_url, raw_sp_url = None, None 
-        yt_url, sp_url = None, None       
-        
-        anisongs_search_tasks = []
-        
-        if provider in ("youtube", "both"):
-            anisongs_search_tasks.append(search_youtube(query))
-        if provider in ("spotify", "both"):
-            anisongs_search_tasks.append(search_spotify(song_title, main_artist))
-            
-        if anisongs_search_tasks:
-            response = await asyncio.gather(*anisongs_search_tasks, return_exceptions=True)
-            
-            if provider == "spotify":
-                raw_sp_url = response[0]
-            elif provider == "youtube":
-                raw_yt_url = response[0]
-            elif provider == "both":
-                raw_yt_url, raw_sp_url = response
-
-            if isinstance(raw_yt_url, BaseException):
-                yt_url = None
-            else:
-                yt_url = raw_yt_url
-
-            if isinstance(raw_sp_url, BaseException):
-                sp_url = None
-            else:
-                sp_url = raw_sp_url
-            
-        anisongs_only.append({
-            "anime": song["anime"],
-            "song_title": song["song_title"],
-            "theme_type": song["theme_type"],
-            "artists": song["artists"],
-            "youtube_url": yt_url,
-            "spotify_url": sp_url
-        })
-
-    return {"count": len(anisongs_only), "results": anisongs_only}
-
-@router.get("/artists")
+    anisongs_only = await enrich_songs(anisong_names, provider=provider, clients=clients)
+
+    return _results(anisongs_only, fields)
+
+@router.get("/artists", response_model=AnisongList, responses=QUEUED)
 async def search_anisong_by_artist(
+    request: Request,
     artist: str = Query(..., description="Name of artist"),
-    limit: int = Query(25, ge=1, le=50)
+    limit: int = Query(25, ge=1, le=50),
+    cursor: Optional[str] = Query(None, description="next_cursor of the previous page"),
+    paginate: bool = Query(False, description="Answer with a next_cursor, streamed responses walk every page"),
+    background: bool = Query(False, description="Answer with the AnimeThemes data right away, enrichment runs as a job"),
+    fields: Optional[tuple[str, ...]] = Depends(result_fields),
+    clients: UpstreamClients = Depends(get_http_clients)
 ):
-    anisongs = await fetch_anisong_artist(artist=artist, limit=limit)
+    if cursor or paginate:
+        return await _listing(request, "artists", listing_url("artists", limit, artist=artist), cursor, fields, clients)
+
+    anisongs = await fetch_anisong_artist(artist=artist, limit=limit, client=clients.animethemes)
+    if background:
+        return _queued(anisongs, fields, clients)
+    if stream := stream_format(request):
+        return _stream(stream, enrich_songs_as_completed(anisongs, clients=clients), fields)
     
     if not anisongs:
-        return {"count": 0, "results": []}
+        return _results([], fields)
     
-    anisongs_results = []
-    for song in anisongs:
-        title = song.get("song_title", "")
-        artists = song.get("artists", [])
-        
-        main_artist = artists[0] if artists else ""
-        query = f"{title} {main_artist} {song.get('anime', '')}"
-        
-        yt_task = search_youtube(query)
-        sp_task = search_spotify(title, main_artist)
-        raw_yt_url, raw_sp_url = await asyncio.gather(yt_task, sp_task, return_exceptions=True)
-
-        if isinstance(raw_yt_url, BaseException):
-            yt_url = None
-        else:
-            yt_url = raw_yt_url
+    anisongs_results = await enrich_songs(anisongs, clients=clients)
         
-        if isinstance(raw_sp_url, BaseException):
-            sp_url = None
-        else:
-            sp_url = raw_sp_url
-            
-        anisongs_results.append({
-            "anime": song["anime"],
-            "song_title": song["song_title"],
-            "theme_type": song["theme_type"],
-            "artists": song["artists"],
-            "youtube_url": yt_url,
-            "spotify_url": sp_url
-        })    
-        
-    return {"count": len(anisongs_results), "results": anisongs_results}
+    return _results(anisongs_results, fields)
 
-@router.get("/criteria")
+@router.get("/criteria", response_model=AnisongList, responses=QUEUED)
 async def search_anisong_by_criteria(
+    request: Request,
     year: Optional[int] = Query(None, description="Filter by year (2025|2024|2023|2022|...)"),
     season: Optional[str] = Query(None, regex="^(Winter|Spring|Summer|Fall)"),
-    limit: int = Query(25, ge=1, le=50)
+    limit: int = Query(25, ge=1, le=50),
+    cursor: Optional[str] = Query(None, description="next_cursor of the previous page"),
+    paginate: bool = Query(False, description="Answer with a next_cursor, streamed responses walk every page"),
+    background: bool = Query(False, description="Answer with the AnimeThemes data right away, enrichment runs as a job"),
+    fields: Optional[tuple[str, ...]] = Depends(result_fields),
+    clients: UpstreamClients = Depends(get_http_clients)
 ):
-    
+    if cursor or paginate:
+        return await _listing(request, "criteria", listing_url("criteria", limit, year=year, season=season), cursor, fields, clients)
+
     anisongs = await fetch_anisong_criteria(
         year=year,
         season=season,
-        limit=limit
+        limit=limit,
+        client=clients.animethemes
     )
+    if background:
+        return _queued(anisongs, fields, clients)
+    if stream := stream_format(request):
+        return _stream(stream, enrich_songs_as_completed(anisongs, clients=clients), fields)
     
     if not anisongs:
-        return {"count": 0, "results": []}
+        return _results([], fields)
     
-    anisongs_results = []
-    for song in anisongs:
-        title = song.get("song_title", "")
-        artists = song.get("artists", [])
-        
-        main_artist = artists[0] if artists else ""
-        query = f"{title} {main_artist} {song.get('anime', '')}"
-        
-        yt_task = search_youtube(query)
-        sp_task = search_spotify(title, main_artist)
-        raw_yt_url, raw_sp_url = await asyncio.gather(yt_task, sp_task, return_exceptions=True)
-
-        if isinstance(raw_yt_url, BaseException):
-            yt_url = None
-        else:
-            yt_url = raw_yt_url
+    anisongs_results = await enrich_songs(anisongs, clients=clients)
         
-        if isinstance(raw_sp_url, BaseException):
-            sp_url = None
-        else:
-            sp_url = raw_sp_url
-            
-        anisongs_results.append({
-            "anime": song["anime"],
-            "song_title": song["song_title"],
-            "theme_type": song["theme_type"],
-            "artists": song["artists"],
-            "youtube_url": yt_url,
-            "spotify_url": sp_url
-        })    
-        
-    return {"count": len(anisongs_results), "results": anisongs_results}
+    return _results(anisongs_results, fields)
+
+def _queued(
+    anisongs: list[dict],
+    fields: Optional[tuple[str, ...]],
+    clients: UpstreamClients,
+    provider: str = "both",
+    priority: str = "normal",
+    user_id: Optional[int] = None,
+    on_done=None
+) -> FastJSONResponse:
+    # 202 with the AnimeThemes data as is, the links follow through /jobs/{id}
+    try:
+        job = job_queue.submit(anisongs, provider, clients, priority, user_id, on_done)
+    except JobQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+    return _results(anisongs, fields, 202, job_id=job.id, status_url=f"/jobs/{job.id}")
+
+async def _listing(
+    request: Request,
+    listing: str,
+    url: str,
+    cursor: Optional[str],
+    fields: Optional[tuple[str, ...]],
+    clients: UpstreamClients
+):
+    # limit is the upstream page size, a cursor carries on where the previous page stopped
+    if cursor:
+        try:
+            url = decode_cursor(listing, cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    if stream := stream_format(request):
+        # read when the summary frame is sent, after the walk has ended
+        walk = {}
+        songs = iter_listing(listing, url, clients.animethemes, STREAM_MAX_PAGES, STREAM_MAX_SONGS, walk)
+        results = enrich_songs_as_completed(songs, clients=clients)
+        return stream_results(stream, results, summary=walk, shape=partial(song_result, fields=fields))
+
+    anisongs, next_url = await fetch_listing_page(listing, url, clients.animethemes)
+    anisongs_results = await enrich_songs(anisongs, clients=clients) if anisongs else []
+    return _results(anisongs_results, fields, next_cursor=encode_cursor(listing, next_url) if next_url else None)
+
+@router.get("/suggest")
+async def suggest_anisong(
+    q: str = Query(..., min_length=1, description="Partial or misspelled anime, song or artist name"),
+    kind: Optional[str] = Query(None, pattern="^(anime|song|artist)$"),
+    limit: int = Query(10, ge=1, le=50)
+):
+    results = await run_db(suggest, q, limit, kind)
+    return {"count": len(results), "results": results}
+
+@router.get("/{song_id}/similar")
+async def similar_anisongs(
+    song_id: int,
+    limit: int = Query(10, ge=1, le=50)
+):
+    results = await run_db(similar_songs, song_id, limit)
+    if results is None:
+        raise HTTPException(status_code=404, detail="Song not found")
+    return {"count": len(results), "results": results}
 
 @router.post("/save")
 def save_song_route(title: str, artist: str, anime: str, spotify_url: str, popularity: int, youtube_url: str, session: Session = Depends(get_session)):
     return save_anisong(session, title, artist, anime, spotify_url, popularity, youtube_url)
 
-@router.post("/search")
+@router.post("/search", response_model=list[AnisongResult], responses=QUEUED)
 async def search_anisong_route(
+    request: Request,
     q: list[str] = Query(),
-    session: Session = Depends(get_session),
-    user_id = Depends(get_current_user)
+    limit: int = Query(15, ge=1, le=50),
+    background: bool = Query(False, description="Answer with the AnimeThemes data right away, enrichment runs as a job"),
+    fields: Optional[tuple[str, ...]] = Depends(result_fields),
+    principal: Principal = Depends(get_current_user),
+    clients: UpstreamClients = Depends(get_http_clients)
 ):
-    songs = await search_and_resolve_anisong(q, session, user_id)
+    if background:
+        candidates = await search_candidates(q, clients, limit)
+        if not candidates:
+            return FastJSONResponse({"message": "no result found"})
+        return _queued(candidates, fields, clients, priority="high", user_id=principal.user_id, on_done=_save_search_job)
+
+    if stream := stream_format(request):
+        return _stream(stream, _search_stream(q, principal.user_id, limit, clients), fields)
+
+    songs = await search_and_resolve_anisong(q, principal.user_id, limit, clients=clients)
     if not songs:
-        return {"message": "no result found"}
-
-    for song in songs:
-        title = song["song_title"]
-        artist = song["artists"][0] if song["artists"] else "Unknown"
-        anime = song["anime"]
-        spotify = song["spotify_url"]
-        youtube = song["youtube_url"]
-
-        saved = save_anisong(
-            session,
-            title,
-            artist,
-            anime,
-            spotify,
-            0,
-            youtube
-        )
-
-        await save_user_history(session, int(user_id), saved.id)
-        update_preference_from_history(
-            session,
-            int(user_id),
-            saved.artist,
-            saved.anime
-        )
-
-    return songs
+        return FastJSONResponse({"message": "no result found"})
+
+    with phase("preferences"):
+        await run_db(update_preferences_from_songs, principal.user_id, songs)
+
+    return FastJSONResponse([song_result(song, fields) for song in songs])
+
+async def _search_stream(q: list[str], user_id: int, limit: int, clients: UpstreamClients):
+    songs = []
+    async for index, song in stream_search_and_resolve(q, user_id, limit, clients=clients):
+        songs.append(song)
+        yield index, song
+    if songs:
+        await run_db(update_preferences_from_songs, user_id, songs)
 
+async def _save_search_job(job: Job):
+    songs = [song for song in job.results if song is not None]
+    if songs:
+        await run_db(save_search_results, songs, job.user_id)
+        await run_db(update_preferences_from_songs, job.user_id, songs)
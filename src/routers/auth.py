@@ -1,10 +1,11 @@
 from fastapi import APIRouter, Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
-from sqlmodel import Session
-from src.utils.sqlite import get_session
-from src.services.user_services import get_user_by_username, create_user
-from src.services.auth_services import verify_password, create_token, decode_token
+from src.utils.sqlite import run_db
+from src.services.user_services import get_user_by_username, create_user, is_admin
+from src.services.auth_services import INVALID_TOKEN_ERRORS, PasswordPoolBusy, authenticate, create_token, hash_password_async, verify_password_async
 from src.models.request_model import RegisterRequest, LoginRequest
+from src.models.user_model import Principal
+import logging
 
 router = APIRouter(
     prefix="/auth",
@@ -13,31 +14,51 @@ router = APIRouter(
 
 oauth_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
-def get_current_user(token: str = Depends(oauth_scheme)):
+async def get_current_user(token: str = Depends(oauth_scheme)) -> Principal:
     try:
-        payload = decode_token(token)
-        return payload["sub"]
-    except Exception:
+        return authenticate(token)
+    except INVALID_TOKEN_ERRORS:
         raise HTTPException(status_code=401, detail="Invalid or expired Token")
 
+async def require_admin(principal: Principal = Depends(get_current_user)) -> Principal:
+    if not await run_db(is_admin, principal.user_id):
+        raise HTTPException(status_code=403, detail="Admin only")
+    return principal
+
+BUSY_DETAIL = "Too many login attempts in progress, try again later"
+
 @router.post("/register")
-def register(data: RegisterRequest, session: Session = Depends(get_session)):
-    user = get_user_by_username(session, data.username)
+async def register(data: RegisterRequest):
+    user = await run_db(get_user_by_username, data.username)
     
     if user:
         raise HTTPException(status_code=400, detail="username already exists")
 
-    new_user = create_user(session, data.username, data.password)
+    try:
+        hashed = await hash_password_async(data.password)
+    except PasswordPoolBusy:
+        raise HTTPException(status_code=503, detail=BUSY_DETAIL, headers={"Retry-After": "1"})
+
+    new_user = await run_db(create_user, data.username, data.password, password_hash=hashed)
     return {"id": new_user.id, "username": new_user.username}
 
 @router.post("/login")
-def login(data: LoginRequest, session: Session = Depends(get_session)):
-    user = get_user_by_username(session, data.username)
+async def login(data: LoginRequest):
+    user = await run_db(get_user_by_username, data.username)
     if not user:
         raise HTTPException(status_code=401, detail="Invalid Username")
 
-    if not verify_password(data.password, user.password_hash):
+    try:
+        valid = await verify_password_async(data.password, user.password_hash)
+    except PasswordPoolBusy:
+        raise HTTPException(status_code=503, detail=BUSY_DETAIL, headers={"Retry-After": "1"})
+    except ValueError as e:
+        # passlib rejects a stored hash it cannot read, that account cannot log in
+        logging.warning(f"Unreadable password hash for user {user.id}: {e}")
+        raise HTTPException(status_code=401, detail="Invalid Password")
+
+    if not valid:
         raise HTTPException(status_code=401, detail="Invalid Password")
 
     token = create_token(user.id)
-    return {"access_token": token, "token_type": "bearer"}
\ No newline at end of file
+    return {"access_token": token, "token_type": "bearer"}
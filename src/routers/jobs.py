@@ -0,0 +1,25 @@
+from fastapi import APIRouter, HTTPException, Request
+from src.services.anisong_services import song_result
+from src.services.job_queue import job_queue
+from src.utils.responses import FastJSONResponse
+from src.utils.streaming import stream_format, stream_results
+
+router = APIRouter(
+    prefix="/jobs",
+    tags=["jobs"]
+)
+
+@router.get("/{job_id}")
+async def get_job(request: Request, job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    # subscribing with a streaming Accept header sends each song as its enrichment finishes
+    if stream := stream_format(request):
+        return stream_results(stream, job.follow(), summary={"job_id": job.id}, shape=song_result)
+
+    return FastJSONResponse({
+        **job.summary(),
+        "results": [song_result(song) if song is not None else None for song in job.results]
+    })
@@ -0,0 +1,75 @@
+from fastapi import APIRouter, Response
+from src.services.anisong_services import animethemes_cache
+from src.services.auth_services import token_cache
+from src.services.enrichment_cache import get_enrichment_cache
+from src.services.job_queue import job_queue
+from src.services.recommendation_cache import recommendation_cache
+from src.services.spotify_services import spotify_tokens
+from src.utils.http_cache import response_etags
+from src.utils.metrics import CONTENT_TYPE, registry
+
+router = APIRouter(tags=["metrics"])
+
+
+def _cache_counts() -> dict[str, tuple[float, float]]:
+    # (hits, misses) per cache, read from the counters the caches already keep
+    counts = {
+        "animethemes": (animethemes_cache.hits, animethemes_cache.misses),
+        "token": (token_cache.hits, token_cache.misses),
+        "recommendations": (
+            recommendation_cache.hits + recommendation_cache.stale_hits,
+            recommendation_cache.misses
+        ),
+        # If-None-Match answered with a 304 before the route ran
+        "etag": (
+            sum(etags.hits for etags in response_etags.values()),
+            sum(etags.misses for etags in response_etags.values())
+        )
+    }
+    for provider, stats in get_enrichment_cache().stats.items():
+        # hits already include the catalog hits, those are exported on their own below
+        counts[f"enrichment_{provider}"] = (stats["hits"], stats["misses"])
+    return counts
+
+
+@registry.collector
+def collect_caches():
+    counts = _cache_counts()
+    yield "cache_hits_total", "counter", "Cache lookups answered from the cache", [
+        ({"cache": cache}, hits) for cache, (hits, _) in counts.items()
+    ]
+    yield "cache_misses_total", "counter", "Cache lookups that had to load", [
+        ({"cache": cache}, misses) for cache, (_, misses) in counts.items()
+    ]
+    yield "cache_hit_ratio", "gauge", "Hits over all lookups since start", [
+        ({"cache": cache}, hits / (hits + misses)) for cache, (hits, misses) in counts.items() if hits + misses
+    ]
+    yield "enrichment_catalog_hits_total", "counter", "Enrichment cache misses answered from AnisongDB", [
+        ({"provider": provider}, stats["catalog_hits"]) for provider, stats in get_enrichment_cache().stats.items()
+    ]
+    yield "animethemes_cache_coalesced_total", "counter", "AnimeThemes requests that joined one already in flight", [
+        ({}, animethemes_cache.coalesced)
+    ]
+
+
+@registry.collector
+def collect_background():
+    tokens = spotify_tokens.metrics()
+    yield "spotify_token_refreshes_total", "counter", "Spotify access token refreshes", [
+        ({"outcome": "success"}, tokens["refresh_count"]),
+        ({"outcome": "failure"}, tokens["refresh_failures"])
+    ]
+    yield "spotify_token_refresh_seconds_total", "counter", "Time spent refreshing the Spotify token", [
+        ({}, tokens["total_refresh_latency"])
+    ]
+    yield "spotify_token_expires_in_seconds", "gauge", "Seconds left on the current Spotify token", [
+        ({}, tokens["expires_in"])
+    ]
+    yield "enrichment_queue_depth", "gauge", "Songs waiting for background enrichment", [
+        ({}, job_queue.depth())
+    ]
+
+
+@router.get("/metrics")
+def metrics():
+    return Response(registry.render(), media_type=CONTENT_TYPE)
@@ -0,0 +1,35 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import PlainTextResponse, Response
+from src.models.user_model import Principal
+from src.routers.auth import require_admin
+from src.services.profiling import profile_dump, profile_store, profile_text
+
+router = APIRouter(
+    prefix="/profiles",
+    tags=["profiles"]
+)
+
+@router.get("/")
+async def list_profiles(principal: Principal = Depends(require_admin)):
+    profiles = profile_store.list()
+    return {"count": len(profiles), "results": profiles}
+
+@router.get("/{profile_id}")
+async def get_profile(
+    profile_id: str,
+    format: str = Query("text", pattern="^(text|pstats)$"),
+    sort: str = Query("cumulative", pattern="^(cumulative|tottime|calls)$"),
+    limit: int = Query(60, ge=1, le=1000),
+    principal: Principal = Depends(require_admin)
+):
+    profile = profile_store.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+
+    if format == "pstats":
+        return Response(
+            profile_dump(profile),
+            media_type="application/octet-stream",
+            headers={"Content-Disposition": f'attachment; filename="{profile_id}.pstats"'}
+        )
+    return PlainTextResponse(profile_text(profile, sort, limit))
@@ -0,0 +1,19 @@
+from fastapi import APIRouter, Depends, Query
+from src.services.recommendation_cache import recommendation_cache
+from src.routers.auth import get_current_user
+from src.models.user_model import Principal
+
+router = APIRouter(
+    prefix="/recommendations",
+    tags=["recommendations"]
+)
+
+@router.get("/")
+async def list_recommendations(
+    limit: int = Query(10, ge=1, le=100),
+    exclude_seen: bool = Query(True, description="Leave out songs the user already searched"),
+    mode: str = Query("preferences", pattern="^(preferences|also_searched)$", description="also_searched: songs that users with a similar history searched"),
+    principal: Principal = Depends(get_current_user)
+):
+    results = await recommendation_cache.get(principal.user_id, mode, limit, exclude_seen)
+    return {"count": len(results), "results": results}
@@ -1,19 +1,69 @@
 import httpx
-from typing import Optional
+from typing import AsyncIterator, Optional
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert
 from sqlmodel import Session, select
 from src.models.anisong_model import AnisongDB
 from src.models.user_model import UserHistory
-from src.services.youtube_services import search_youtube
-from src.services.spotify_services import search_spotify
+from src.services.enrichment_service import enrich_songs, enrich_songs_as_completed
+from src.services.catalog_service import (
+    local_anisong_artist,
+    local_anisong_criteria,
+    local_anisong_list,
+    local_anisong_name,
+    local_anisong_song,
+    local_first_enabled
+)
+from src.services.search_index import best_match, index_names
+from src.services.recommendation_cache import recommendation_cache
+from src.services.recommendation_service import mark_anisongs_changed
+from src.utils.http_client import UpstreamClients, get_http_clients
+from src.utils.cache import AsyncTTLCache, make_key
+from src.utils.sqlite import run_db
+from src.utils.timing import phase
+import asyncio
+import base64
+import json
 import logging
+import os
 logging.basicConfig(level=logging.INFO)
 
 BASE_URL = "https://api.animethemes.moe"
+UPSERT_CHUNK_SIZE = 500
+# a streamed paginate=true listing stops here, every song costs a YouTube lookup. 0 turns a cap off
+STREAM_MAX_PAGES = int(os.getenv("STREAM_MAX_PAGES", "10"))
+STREAM_MAX_SONGS = int(os.getenv("STREAM_MAX_SONGS", "250"))
 
-async def fetch_anisong_list(theme_type: str, limit: int = 25):
+animethemes_cache = AsyncTTLCache(
+    ttl=float(os.getenv("ANIMETHEMES_CACHE_TTL", "21600")),
+    max_entries=int(os.getenv("ANIMETHEMES_CACHE_MAX_ENTRIES", "512")),
+    max_bytes=int(os.getenv("ANIMETHEMES_CACHE_MAX_BYTES", "33554432"))
+)
+
+async def _cached(key: tuple, loader):
+    # callers get their own list, the cached one is shared
+    return list(await animethemes_cache.get_or_load(key, loader))
+
+async def _from_catalog(func, *args):
+    # local-first mode answers from the mirrored catalog, an empty answer falls back to upstream
+    if not local_first_enabled():
+        return []
+    return await run_db(func, *args)
+
+async def fetch_anisong_list(theme_type: str, limit: int = 25, client: Optional[httpx.AsyncClient] = None):
     if theme_type not in ["OP", "ED", "INS"]:
         return []
-    
+
+    local = await _from_catalog(local_anisong_list, theme_type, limit)
+    if local:
+        return local
+
+    return await _cached(
+        make_key("list", theme_type, limit),
+        lambda: _load_anisong_list(theme_type, limit, client)
+    )
+
+async def _load_anisong_list(theme_type: str, limit: int, client: Optional[httpx.AsyncClient]):
     url = (
         f"{BASE_URL}/animetheme?"
         f"filter[type]={theme_type}"
@@ -22,29 +72,34 @@ async def fetch_anisong_list(theme_type: str, limit: int = 25):
         f"&include=anime,animethemeentries,song.artists"
     )
     
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url)
-        response.raise_for_status()
-        data = response.json()
-
-    anime_context_only = []
-    for item in data.get("animethemes", []):
-        anime = item.get("anime", {})
-        anime_name = anime.get("name")
-
-        song = item.get("song", {})
-        song_title = song.get("title")
-        artists = [a.get("name") for a in song.get("artists", [])]
-
-        anime_context_only.append({
-            "anime": anime_name,
-            "song_title": song_title,
-            "artists": artists,
-            "theme_type": item.get("type")
-        })
-    return anime_context_only
+    client = client or get_http_clients().animethemes
+    response = await client.get(url)
+    response.raise_for_status()
+    data = response.json()
+
+    return [song for item in data.get("animethemes", []) for song in _songs_from_theme(item)]
+
+def _songs_from_theme(item: dict) -> list[dict]:
+    anime = item.get("anime") or {}
+    song = item.get("song") or {}
+    return [{
+        "anime": anime.get("name"),
+        "song_title": song.get("title"),
+        "artists": [a.get("name") for a in song.get("artists", [])],
+        "theme_type": item.get("type")
+    }]
 
-async def fetch_anisong_name(name: str, limit: int = 25):   
+async def fetch_anisong_name(name: str, limit: int = 25, client: Optional[httpx.AsyncClient] = None):
+    local = await _from_catalog(local_anisong_name, name, limit)
+    if local:
+        return local
+
+    return await _cached(
+        make_key("name", name, limit),
+        lambda: _load_anisong_name(name, limit, client)
+    )
+
+async def _load_anisong_name(name: str, limit: int, client: Optional[httpx.AsyncClient]):
     url = (
         f"{BASE_URL}/anime?"
         f"filter[name]={name}"
@@ -52,26 +107,36 @@ async def fetch_anisong_name(name: str, limit: int = 25):
         f"&limit={limit}"
     )
     
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url)
-        response.raise_for_status()
-        data = response.json()
-        
-    anime_names = []
-    for anime in data.get("anime", []):
-        anime_name = anime.get("name")
-        for theme in anime.get("animethemes", []):
-            song = theme.get("song", {})
-            anime_names.append({
-                "anime": anime_name,
-                "song_title": song.get("title"),
-                "artists": [a.get("name") for a in song.get("artists", [])],
-                "theme_type": theme.get("type")
-            })
-    
-    return anime_names     
+    client = client or get_http_clients().animethemes
+    response = await client.get(url)
+    response.raise_for_status()
+    data = response.json()
 
-async def fetch_anisong_artist(artist: str, limit: int = 25):
+    return [song for anime in data.get("anime", []) for song in _songs_from_anime(anime)]
+
+def _songs_from_anime(anime: dict) -> list[dict]:
+    anime_songs = []
+    for theme in anime.get("animethemes", []):
+        song = theme.get("song") or {}
+        anime_songs.append({
+            "anime": anime.get("name"),
+            "song_title": song.get("title") or "",
+            "artists": [a.get("name") for a in song.get("artists", [])],
+            "theme_type": theme.get("type")
+        })
+    return anime_songs
+
+async def fetch_anisong_artist(artist: str, limit: int = 25, client: Optional[httpx.AsyncClient] = None):
+    local = await _from_catalog(local_anisong_artist, artist, limit)
+    if local:
+        return local
+
+    return await _cached(
+        make_key("artist", artist, limit),
+        lambda: _load_anisong_artist(artist, limit, client)
+    )
+
+async def _load_anisong_artist(artist: str, limit: int, client: Optional[httpx.AsyncClient]):
     url = (
     f"{BASE_URL}/artist?"
     f"filter[name]={artist}"
@@ -79,43 +144,30 @@ async def fetch_anisong_artist(artist: str, limit: int = 25):
     f"&limit={limit}"
     )
   
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url)
-        response.raise_for_status()
-        data = response.json()
-
-    songs = []
+    client = client or get_http_clients().animethemes
+    response = await client.get(url)
+    response.raise_for_status()
+    data = response.json()
 
-    for art in data.get("artists", []):
-        for song in art.get("songs", []):
-            title = song.get("title")
-            artist_name = art.get("name")
-
-            for theme in song.get("animethemes", []):
-                anime = theme.get("anime") or {}
-                anime_name = anime.get("name")
-                year = anime.get("year")
-                season = anime.get("season")
-
-                songs.append({
-                    "anime": anime_name,
-                    "song_title": title,
-                    "artists": [artist_name],
-                    "theme_type": theme.get("type"),
-                    "year": year,
-                    "season": season
-                })
+    return [song for art in data.get("artists", []) for song in _songs_from_artist(art)]
 
+def _songs_from_artist(art: dict) -> list[dict]:
+    songs = []
+    for song in art.get("songs", []):
+        for theme in song.get("animethemes", []):
+            anime = theme.get("anime") or {}
+            songs.append({
+                "anime": anime.get("name"),
+                "song_title": song.get("title"),
+                "artists": [art.get("name")],
+                "theme_type": theme.get("type"),
+                "year": anime.get("year"),
+                "season": anime.get("season")
+            })
     return songs
 
 
-async def fetch_anisong_criteria(
-    year: Optional[int] = None,
-    season: Optional[str] = None,
-    limit: int = 25
-):
-    base_url = f"{BASE_URL}/anime"
-    
+def _criteria_params(year: Optional[int], season: Optional[str], limit: int) -> dict:
     params = {
         "include": "animethemes.song.artists",
         "page[size]": limit
@@ -125,24 +177,144 @@ async def fetch_anisong_criteria(
         params["filter[year]"] = year
     if season == "winter" or season == "spring" or season == "summer" or season == "fall":
         params["filter[season]"] = season
-           
-    async with httpx.AsyncClient() as client:
-        response = await client.get(base_url, params=params)
+    return params
+
+async def fetch_anisong_criteria(
+    year: Optional[int] = None,
+    season: Optional[str] = None,
+    limit: int = 25,
+    client: Optional[httpx.AsyncClient] = None
+):
+    base_url = f"{BASE_URL}/anime"
+    params = _criteria_params(year, season, limit)
+
+    local = await _from_catalog(local_anisong_criteria, params.get("filter[year]"), params.get("filter[season]"), limit)
+    if local:
+        return local
+
+    return await _cached(
+        make_key("criteria", params.get("filter[year]"), params.get("filter[season]"), limit),
+        lambda: _load_anisong_criteria(base_url, params, client)
+    )
+
+async def _load_anisong_criteria(base_url: str, params: dict, client: Optional[httpx.AsyncClient]):
+    client = client or get_http_clients().animethemes
+    response = await client.get(base_url, params=params)
+    response.raise_for_status()
+    data = response.json()
+
+    return [song for anime in data.get("anime", []) for song in _songs_from_anime(anime)]
+
+
+# paginated listings: resource path, response key and how one item turns into songs
+LISTINGS = {
+    "themes": ("animetheme", "animethemes", _songs_from_theme),
+    "artists": ("artist", "artists", _songs_from_artist),
+    "criteria": ("anime", "anime", _songs_from_anime)
+}
+
+_prefetches: set[asyncio.Task] = set()
+
+def listing_url(listing: str, limit: int, **filters) -> str:
+    if listing == "themes":
+        params = {
+            "filter[type]": filters["theme_type"],
+            "sort": "-anime.year",
+            "page[size]": limit,
+            "include": "anime,animethemeentries,song.artists"
+        }
+    elif listing == "artists":
+        params = {
+            "filter[name]": filters["artist"],
+            "include": "songs.animethemes.animethemeentries.videos,songs.animethemes.anime",
+            "page[size]": limit
+        }
+    else:
+        params = _criteria_params(filters.get("year"), filters.get("season"), limit)
+    return str(httpx.URL(f"{BASE_URL}/{LISTINGS[listing][0]}", params=params))
+
+def encode_cursor(listing: str, url: str) -> str:
+    # opaque to clients, it is the upstream next link tagged with the listing it belongs to
+    payload = json.dumps({"l": listing, "u": url}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def decode_cursor(listing: str, cursor: str) -> str:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        url = payload["u"]
+    except (ValueError, TypeError, KeyError):
+        raise ValueError("Malformed cursor")
+    # only links back into the same AnimeThemes listing are followed
+    if payload.get("l") != listing or not isinstance(url, str) or not url.startswith(f"{BASE_URL}/{LISTINGS[listing][0]}?"):
+        raise ValueError("Cursor does not belong to this listing")
+    return url
+
+async def _load_page(url: str, client: Optional[httpx.AsyncClient]) -> dict:
+    async def load():
+        response = await (client or get_http_clients().animethemes).get(url)
         response.raise_for_status()
-        data = response.json()
-        
-    anime_songs = []
-    for anime in data.get("anime", []):
-        anime_name = anime.get("name")
-        for theme in anime.get("animethemes", []):
-            song = theme.get("song") or {}
-            anime_songs.append({
-                "anime": anime_name,
-                "song_title": song.get("title") or "",
-                "artists" : [a.get("name") for a in song.get("artists", [])],
-                "theme_type": theme.get("type")
-            })  
-    return anime_songs 
+        return response.json()
+
+    # keyed by the exact url, page links carry their own page number and filters
+    return await animethemes_cache.get_or_load(("page", url), load)
+
+def _next_link(data: dict) -> Optional[str]:
+    return (data.get("links") or {}).get("next")
+
+def _prefetch(url: str, client: Optional[httpx.AsyncClient]):
+    # warms the cache for the page a client is most likely to ask for next
+    task = asyncio.create_task(_load_page(url, client))
+    _prefetches.add(task)
+    task.add_done_callback(_prefetched)
+
+def _prefetched(task: asyncio.Task):
+    _prefetches.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logging.debug(f"Page prefetch failed: {task.exception()}")
+
+async def fetch_listing_page(listing: str, url: str, client: Optional[httpx.AsyncClient] = None) -> tuple[list[dict], Optional[str]]:
+    _, key, parse = LISTINGS[listing]
+    data = await _load_page(url, client)
+    next_url = _next_link(data)
+    if next_url:
+        _prefetch(next_url, client)
+    return [song for item in data.get(key, []) for song in parse(item)], next_url
+
+async def iter_listing(
+    listing: str,
+    url: Optional[str],
+    client: Optional[httpx.AsyncClient] = None,
+    max_pages: int = 0,
+    max_songs: int = 0,
+    walk: Optional[dict] = None
+) -> AsyncIterator[dict]:
+    # follows links.next to the end or to the first cap, one page in memory plus the one being prefetched.
+    # walk["truncated"] tells the caller whether a cap cut the listing short
+    _, key, parse = LISTINGS[listing]
+    walk = walk if walk is not None else {}
+    walk["truncated"] = False
+    next_page = None
+    pages = songs = 0
+    try:
+        while url:
+            if max_pages and pages >= max_pages:
+                walk["truncated"] = True
+                return
+            data = await (next_page or _load_page(url, client))
+            pages += 1
+            url = _next_link(data)
+            more = url and not (max_pages and pages >= max_pages)
+            next_page = asyncio.ensure_future(_load_page(url, client)) if more else None
+            for item in data.get(key, []):
+                for song in parse(item):
+                    if max_songs and songs >= max_songs:
+                        walk["truncated"] = True
+                        return
+                    songs += 1
+                    yield song
+    finally:
+        if next_page is not None:
+            next_page.cancel()
 
 def get_anisong_by_title_and_artist(session: Session, title: str, artist: str):
     return session.exec(
@@ -171,104 +343,197 @@ def save_anisong(session: Session, title: str, artist: str, anime: str, spotify_
     session.refresh(song)
     return song
 
+def song_row(resolved: dict) -> dict:
+    artists = resolved.get("artists") or []
+    spotify_data = resolved.get("spotify_url")
+    if isinstance(spotify_data, dict):
+        spotify_url = spotify_data.get("spotify_url")
+        popularity = spotify_data.get("popularity", 0)
+    else:
+        spotify_url = spotify_data
+        popularity = 0
+
+    return {
+        "title": resolved.get("song_title") or "",
+        "artist": artists[0] if artists else "Unknown",
+        "anime": resolved.get("anime"),
+        "spotify_url": spotify_url,
+        "spotify_popularity": popularity,
+        "youtube_url": resolved.get("youtube_url")
+    }
+
+def song_result(song: dict, fields: Optional[tuple[str, ...]] = None) -> dict:
+    # the AnisongResult shape: of the whole Spotify match only the link and popularity are sent
+    spotify_data = song.get("spotify_url")
+    if isinstance(spotify_data, dict):
+        spotify = {"spotify_url": spotify_data.get("spotify_url"), "spotify_popularity": spotify_data.get("popularity")}
+    elif "spotify_url" in song:
+        spotify = {"spotify_url": spotify_data, "spotify_popularity": None}
+    else:
+        spotify = {}
+
+    if fields is None:
+        return {**song, **spotify}
+    return {field: spotify[field] if field in spotify else song.get(field) for field in fields}
+
+def upsert_anisongs(session: Session, rows: list[dict]) -> dict:
+    # one INSERT ... ON CONFLICT per chunk instead of a SELECT/INSERT/COMMIT per song.
+    # links already stored are kept when the new lookup came back empty
+    unique = {}
+    for row in rows:
+        unique[(row["title"], row["artist"])] = row
+    rows = list(unique.values())
+
+    ids = {}
+    for start in range(0, len(rows), UPSERT_CHUNK_SIZE):
+        statement = insert(AnisongDB).values(rows[start:start + UPSERT_CHUNK_SIZE])
+        statement = statement.on_conflict_do_update(
+            index_elements=["title", "artist"],
+            set_={
+                "anime": func.coalesce(statement.excluded.anime, AnisongDB.anime),
+                "spotify_url": func.coalesce(statement.excluded.spotify_url, AnisongDB.spotify_url),
+                "spotify_popularity": func.coalesce(statement.excluded.spotify_popularity, AnisongDB.spotify_popularity),
+                "youtube_url": func.coalesce(statement.excluded.youtube_url, AnisongDB.youtube_url)
+            }
+        ).returning(AnisongDB.id, AnisongDB.title, AnisongDB.artist)
+
+        for song_id, title, artist in session.execute(statement):
+            ids[(title, artist)] = song_id
+    # coalesce can rewrite rows the recommendation index already holds
+    mark_anisongs_changed(session, ids.values())
+    return ids
+
+def save_search_results(session: Session, songs: list[dict], user_id: int, score: float = 1.0) -> dict:
+    rows = [song_row(song) for song in songs]
+    if not rows:
+        return {}
+
+    ids = upsert_anisongs(session, rows)
+    session.execute(insert(UserHistory).values([
+        {"user_id": user_id, "song_id": ids[(row["title"], row["artist"])], "score": score}
+        for row in rows
+    ]))
+    # names that were searched become suggestions right away
+    index_names(session, [
+        (kind, row[column])
+        for row in rows
+        for kind, column in (("song", "title"), ("artist", "artist"), ("anime", "anime"))
+    ])
+    recommendation_cache.invalidate(session, user_id)
+    session.commit()
+    return ids
+
 async def save_user_history(session: Session, user_id: int, song_id: int, score: float = 1.0):
     history = UserHistory(user_id=user_id, song_id=song_id, score=score)
     session.add(history)
+    recommendation_cache.invalidate(session, user_id)
     session.commit()
     session.refresh(history)
     return history
 
 
-async def resolve_anisong(raw):
-    title = raw.get("song_title")
-    artists = raw.get("artists", [])
-    anime = raw.get("anime")
-    
-    main_artists = artists[0] if artists else ""
-    
-    youtube = await search_youtube(f"{title} {anime}")
-    spotify = await search_spotify(title, main_artists)
-    
-    return {
-        "anime": anime,
-        "song_title": title,
-        "artists": artists,
-        "youtube_url": youtube,
-        "spotify_url": spotify
-    }
-    
-async def search_and_resolve_anisong(q: list[str], session: Session, user_id: int, limit: int = 15):
+async def resolve_anisong(raw, clients: Optional[UpstreamClients] = None):
+    resolved = await enrich_songs([raw], clients=clients)
+    return resolved[0]
+
+SEASONS = ["winter", "spring", "summer", "fall"]
+
+async def _lookup(stage: str, coro):
+    try:
+        result = await coro
+        logging.info(f"fetch_anisong_{stage} returned {len(result)} items")
+        return result
+    except httpx.HTTPError as e:
+        logging.warning(f"fetch_anisong_{stage} error: {e}")
+        return []
+
+async def fetch_anisong_any(query: str, limit: int = 20, client: Optional[httpx.AsyncClient] = None):
+    stages = [
+        ("list", fetch_anisong_list(query, limit=limit, client=client)),
+        ("name", fetch_anisong_name(query, limit=limit, client=client)),
+        ("artist", fetch_anisong_artist(query, limit=limit, client=client))
+    ]
+    if query.isdigit():
+        stages.append(("criteria", fetch_anisong_criteria(year=int(query), limit=limit, client=client)))
+    elif query.lower() in SEASONS:
+        stages.append(("criteria", fetch_anisong_criteria(season=query.lower(), limit=limit, client=client)))
+
+    # every fallback starts at once, the first non-empty one in priority order wins
+    tasks = [asyncio.create_task(_lookup(stage, coro)) for stage, coro in stages]
+    try:
+        for task in tasks:
+            result = await task
+            if result:
+                return result
+        return []
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def _fetch_match(kind: str, name: str, client: Optional[httpx.AsyncClient]):
+    if kind == "anime":
+        return await fetch_anisong_name(name, limit=20, client=client)
+    if kind == "artist":
+        return await fetch_anisong_artist(name, limit=20, client=client)
+    return await run_db(local_anisong_song, name, 20)
+
+async def search_query(query: str, client: Optional[httpx.AsyncClient] = None):
+    # free text goes through the local name index first, so "shingeki no kyoujin" or
+    # "guilty crwn" is looked up by the name AnimeThemes actually knows
+    keyword = query.isdigit() or query.lower() in SEASONS or query in ["OP", "ED", "INS"]
+    match = None if keyword else await run_db(best_match, query)
+    if match:
+        kind, name = match
+        result = await _lookup(f"index_{kind}", _fetch_match(kind, name, client))
+        if result:
+            return result
+    return await fetch_anisong_any(query, limit=20, client=client)
+
+def _dedupe_key(raw: dict):
+    artists = raw.get("artists") or []
+    return make_key(raw.get("song_title") or "", artists[0] if artists else "", raw.get("anime") or "")
+
+async def search_candidates(q: list[str], clients: UpstreamClients, limit: int = 15) -> list[dict]:
+    with phase("candidates"):
+        results = await asyncio.gather(*[
+            search_query(query, client=clients.animethemes) for query in q
+        ])
+
+    # the same song can come back from several queries, resolve it once
+    unique = {}
+    for result in results:
+        for raw in result:
+            unique.setdefault(_dedupe_key(raw), raw)
+    # songs past the limit are dropped before enrichment, they would only cost upstream calls
+    return list(unique.values())[:limit]
+
+async def search_and_resolve_anisong(q: list[str], user_id: int, limit: int = 15, clients: Optional[UpstreamClients] = None):
     logging.info(f"Query: {q}, Limit: {limit}")
-    songs = []
+    clients = clients or get_http_clients()
     
-    for query in q:    
-        try:
-            result = await fetch_anisong_list(query, limit =20)
-            logging.info(f"fetch_anisong_list returned {len(result)} items")
-        except httpx.HTTPStatusError as e:
-            logging.warning(f"fetch_anisong_list error: {e}")
-            result = []
-            
-        if not result:
-            try:
-                result = await fetch_anisong_name(query, limit =20)
-                logging.info(f"fetch_anisong_name returned {len(result)} items")
-            except httpx.HTTPStatusError as e:
-                logging.warning(f"fetch_anisong_name error: {e}")
-                result = []
-        if not result:
-            try:
-                result = await fetch_anisong_artist(query, limit =20)
-                logging.info(f"fetch_anisong_artist returned {len(result)} items")
-            except httpx.HTTPStatusError as e:
-                logging.warning(f"fetch_anisong_artist error: {e}")
-                result = []
-        if not result:
-            if query.isdigit():
-                year = int(query)
-                season = None
-            elif query.lower() in ["winter", "spring", "summer", "fall"]:
-                season = query.lower()
-                year = None
-            else:
-                year = int(query)
-                season = str(query.lower())
-            try:
-                result = await fetch_anisong_criteria(year=year, season=season, limit=20)
-                logging.info(f"fetch_anisong_criteria returned {len(result)} items")
-            except httpx.HTTPStatusError as e:
-                logging.warning(f"fetch_anisong_criteria error: {e}")
-                result = []
-        if not result:
-            result = []
-        
-    for raw in result:
-        resolved = await resolve_anisong(raw)
-        logging.info(f"Resolved song: {resolved}")
-        songs.append(resolved)
+    candidates = await search_candidates(q, clients, limit)
+    songs = await enrich_songs(candidates, clients=clients)
 
-        title = resolved["song_title"]
-        artist = resolved["artists"][0] if resolved["artists"] else "Unknown"
-        anime = resolved["anime"]
-        spotify_data = resolved["spotify_url"]
-        if isinstance(spotify_data, dict):
-            spotify_url = spotify_data.get("spotify_url")
-            popularity = spotify_data.get("popularity", 0)
-        else:
-            spotify_url = spotify_data
-            popularity = 0
-
-        song = save_anisong(
-            session=session,
-            title=title,
-            artist=artist,
-            anime=anime,
-            spotify_url=spotify_url,
-            popularity=popularity,
-            youtube_url=resolved["youtube_url"]
-        )
+    logging.info(f"Resolved {len(songs)} songs for {q}")
+    # the full dicts are only formatted when debug logging is on
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        for resolved in songs:
+            logging.debug(f"Resolved song: {resolved}")
 
-        await save_user_history(session, user_id, song.id)
+    with phase("save"):
+        await run_db(save_search_results, songs, user_id)
 
     return songs
 
+async def stream_search_and_resolve(q: list[str], user_id: int, limit: int = 15, clients: Optional[UpstreamClients] = None):
+    # same as search_and_resolve_anisong, but every song is yielded as soon as it is enriched
+    logging.info(f"Query: {q}, Limit: {limit}, streamed")
+    clients = clients or get_http_clients()
+
+    candidates = await search_candidates(q, clients, limit)
+    songs = []
+    async for index, resolved in enrich_songs_as_completed(candidates, clients=clients):
+        songs.append(resolved)
+        yield index, resolved
+
+    await run_db(save_search_results, songs, user_id)
@@ -1,4 +1,11 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from passlib.context import CryptContext
+from typing import Optional
+from src.models.user_model import Principal
+import asyncio
+import hashlib
+import multiprocessing
 import os
 import jwt
 import time
@@ -6,7 +13,12 @@ import time
 SECRET_KEY = os.getenv("JWT_SECRET", "devsecret")
 ALGO = "HS256"
 
-pwd = CryptContext(schemes=["bcrypt"], deprecated="auto")
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", str(min(os.cpu_count() or 1, 4))))
+PASSWORD_QUEUE_LIMIT = int(os.getenv("PASSWORD_QUEUE_LIMIT", "32"))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+
+pwd = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 
 def hash_password(password):
     return pwd.hash(password)
@@ -14,6 +26,52 @@ def hash_password(password):
 def verify_password(plain, hashed):
     return pwd.verify(plain, hashed)
 
+class PasswordPoolBusy(Exception):
+    pass
+
+class PasswordPool:
+    def __init__(self, workers: int = PASSWORD_WORKERS, limit: int = PASSWORD_QUEUE_LIMIT):
+        self.workers = workers
+        self.limit = limit
+        self.pending = 0
+        self.rejected = 0
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn, not fork: the parent already runs the event loop and db threads
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    async def run(self, func, *args):
+        # bcrypt is slow on purpose, past the limit a fast 503 beats an ever growing queue
+        if self.pending >= self.limit:
+            self.rejected += 1
+            raise PasswordPoolBusy()
+
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), func, *args)
+        finally:
+            self.pending -= 1
+
+    def shutdown(self):
+        executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+password_pool = PasswordPool()
+
+async def hash_password_async(password):
+    return await password_pool.run(hash_password, password)
+
+async def verify_password_async(plain, hashed):
+    return await password_pool.run(verify_password, plain, hashed)
+
 def create_token(user_id):
     now = int(time.time())
     payload = {
@@ -34,8 +92,55 @@ def create_refresh_token(user_id):
     }
     return jwt.encode(payload, SECRET_KEY, algorithm=ALGO)
 
+# what a forged, expired or malformed token raises on its way through authenticate
+INVALID_TOKEN_ERRORS = (jwt.PyJWTError, KeyError, TypeError, ValueError)
+
 def decode_token(token):
     payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGO])
     if payload.get("type") != "access":
         raise ValueError("Invalid token type")
-    return payload
\ No newline at end of file
+    return payload
+
+class TokenCache:
+    def __init__(self, max_entries: int = TOKEN_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[bytes, Principal] = OrderedDict()
+
+    def get(self, digest: bytes) -> Optional[Principal]:
+        principal = self._entries.get(digest)
+        if principal is None:
+            self.misses += 1
+            return None
+        if principal.expires_at <= time.time():
+            self._entries.pop(digest, None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(digest)
+        self.hits += 1
+        return principal
+
+    def put(self, digest: bytes, principal: Principal):
+        self._entries[digest] = principal
+        self._entries.move_to_end(digest)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+token_cache = TokenCache()
+
+def authenticate(token: str) -> Principal:
+    # keyed by a digest so the cache never holds usable bearer tokens
+    digest = hashlib.sha256(token.encode()).digest()
+    principal = token_cache.get(digest)
+    if principal is not None:
+        return principal
+
+    payload = decode_token(token)
+    principal = Principal(user_id=int(payload["sub"]), expires_at=int(payload["exp"]))
+    token_cache.put(digest, principal)
+    return principal
+
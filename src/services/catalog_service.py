@@ -0,0 +1,432 @@
+from dotenv import load_dotenv
+from typing import Optional
+from sqlalchemy import delete, func, or_
+from sqlalchemy.dialects.sqlite import insert
+from sqlmodel import Session, select
+from src.models.catalog_model import (
+    CatalogAnime,
+    CatalogArtist,
+    CatalogSong,
+    CatalogSongArtist,
+    CatalogSyncState,
+    CatalogTheme
+)
+from src.services.search_index import rebuild_search_index
+from src.utils import sqlite
+from src.utils.cache import normalize_text
+from src.utils.http_client import create_client
+import argparse
+import asyncio
+import httpx
+import json
+import logging
+import os
+
+load_dotenv()
+
+BASE_URL = "https://api.animethemes.moe"
+CATALOG_MODE = os.getenv("CATALOG_MODE", "upstream").lower()
+CATALOG_PAGE_SIZE = int(os.getenv("CATALOG_PAGE_SIZE", "100"))
+# AnimeThemes allows about 90 requests a minute
+CATALOG_PAGE_DELAY = float(os.getenv("CATALOG_PAGE_DELAY", "0.7"))
+CATALOG_CHUNK_SIZE = 500
+
+# resource -> (path, envelope key, include)
+RESOURCES = {
+    "anime": ("anime", "anime", None),
+    "animetheme": ("animetheme", "animethemes", "anime,song.artists"),
+    "song": ("song", "songs", "artists"),
+    "artist": ("artist", "artists", None)
+}
+
+
+def local_first_enabled() -> bool:
+    return CATALOG_MODE == "local-first"
+
+
+class CatalogBatch:
+    # rows keyed by upstream id, nested includes are flattened into their own tables
+    def __init__(self):
+        self.anime: dict[int, dict] = {}
+        self.themes: dict[int, dict] = {}
+        self.songs: dict[int, dict] = {}
+        self.artists: dict[int, dict] = {}
+        self.song_artists: dict[int, list[int]] = {}
+
+    def __len__(self):
+        return len(self.anime) + len(self.themes) + len(self.songs) + len(self.artists)
+
+    def add(self, resource: str, item: dict):
+        getattr(self, f"add_{resource}")(item)
+
+    def add_anime(self, item: Optional[dict]):
+        if not item or item.get("id") is None:
+            return
+        name = item.get("name") or ""
+        self.anime[item["id"]] = {
+            "id": item["id"],
+            "name": name,
+            "name_key": normalize_text(name),
+            "slug": item.get("slug"),
+            "year": item.get("year"),
+            "season": item.get("season"),
+            "updated_at": item.get("updated_at")
+        }
+        for theme in item.get("animethemes") or []:
+            self.add_animetheme(theme, anime_id=item["id"])
+
+    def add_animetheme(self, item: Optional[dict], anime_id: Optional[int] = None, song_id: Optional[int] = None):
+        if not item or item.get("id") is None:
+            return
+        anime = item.get("anime")
+        if anime:
+            self.add_anime(anime)
+            anime_id = anime.get("id")
+        song = item.get("song")
+        if song:
+            self.add_song(song)
+            song_id = song.get("id")
+
+        anime_id = anime_id or item.get("anime_id")
+        if anime_id is None:
+            return
+        self.themes[item["id"]] = {
+            "id": item["id"],
+            "anime_id": anime_id,
+            "song_id": song_id or item.get("song_id"),
+            "type": item.get("type"),
+            "sequence": item.get("sequence"),
+            "updated_at": item.get("updated_at")
+        }
+
+    def add_song(self, item: Optional[dict]):
+        if not item or item.get("id") is None:
+            return
+        self.songs[item["id"]] = {
+            "id": item["id"],
+            "title": item.get("title"),
+            "updated_at": item.get("updated_at")
+        }
+        if "artists" in item:
+            artists = [artist for artist in item.get("artists") or [] if artist.get("id") is not None]
+            for artist in artists:
+                self.add_artist(artist)
+            self.song_artists[item["id"]] = list(dict.fromkeys(artist["id"] for artist in artists))
+        for theme in item.get("animethemes") or []:
+            self.add_animetheme(theme, song_id=item["id"])
+
+    def add_artist(self, item: Optional[dict]):
+        if not item or item.get("id") is None:
+            return
+        name = item.get("name") or ""
+        self.artists[item["id"]] = {
+            "id": item["id"],
+            "name": name,
+            "name_key": normalize_text(name),
+            "updated_at": item.get("updated_at")
+        }
+        for song in item.get("songs") or []:
+            self.add_song(song)
+
+
+def _upsert(session: Session, model, rows: list[dict], keep: tuple = ()):
+    # rows older than the stored copy are skipped, so replaying a page or a dump is harmless
+    for start in range(0, len(rows), CATALOG_CHUNK_SIZE):
+        statement = insert(model).values(rows[start:start + CATALOG_CHUNK_SIZE])
+        columns = {
+            name: func.coalesce(statement.excluded[name], getattr(model, name)) if name in keep else statement.excluded[name]
+            for name in rows[0] if name != "id"
+        }
+        session.execute(statement.on_conflict_do_update(
+            index_elements=["id"],
+            set_=columns,
+            where=or_(
+                model.updated_at.is_(None),
+                statement.excluded.updated_at.is_(None),
+                statement.excluded.updated_at >= model.updated_at
+            )
+        ))
+
+
+def write_batch(session: Session, batch: CatalogBatch):
+    _upsert(session, CatalogAnime, list(batch.anime.values()))
+    _upsert(session, CatalogSong, list(batch.songs.values()))
+    _upsert(session, CatalogArtist, list(batch.artists.values()))
+    # a theme seen without its song keeps the song it already had
+    _upsert(session, CatalogTheme, list(batch.themes.values()), keep=("song_id",))
+
+    if batch.song_artists:
+        session.execute(delete(CatalogSongArtist).where(CatalogSongArtist.song_id.in_(list(batch.song_artists))))
+        links = [
+            {"song_id": song_id, "artist_id": artist_id, "position": position}
+            for song_id, artist_ids in batch.song_artists.items()
+            for position, artist_id in enumerate(artist_ids)
+        ]
+        if links:
+            session.execute(insert(CatalogSongArtist).values(links))
+
+
+def load_sync_state(session: Session, resource: str) -> dict:
+    state = session.get(CatalogSyncState, resource) or CatalogSyncState(resource=resource)
+    return state.model_dump()
+
+
+def write_page(session: Session, batch: CatalogBatch, state: dict):
+    # the page and the cursor pointing past it commit together, an interrupted ingest resumes here
+    write_batch(session, batch)
+    session.merge(CatalogSyncState(**state))
+    session.commit()
+
+
+def first_page_url(resource: str, page_size: int = CATALOG_PAGE_SIZE) -> str:
+    path, _, include = RESOURCES[resource]
+    # newest changes first, an incremental run stops once it reaches rows it already has
+    url = f"{BASE_URL}/{path}?sort=-updated_at&page[size]={page_size}"
+    if include:
+        url += f"&include={include}"
+    return url
+
+
+async def _get_page(client: httpx.AsyncClient, url: str) -> dict:
+    while True:
+        response = await client.get(url)
+        if response.status_code == 429:
+            await asyncio.sleep(float(response.headers.get("Retry-After", "60")))
+            continue
+        response.raise_for_status()
+        return response.json()
+
+
+async def ingest_resource(
+    resource: str,
+    client: httpx.AsyncClient,
+    full: bool = False,
+    page_size: int = CATALOG_PAGE_SIZE,
+    delay: float = CATALOG_PAGE_DELAY,
+    max_pages: Optional[int] = None
+) -> dict:
+    _, key, _ = RESOURCES[resource]
+    state = await sqlite.run_db(load_sync_state, resource)
+    if full:
+        state = CatalogSyncState(resource=resource).model_dump()
+
+    url = state["next_url"] or first_page_url(resource, page_size)
+    pages = 0
+    rows = 0
+
+    while url:
+        if pages and delay:
+            await asyncio.sleep(delay)
+
+        data = await _get_page(client, url)
+        items = data.get(key) or []
+        batch = CatalogBatch()
+        for item in items:
+            batch.add(resource, item)
+
+        stamps = [item["updated_at"] for item in items if item.get("updated_at")]
+        synced_until = state["synced_until"]
+        reached = synced_until is not None and any(stamp <= synced_until for stamp in stamps)
+        url = None if reached else (data.get("links") or {}).get("next")
+
+        state["run_max"] = max([stamp for stamp in (state["run_max"], *stamps) if stamp], default=None)
+        state["next_url"] = url
+        state["pages"] += 1
+        if url is None:
+            state["synced_until"] = state["run_max"] or synced_until
+            state["run_max"] = None
+
+        await sqlite.run_db(write_page, batch, dict(state))
+        pages += 1
+        rows += len(batch)
+        if max_pages and pages >= max_pages:
+            break
+
+    return {"resource": resource, "pages": pages, "rows": rows, "complete": url is None}
+
+
+async def ingest_catalog(
+    client: httpx.AsyncClient,
+    resources: Optional[list[str]] = None,
+    **kwargs
+) -> list[dict]:
+    summaries = []
+    for resource in resources or list(RESOURCES):
+        summary = await ingest_resource(resource, client, **kwargs)
+        logging.info(f"catalog ingest {summary}")
+        summaries.append(summary)
+    return summaries
+
+
+def load_dump(session: Session, path: str) -> dict:
+    # a JSON object keyed like the API envelopes: {"anime": [...], "animethemes": [...], "songs": [...], "artists": [...]}
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+
+    batch = CatalogBatch()
+    for resource, (_, key, _) in RESOURCES.items():
+        for item in data.get(key) or []:
+            batch.add(resource, item)
+
+    write_batch(session, batch)
+    session.commit()
+    return {
+        "anime": len(batch.anime),
+        "animethemes": len(batch.themes),
+        "songs": len(batch.songs),
+        "artists": len(batch.artists)
+    }
+
+
+def _theme_rows():
+    return select(CatalogTheme, CatalogAnime, CatalogSong).join(
+        CatalogAnime, CatalogAnime.id == CatalogTheme.anime_id
+    ).outerjoin(
+        CatalogSong, CatalogSong.id == CatalogTheme.song_id
+    )
+
+
+def _artist_names(session: Session, song_ids: set) -> dict[int, list[str]]:
+    names: dict[int, list[str]] = {}
+    if not song_ids:
+        return names
+
+    rows = session.exec(
+        select(CatalogSongArtist.song_id, CatalogArtist.name).join(
+            CatalogArtist, CatalogArtist.id == CatalogSongArtist.artist_id
+        ).where(
+            CatalogSongArtist.song_id.in_(song_ids)
+        ).order_by(CatalogSongArtist.song_id, CatalogSongArtist.position)
+    ).all()
+    for song_id, name in rows:
+        names.setdefault(song_id, []).append(name)
+    return names
+
+
+def _to_songs(session: Session, rows, default_title=None) -> list[dict]:
+    names = _artist_names(session, {song.id for _, _, song in rows if song})
+    return [
+        {
+            "anime": anime.name,
+            "song_title": (song.title if song else None) or default_title,
+            "artists": names.get(song.id, []) if song else [],
+            "theme_type": theme.type
+        }
+        for theme, anime, song in rows
+    ]
+
+
+def local_anisong_list(session: Session, theme_type: str, limit: int) -> list[dict]:
+    rows = session.exec(
+        _theme_rows().where(
+            CatalogTheme.type == theme_type
+        ).order_by(CatalogAnime.year.desc(), CatalogTheme.id).limit(limit)
+    ).all()
+    return _to_songs(session, rows)
+
+
+def local_anisong_name(session: Session, name: str, limit: int) -> list[dict]:
+    anime_ids = select(CatalogAnime.id).where(
+        CatalogAnime.name_key == normalize_text(name)
+    ).order_by(CatalogAnime.id).limit(limit)
+    rows = session.exec(
+        _theme_rows().where(
+            CatalogTheme.anime_id.in_(anime_ids)
+        ).order_by(CatalogAnime.id, CatalogTheme.sequence, CatalogTheme.id)
+    ).all()
+    return _to_songs(session, rows)
+
+
+def local_anisong_song(session: Session, title: str, limit: int) -> list[dict]:
+    song_ids = select(CatalogSong.id).where(CatalogSong.title == title).order_by(CatalogSong.id).limit(limit)
+    rows = session.exec(
+        _theme_rows().where(
+            CatalogTheme.song_id.in_(song_ids)
+        ).order_by(CatalogTheme.id)
+    ).all()
+    return _to_songs(session, rows)
+
+
+def local_anisong_criteria(session: Session, year: Optional[int], season: Optional[str], limit: int) -> list[dict]:
+    anime_ids = select(CatalogAnime.id)
+    if year:
+        anime_ids = anime_ids.where(CatalogAnime.year == year)
+    if season:
+        anime_ids = anime_ids.where(func.lower(CatalogAnime.season) == season)
+    anime_ids = anime_ids.order_by(CatalogAnime.id).limit(limit)
+
+    rows = session.exec(
+        _theme_rows().where(
+            CatalogTheme.anime_id.in_(anime_ids)
+        ).order_by(CatalogAnime.id, CatalogTheme.sequence, CatalogTheme.id)
+    ).all()
+    return _to_songs(session, rows, default_title="")
+
+
+def local_anisong_artist(session: Session, artist: str, limit: int) -> list[dict]:
+    artist_ids = select(CatalogArtist.id).where(
+        CatalogArtist.name_key == normalize_text(artist)
+    ).order_by(CatalogArtist.id).limit(limit)
+    rows = session.exec(
+        select(CatalogArtist, CatalogSong, CatalogTheme, CatalogAnime).join(
+            CatalogSongArtist, CatalogSongArtist.artist_id == CatalogArtist.id
+        ).join(
+            CatalogSong, CatalogSong.id == CatalogSongArtist.song_id
+        ).join(
+            CatalogTheme, CatalogTheme.song_id == CatalogSong.id
+        ).join(
+            CatalogAnime, CatalogAnime.id == CatalogTheme.anime_id
+        ).where(
+            CatalogArtist.id.in_(artist_ids)
+        ).order_by(CatalogArtist.id, CatalogSong.id, CatalogTheme.id)
+    ).all()
+
+    return [
+        {
+            "anime": anime.name,
+            "song_title": song.title,
+            "artists": [art.name],
+            "theme_type": theme.type,
+            "year": anime.year,
+            "season": anime.season
+        }
+        for art, song, theme, anime in rows
+    ]
+
+
+async def _ingest_command(args):
+    client = create_client("animethemes")
+    try:
+        return await ingest_catalog(
+            client,
+            resources=args.resource,
+            full=args.full,
+            max_pages=args.max_pages
+        )
+    finally:
+        await client.aclose()
+        sqlite.shutdown_db_executor()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mirror the AnimeThemes catalog into the local database")
+    parser.add_argument("--resource", nargs="*", choices=list(RESOURCES), help="resources to sync, all by default")
+    parser.add_argument("--full", action="store_true", help="ignore the last sync point and page through everything")
+    parser.add_argument("--max-pages", type=int, default=None, help="stop after this many pages, the next run resumes")
+    parser.add_argument("--dump", help="load a JSON dump instead of calling the API")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    sqlite.create_db_and_tables()
+    if args.dump:
+        with Session(sqlite.engine) as session:
+            print(json.dumps(load_dump(session, args.dump)))
+    else:
+        print(json.dumps(asyncio.run(_ingest_command(args))))
+
+    with Session(sqlite.engine) as session:
+        logging.info(f"search index rebuilt with {rebuild_search_index(session)} names")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+from collections import OrderedDict
+from dotenv import load_dotenv
+from typing import Optional
+from sqlalchemy import delete, func, tuple_, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlmodel import Session, select
+from src.models.anisong_model import AnisongDB
+from src.models.cache_model import EnrichmentCacheEntry
+from src.utils.sqlite import engine as default_engine
+import json
+import os
+import threading
+import time
+import unicodedata
+
+load_dotenv()
+
+ENRICHMENT_CACHE_ENABLED = os.getenv("ENRICHMENT_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+CACHE_TTL = {
+    "youtube": float(os.getenv("YOUTUBE_CACHE_TTL", "2592000")),
+    "spotify": float(os.getenv("SPOTIFY_CACHE_TTL", "604800"))
+}
+NEGATIVE_CACHE_TTL = float(os.getenv("NEGATIVE_CACHE_TTL", "86400"))
+CACHE_MAX_ENTRIES = int(os.getenv("ENRICHMENT_CACHE_MAX_ENTRIES", "50000"))
+# entries also kept in process, so a warm lookup needs no session and no db thread
+MEMORY_MAX_ENTRIES = int(os.getenv("ENRICHMENT_MEMORY_MAX_ENTRIES", "10000"))
+
+# only rewrite accessed_at once in a while so a cache hit stays a read
+TOUCH_INTERVAL = 3600
+EVICT_EVERY = 100
+
+
+def normalize(text: Optional[str]) -> str:
+    text = unicodedata.normalize("NFKC", text or "")
+    return " ".join(text.casefold().split())
+
+
+def make_cache_key(title: Optional[str], artist: Optional[str] = None, anime: Optional[str] = None) -> str:
+    return "|".join(normalize(part) for part in (title, artist, anime))
+
+
+class EnrichmentCache:
+    def __init__(
+        self,
+        engine=None,
+        ttl: Optional[dict] = None,
+        negative_ttl: float = NEGATIVE_CACHE_TTL,
+        max_entries: int = CACHE_MAX_ENTRIES,
+        enabled: bool = ENRICHMENT_CACHE_ENABLED,
+        memory_entries: int = MEMORY_MAX_ENTRIES
+    ):
+        self.engine = engine or default_engine
+        self.ttl = CACHE_TTL | (ttl or {})
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self.stats = {
+            provider: {"hits": 0, "misses": 0, "catalog_hits": 0, "evictions": 0}
+            for provider in self.ttl
+        }
+        self._writes = 0
+        self.memory_entries = memory_entries
+        # (provider, key) -> (expires_at, value), read from the event loop and the db threads
+        self._memory: OrderedDict[tuple[str, str], tuple[float, object]] = OrderedDict()
+        self._memory_lock = threading.Lock()
+
+    def _ttl(self, provider: str, value) -> float:
+        return self.ttl[provider] if value is not None else self.negative_ttl
+
+    def _remember(self, provider: str, key: str, value, expires_at: float):
+        with self._memory_lock:
+            self._memory[(provider, key)] = (expires_at, value)
+            self._memory.move_to_end((provider, key))
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    def _recall(self, provider: str, key: str):
+        with self._memory_lock:
+            entry = self._memory.get((provider, key))
+            if entry is None:
+                return False, None
+            if entry[0] <= time.time():
+                del self._memory[(provider, key)]
+                return False, None
+            self._memory.move_to_end((provider, key))
+            return True, entry[1]
+
+    def in_memory(self, provider: str, key: str) -> bool:
+        return self.enabled and self._recall(provider, key)[0]
+
+    def peek(self, provider: str, key: str):
+        # the in-process part only, a miss here still has to ask get
+        if not self.enabled:
+            return False, None
+        hit, value = self._recall(provider, key)
+        if hit:
+            self.stats[provider]["hits"] += 1
+        return hit, value
+
+    def get(self, provider: str, key: str, title: Optional[str] = None, artist: Optional[str] = None):
+        if not self.enabled:
+            return False, None
+
+        now = time.time()
+        stats = self.stats[provider]
+
+        with Session(self.engine) as session:
+            entry = session.exec(
+                select(EnrichmentCacheEntry).where(
+                    EnrichmentCacheEntry.provider == provider,
+                    EnrichmentCacheEntry.cache_key == key
+                )
+            ).first()
+
+            if entry:
+                value = json.loads(entry.value) if entry.value else None
+                ttl = self._ttl(provider, value)
+                if now - entry.created_at < ttl:
+                    if now - entry.accessed_at > TOUCH_INTERVAL:
+                        entry.accessed_at = now
+                        session.add(entry)
+                        session.commit()
+                    stats["hits"] += 1
+                    self._remember(provider, key, value, entry.created_at + ttl)
+                    return True, value
+
+            value = None
+            if title and artist:
+                value = self._from_catalog(session, provider, title, artist)
+
+        if value is not None:
+            # written after the read session is closed so the two never hold locks at once
+            stats["hits"] += 1
+            stats["catalog_hits"] += 1
+            self.set(provider, key, value)
+            return True, value
+
+        stats["misses"] += 1
+        return False, None
+
+    def get_many(self, provider: str, lookups: list[tuple[str, Optional[str], Optional[str]]]) -> dict:
+        # (key, title, artist) lookups for a whole result set in one session: one query for the
+        # cache entries, one for the AnisongDB fallback. Answers key -> (hit, value) like get
+        if not self.enabled:
+            return {key: (False, None) for key, _, _ in lookups}
+
+        now = time.time()
+        stats = self.stats[provider]
+        lookups = list({key: (key, title, artist) for key, title, artist in lookups}.values())
+        found = {}
+
+        with Session(self.engine) as session:
+            entries = session.exec(
+                select(EnrichmentCacheEntry).where(
+                    EnrichmentCacheEntry.provider == provider,
+                    EnrichmentCacheEntry.cache_key.in_([key for key, _, _ in lookups])
+                )
+            ).all()
+
+            touched = []
+            for entry in entries:
+                value = json.loads(entry.value) if entry.value else None
+                ttl = self._ttl(provider, value)
+                if now - entry.created_at < ttl:
+                    found[entry.cache_key] = value
+                    self._remember(provider, entry.cache_key, value, entry.created_at + ttl)
+                    if now - entry.accessed_at > TOUCH_INTERVAL:
+                        touched.append(entry.id)
+            if touched:
+                session.execute(
+                    update(EnrichmentCacheEntry).where(EnrichmentCacheEntry.id.in_(touched)).values(accessed_at=now)
+                )
+                session.commit()
+
+            pairs = {(title, artist): key for key, title, artist in lookups if key not in found and title and artist}
+            catalog = self._from_catalog_many(session, provider, pairs) if pairs else {}
+
+        # hits and misses are counted when the lookups read these entries through peek and get
+        stats["catalog_hits"] += len(catalog)
+        if catalog:
+            self.set_many(provider, catalog)
+        found.update(catalog)
+        return {key: (key in found, found.get(key)) for key, _, _ in lookups}
+
+    def set(self, provider: str, key: str, value):
+        self.set_many(provider, {key: value})
+
+    def set_many(self, provider: str, values: dict):
+        if not self.enabled or not values:
+            return
+
+        now = time.time()
+        rows = [
+            {
+                "provider": provider,
+                "cache_key": key,
+                "value": json.dumps(value) if value is not None else None,
+                "created_at": now,
+                "accessed_at": now
+            }
+            for key, value in values.items()
+        ]
+        statement = insert(EnrichmentCacheEntry).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=["provider", "cache_key"],
+            set_={
+                "value": statement.excluded.value,
+                "created_at": statement.excluded.created_at,
+                "accessed_at": statement.excluded.accessed_at
+            }
+        )
+
+        with Session(self.engine) as session:
+            session.execute(statement)
+            session.commit()
+
+        for key, value in values.items():
+            self._remember(provider, key, value, now + self._ttl(provider, value))
+
+        # evict once each time the write count passes a multiple of EVICT_EVERY
+        previous, self._writes = self._writes, self._writes + len(values)
+        if self._writes // EVICT_EVERY != previous // EVICT_EVERY:
+            self.evict(provider)
+
+    def evict(self, provider: str):
+        with Session(self.engine) as session:
+            count = session.exec(
+                select(func.count()).select_from(EnrichmentCacheEntry).where(
+                    EnrichmentCacheEntry.provider == provider
+                )
+            ).one()
+            overflow = count - self.max_entries
+            if overflow <= 0:
+                return 0
+
+            oldest = select(EnrichmentCacheEntry.id).where(
+                EnrichmentCacheEntry.provider == provider
+            ).order_by(EnrichmentCacheEntry.accessed_at).limit(overflow)
+            session.execute(delete(EnrichmentCacheEntry).where(EnrichmentCacheEntry.id.in_(oldest)))
+            session.commit()
+
+        self.stats[provider]["evictions"] += overflow
+        return overflow
+
+    def _from_catalog(self, session: Session, provider: str, title: str, artist: str):
+        # AnisongDB already holds the links for songs someone searched before
+        song = session.exec(
+            select(AnisongDB).where(
+                AnisongDB.title == title,
+                AnisongDB.artist == artist
+            )
+        ).first()
+        if not song:
+            return None
+        return self._catalog_value(provider, song)
+
+    def _from_catalog_many(self, session: Session, provider: str, pairs: dict[tuple[str, str], str]) -> dict:
+        songs = session.exec(
+            select(AnisongDB).where(tuple_(AnisongDB.title, AnisongDB.artist).in_(list(pairs)))
+        ).all()
+        found = {}
+        for song in songs:
+            value = self._catalog_value(provider, song)
+            if value is not None:
+                found[pairs[(song.title, song.artist)]] = value
+        return found
+
+    def _catalog_value(self, provider: str, song: AnisongDB):
+        if provider == "youtube" and song.youtube_url:
+            return song.youtube_url
+        if provider == "spotify" and song.spotify_url and song.spotify_url.startswith("http"):
+            return {
+                "spotify_url": song.spotify_url,
+                "name": song.title,
+                "artists": song.artist,
+                "popularity": song.spotify_popularity or 0
+            }
+        return None
+
+
+_cache: Optional[EnrichmentCache] = None
+
+
+def get_enrichment_cache() -> EnrichmentCache:
+    global _cache
+    if _cache is None:
+        _cache = EnrichmentCache()
+    return _cache
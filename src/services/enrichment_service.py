@@ -0,0 +1,214 @@
+from dotenv import load_dotenv
+from typing import AsyncIterable, AsyncIterator, Iterable, Optional, Union
+from src.services.enrichment_cache import get_enrichment_cache, make_cache_key
+from src.services.youtube_services import search_youtube
+from src.services.spotify_services import search_spotify
+from src.utils.http_client import UpstreamClients, get_http_clients
+from src.utils.sqlite import run_in_db
+from src.utils.timing import phase
+import asyncio
+import os
+
+load_dotenv()
+
+YOUTUBE_CONCURRENCY = int(os.getenv("YOUTUBE_CONCURRENCY", "8"))
+SPOTIFY_CONCURRENCY = int(os.getenv("SPOTIFY_CONCURRENCY", "8"))
+
+PROVIDERS = ("spotify", "youtube", "both")
+
+
+def _ok(result):
+    # same isolation as gather(return_exceptions=True): a failed lookup becomes None
+    if isinstance(result, BaseException):
+        return None
+    return result
+
+
+async def _limited(semaphore: asyncio.Semaphore, func, *args, **kwargs):
+    async with semaphore:
+        return await func(*args, **kwargs)
+
+
+async def _skip():
+    return None
+
+
+def _song_parts(song: dict) -> tuple[str, str, str]:
+    artists = song.get("artists") or []
+    return song.get("song_title") or "", artists[0] if artists else "", song.get("anime") or ""
+
+
+async def _warm_cache(songs: list[dict], provider: str):
+    # one db round trip for the whole batch instead of one session per song and provider,
+    # the lookups then find their entries in memory
+    cache = get_enrichment_cache()
+    if not cache.enabled:
+        return
+    lookups = []
+    for song in songs:
+        title, artist, anime = _song_parts(song)
+        if title:
+            lookups.append((make_cache_key(title, artist, anime), title, artist))
+
+    wanted = {
+        name: [lookup for lookup in lookups if not cache.in_memory(name, lookup[0])]
+        for name in ("youtube", "spotify") if provider in (name, "both")
+    }
+    wanted = {name: missing for name, missing in wanted.items() if missing}
+    if not wanted:
+        return
+
+    def load():
+        for name, missing in wanted.items():
+            cache.get_many(name, missing)
+    await run_in_db(load)
+
+
+async def _enrich_song(
+    song: dict,
+    provider: str,
+    clients: UpstreamClients,
+    youtube_limit: asyncio.Semaphore,
+    spotify_limit: asyncio.Semaphore,
+    strict: bool = False
+):
+    title, main_artist, anime = _song_parts(song)
+    artists = song.get("artists") or []
+
+    if provider in ("youtube", "both"):
+        yt_task = _limited(
+            youtube_limit,
+            search_youtube,
+            f"{title} {main_artist} {anime}",
+            client=clients.youtube,
+            title=title,
+            artist=main_artist,
+            anime=anime
+        )
+    else:
+        yt_task = _skip()
+
+    if provider in ("spotify", "both"):
+        sp_task = _limited(spotify_limit, search_spotify, title, main_artist, anime, client=clients.spotify)
+    else:
+        sp_task = _skip()
+
+    yt_url, sp_url = await asyncio.gather(yt_task, sp_task, return_exceptions=True)
+    if strict:
+        for result in (yt_url, sp_url):
+            if isinstance(result, Exception):
+                raise result
+
+    return {
+        "anime": song.get("anime"),
+        "song_title": song.get("song_title"),
+        "theme_type": song.get("theme_type"),
+        "artists": artists,
+        "youtube_url": _ok(yt_url),
+        "spotify_url": _ok(sp_url)
+    }
+
+
+async def enrich_song(
+    song: dict,
+    provider: str = "both",
+    clients: Optional[UpstreamClients] = None,
+    youtube_limit: Optional[asyncio.Semaphore] = None,
+    spotify_limit: Optional[asyncio.Semaphore] = None,
+    strict: bool = False
+):
+    # strict raises a failed lookup instead of leaving its link empty, for callers that retry
+    if provider not in PROVIDERS:
+        raise ValueError(f"Unknown provider: {provider}")
+
+    return await _enrich_song(
+        song,
+        provider,
+        clients or get_http_clients(),
+        youtube_limit or asyncio.Semaphore(YOUTUBE_CONCURRENCY),
+        spotify_limit or asyncio.Semaphore(SPOTIFY_CONCURRENCY),
+        strict
+    )
+
+
+async def enrich_songs(
+    songs: list[dict],
+    provider: str = "both",
+    clients: Optional[UpstreamClients] = None,
+    youtube_concurrency: Optional[int] = None,
+    spotify_concurrency: Optional[int] = None
+):
+    if provider not in PROVIDERS:
+        raise ValueError(f"Unknown provider: {provider}")
+
+    clients = clients or get_http_clients()
+    youtube_limit = asyncio.Semaphore(youtube_concurrency or YOUTUBE_CONCURRENCY)
+    spotify_limit = asyncio.Semaphore(spotify_concurrency or SPOTIFY_CONCURRENCY)
+
+    # gather keeps the input order, the semaphores only bound how many lookups are in flight
+    with phase("enrich"):
+        await _warm_cache(songs, provider)
+        return await asyncio.gather(*[
+            _enrich_song(song, provider, clients, youtube_limit, spotify_limit)
+            for song in songs
+        ])
+
+
+async def _aiter(songs: Union[Iterable[dict], AsyncIterable[dict]]) -> AsyncIterator[dict]:
+    if hasattr(songs, "__aiter__"):
+        async for song in songs:
+            yield song
+    else:
+        for song in songs:
+            yield song
+
+
+async def enrich_songs_as_completed(
+    songs: Union[Iterable[dict], AsyncIterable[dict]],
+    provider: str = "both",
+    clients: Optional[UpstreamClients] = None,
+    youtube_concurrency: Optional[int] = None,
+    spotify_concurrency: Optional[int] = None
+) -> AsyncIterator[tuple[int, dict]]:
+    # yields (input index, enriched song) as each one finishes. only a window of songs is
+    # in flight at once and an async source is pulled lazily, so memory stays flat however
+    # long the input is
+    if provider not in PROVIDERS:
+        raise ValueError(f"Unknown provider: {provider}")
+
+    clients = clients or get_http_clients()
+    youtube_concurrency = youtube_concurrency or YOUTUBE_CONCURRENCY
+    spotify_concurrency = spotify_concurrency or SPOTIFY_CONCURRENCY
+    youtube_limit = asyncio.Semaphore(youtube_concurrency)
+    spotify_limit = asyncio.Semaphore(spotify_concurrency)
+    window = 2 * max(youtube_concurrency, spotify_concurrency)
+
+    async def enrich(index: int, song: dict):
+        return index, await _enrich_song(song, provider, clients, youtube_limit, spotify_limit)
+
+    pending = set()
+    index = -1
+    try:
+        if not hasattr(songs, "__aiter__"):
+            # an async source is pulled lazily, only a list known up front is warmed in one go
+            songs = list(songs)
+            await _warm_cache(songs, provider)
+        async for song in _aiter(songs):
+            index += 1
+            pending.add(asyncio.create_task(enrich(index, song)))
+            if len(pending) < window:
+                continue
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        # the client went away, nothing left is worth looking up
+        for task in pending:
+            task.cancel()
+        if hasattr(songs, "aclose"):
+            await songs.aclose()
@@ -0,0 +1,262 @@
+from dataclasses import dataclass, field
+from dotenv import load_dotenv
+from typing import AsyncIterator, Awaitable, Callable, Optional
+from sqlalchemy.exc import SQLAlchemyError
+from sqlmodel import Session
+from src.services.anisong_services import song_row, upsert_anisongs
+from src.services.enrichment_service import PROVIDERS, SPOTIFY_CONCURRENCY, YOUTUBE_CONCURRENCY, enrich_song
+from src.utils import sqlite
+from src.utils.http_client import UpstreamClients, get_http_clients
+import asyncio
+import httpx
+import itertools
+import logging
+import os
+import time
+import uuid
+
+load_dotenv()
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "8"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "1000"))
+JOB_MAX_RETRIES = int(os.getenv("JOB_MAX_RETRIES", "2"))
+JOB_RETRY_DELAY = float(os.getenv("JOB_RETRY_DELAY", "1"))
+# finished jobs stay readable this many seconds
+JOB_TTL = float(os.getenv("JOB_TTL", "600"))
+JOB_FLUSH_SIZE = int(os.getenv("JOB_FLUSH_SIZE", "50"))
+JOB_FLUSH_INTERVAL = float(os.getenv("JOB_FLUSH_INTERVAL", "1"))
+
+# lower runs first, a user waiting on a search goes ahead of a listing being warmed up
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+@dataclass(eq=False)
+class Job:
+    id: str
+    songs: list[dict]
+    provider: str
+    clients: UpstreamClients
+    user_id: Optional[int] = None
+    on_done: Optional[Callable[["Job"], Awaitable]] = None
+    status: str = "queued"
+    results: list[Optional[dict]] = field(default_factory=list)
+    # song indexes in the order they finished
+    completed: list[int] = field(default_factory=list)
+    failed: int = 0
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    _changed: asyncio.Event = field(default_factory=asyncio.Event, repr=False)
+
+    def __post_init__(self):
+        self.results = [None] * len(self.songs)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def _record(self, index: int, result: Optional[dict]):
+        self.results[index] = result
+        self.completed.append(index)
+        self.failed += result is None
+        self._notify()
+
+    async def follow(self) -> AsyncIterator[tuple[int, dict]]:
+        # everything finished so far, then each song as it finishes until the job is done
+        sent = 0
+        while True:
+            changed = self._changed
+            while sent < len(self.completed):
+                index = self.completed[sent]
+                sent += 1
+                yield index, self.results[index]
+            if self.finished:
+                return
+            await changed.wait()
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "total": len(self.songs),
+            "completed": len(self.completed),
+            "failed": self.failed,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at
+        }
+
+
+def _write_rows(session: Session, rows: list[dict]):
+    upsert_anisongs(session, rows)
+    session.commit()
+
+
+class JobQueue:
+    def __init__(
+        self,
+        workers: int = JOB_WORKERS,
+        size: int = JOB_QUEUE_SIZE,
+        max_retries: int = JOB_MAX_RETRIES,
+        retry_delay: float = JOB_RETRY_DELAY,
+        ttl: float = JOB_TTL,
+        flush_size: int = JOB_FLUSH_SIZE,
+        flush_interval: float = JOB_FLUSH_INTERVAL
+    ):
+        self.workers = workers
+        self.size = size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.ttl = ttl
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.jobs: dict[str, Job] = {}
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._tasks: list[asyncio.Task] = []
+        self._retries: set[asyncio.Task] = set()
+        self._rows: list[dict] = []
+        # ties within a priority are served first come first served
+        self._sequence = itertools.count()
+
+    def start(self):
+        if self._tasks:
+            return
+        self._queue = asyncio.PriorityQueue(self.size)
+        self._youtube_limit = asyncio.Semaphore(YOUTUBE_CONCURRENCY)
+        self._spotify_limit = asyncio.Semaphore(SPOTIFY_CONCURRENCY)
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._flush_loop()))
+
+    async def stop(self):
+        tasks = self._tasks + list(self._retries)
+        self._tasks, self._retries = [], set()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.flush()
+        self._queue = None
+
+    def submit(
+        self,
+        songs: list[dict],
+        provider: str = "both",
+        clients: Optional[UpstreamClients] = None,
+        priority: str = "normal",
+        user_id: Optional[int] = None,
+        on_done: Optional[Callable[[Job], Awaitable]] = None
+    ) -> Job:
+        if provider not in PROVIDERS:
+            raise ValueError(f"Unknown provider: {provider}")
+        self.start()
+        self._prune()
+        # a job is queued whole or not at all
+        if self._queue.maxsize - self._queue.qsize() < len(songs):
+            raise JobQueueFull(f"Enrichment queue is full ({self._queue.qsize()}/{self._queue.maxsize})")
+
+        job = Job(uuid.uuid4().hex, list(songs), provider, clients or get_http_clients(), user_id, on_done)
+        self.jobs[job.id] = job
+        if not job.songs:
+            job.status = "done"
+            job.finished_at = time.time()
+        for index in range(len(job.songs)):
+            self._queue.put_nowait((PRIORITIES[priority], next(self._sequence), job, index, 0))
+        return job
+
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def get(self, job_id: str) -> Optional[Job]:
+        self._prune()
+        return self.jobs.get(job_id)
+
+    def _prune(self):
+        now = time.time()
+        for job_id in [job.id for job in self.jobs.values() if job.finished and now - job.finished_at > self.ttl]:
+            del self.jobs[job_id]
+
+    async def _work(self):
+        while True:
+            item = await self._queue.get()
+            try:
+                await self._run(*item)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, priority: int, _, job: Job, index: int, attempt: int):
+        job.status = "running"
+        # the last attempt keeps whatever lookups succeeded instead of raising
+        strict = attempt < self.max_retries
+        try:
+            result = await enrich_song(
+                job.songs[index], job.provider, job.clients, self._youtube_limit, self._spotify_limit, strict=strict
+            )
+        except httpx.HTTPError as e:
+            if strict:
+                logging.info(f"Job {job.id} song {index} attempt {attempt + 1} failed, retrying: {e}")
+                self._retry_later((priority, next(self._sequence), job, index, attempt + 1), self.retry_delay * 2 ** attempt)
+                return
+            logging.warning(f"Job {job.id} song {index} failed: {e}")
+            result = None
+        except Exception:
+            # anything else is not worth retrying, but must not take the worker down with it
+            logging.exception(f"Job {job.id} song {index} failed")
+            result = None
+
+        job._record(index, result)
+        # searches write their songs together with the history once the job is done
+        if result is not None and job.user_id is None:
+            self._rows.append(song_row(result))
+            if len(self._rows) >= self.flush_size:
+                await self._flush_quietly()
+        if len(job.completed) == len(job.songs):
+            await self._finish(job)
+
+    def _retry_later(self, item: tuple, delay: float):
+        async def retry():
+            await asyncio.sleep(delay)
+            await self._queue.put(item)
+
+        task = asyncio.create_task(retry())
+        self._retries.add(task)
+        task.add_done_callback(self._retries.discard)
+
+    async def _finish(self, job: Job):
+        try:
+            if job.on_done is not None:
+                await job.on_done(job)
+            job.status = "done"
+        except Exception as e:
+            # on_done is the caller's, whatever it raises the job has to end so waiting clients get an answer
+            logging.exception(f"Job {job.id} could not be saved")
+            job.status = "failed"
+            job.error = str(e)
+        job.finished_at = time.time()
+        job._notify()
+
+    async def flush(self):
+        # finished enrichments reach AnisongDB in one upsert per batch
+        rows, self._rows = self._rows, []
+        if rows:
+            await sqlite.run_db(_write_rows, rows)
+
+    async def _flush_quietly(self):
+        try:
+            await self.flush()
+        except SQLAlchemyError:
+            logging.exception("Writing enriched songs failed")
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self._flush_quietly()
+
+
+job_queue = JobQueue()
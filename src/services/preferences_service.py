@@ -1,5 +1,8 @@
+from collections import defaultdict
+from sqlalchemy.dialects.sqlite import insert
 from sqlmodel import Session, select
 from src.models.user_model import UserPreference
+from src.services.recommendation_cache import recommendation_cache
 
 def get_user_preferences(session: Session, user_id: int):
     return session.exec(
@@ -7,34 +10,57 @@ def get_user_preferences(session: Session, user_id: int):
     ).all()
     
 def add_preference(session: Session, user_id: int, tag: str, weight: float):
-    pref = UserPreference(user_id=user_id, tag=tag, weight=weight)
-    session.add(pref)
+    statement = insert(UserPreference).values(user_id=user_id, tag=tag, weight=weight)
+    statement = statement.on_conflict_do_update(
+        index_elements=["user_id", "tag"],
+        set_={"weight": statement.excluded.weight}
+    )
+    session.execute(statement)
+    recommendation_cache.invalidate(session, user_id)
     session.commit()
-    session.refresh(pref)
-    return pref
+    return session.exec(
+        select(UserPreference).where(
+            UserPreference.user_id == user_id,
+            UserPreference.tag == tag
+        ).execution_options(populate_existing=True)
+    ).one()
+
+def aggregate_preference_deltas(songs: list[dict], weight: float = 1.0) -> dict[str, float]:
+    deltas = defaultdict(float)
+    for song in songs:
+        artists = song.get("artists") or []
+        artist = artists[0] if artists else "Unknown"
+        for tag in (artist, song.get("anime")):
+            if tag:
+                deltas[tag] += weight
+    return dict(deltas)
+
+def apply_preference_deltas(session: Session, user_id: int, deltas: dict[str, float], commit: bool = True):
+    if not deltas:
+        return
+
+    # one statement for the whole batch, existing tags get the delta added to their weight
+    statement = insert(UserPreference).values([
+        {"user_id": user_id, "tag": tag, "weight": delta}
+        for tag, delta in deltas.items()
+    ])
+    statement = statement.on_conflict_do_update(
+        index_elements=["user_id", "tag"],
+        set_={"weight": UserPreference.weight + statement.excluded.weight}
+    )
+    session.execute(statement)
+    recommendation_cache.invalidate(session, user_id)
+    if commit:
+        session.commit()
+
+def update_preferences_from_songs(session: Session, user_id: int, songs: list[dict], weight: float = 1.0):
+    deltas = aggregate_preference_deltas(songs, weight)
+    apply_preference_deltas(session, user_id, deltas)
+    return deltas
 
 def update_preference_from_history(session: Session, user_id: int, artist: str, anime: str):
-    tags = [artist, anime]
-    for tag in tags:
-        if not tag:
-            continue
-        
-        pref = session.exec(
-            select(UserPreference).where(
-                UserPreference.user_id == user_id,
-                UserPreference.tag == tag
-            )
-        ).first()
-        
-        if pref:
-            pref.weight += 1
-            
-        else:
-            pref = UserPreference(
-                user_id=user_id,
-                tag=tag,
-                weight=1
-            )
-            session.add(pref)
-            
-    session.commit()
\ No newline at end of file
+    deltas = defaultdict(float)
+    for tag in (artist, anime):
+        if tag:
+            deltas[tag] += 1
+    apply_preference_deltas(session, user_id, deltas)
@@ -0,0 +1,124 @@
+from collections import OrderedDict
+from dotenv import load_dotenv
+from typing import NamedTuple, Optional
+from urllib.parse import parse_qs
+from fastapi.responses import JSONResponse
+from src.services.auth_services import INVALID_TOKEN_ERRORS, authenticate
+from src.services.user_services import is_admin
+from src.utils.sqlite import run_db
+import cProfile
+import io
+import marshal
+import os
+import pstats
+import time
+import uuid
+
+load_dotenv()
+
+# the last N profiles stay downloadable from /profiles/{id}
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "20"))
+
+
+class StoredProfile(NamedTuple):
+    id: str
+    method: str
+    path: str
+    created_at: float
+    elapsed_ms: float
+    profiler: cProfile.Profile
+
+
+class ProfileStore:
+    def __init__(self, keep: int = PROFILE_KEEP):
+        self.keep = keep
+        self._profiles: OrderedDict[str, StoredProfile] = OrderedDict()
+
+    def put(self, profile: StoredProfile):
+        self._profiles[profile.id] = profile
+        while len(self._profiles) > self.keep:
+            self._profiles.popitem(last=False)
+
+    def get(self, profile_id: str) -> Optional[StoredProfile]:
+        return self._profiles.get(profile_id)
+
+    def list(self) -> list[dict]:
+        return [
+            {"id": p.id, "method": p.method, "path": p.path, "created_at": p.created_at, "elapsed_ms": p.elapsed_ms}
+            for p in reversed(self._profiles.values())
+        ]
+
+
+profile_store = ProfileStore()
+
+
+def profile_text(profile: StoredProfile, sort: str = "cumulative", limit: int = 60) -> str:
+    stream = io.StringIO()
+    pstats.Stats(profile.profiler, stream=stream).sort_stats(sort).print_stats(limit)
+    return stream.getvalue()
+
+
+def profile_dump(profile: StoredProfile) -> bytes:
+    # the same bytes Profile.dump_stats writes, loadable with pstats or snakeviz
+    profile.profiler.create_stats()
+    return marshal.dumps(profile.profiler.stats)
+
+
+async def _admin_request(scope) -> bool:
+    headers = dict(scope.get("headers", []))
+    scheme, _, token = headers.get(b"authorization", b"").decode().partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return False
+    try:
+        principal = authenticate(token)
+    except INVALID_TOKEN_ERRORS:
+        return False
+    return await run_db(is_admin, principal.user_id)
+
+
+class ProfileMiddleware:
+    # ?profile=1 from an admin runs the request under cProfile and keeps the result.
+    # cProfile follows the event loop thread only, time on the db threads shows up in Server-Timing
+    def __init__(self, app):
+        self.app = app
+        self.active = False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or parse_qs(scope.get("query_string", b"").decode()).get("profile") != ["1"]:
+            return await self.app(scope, receive, send)
+
+        if not await _admin_request(scope):
+            return await JSONResponse({"detail": "Profiling is admin only"}, status_code=403)(scope, receive, send)
+        # one profiler per thread, everything else on the loop would end up in the same trace anyway
+        if self.active:
+            return await JSONResponse({"detail": "Another request is being profiled"}, status_code=409)(scope, receive, send)
+
+        profile_id = uuid.uuid4().hex
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-profile-id", profile_id.encode())]
+            await send(message)
+
+        profiler = cProfile.Profile()
+        self.active = True
+        started = time.perf_counter()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiling tool (a debugger, coverage) already owns the hook
+            self.active = False
+            return await JSONResponse({"detail": "Profiler unavailable"}, status_code=409)(scope, receive, send)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            profiler.disable()
+            self.active = False
+            profile_store.put(StoredProfile(
+                profile_id,
+                scope["method"],
+                scope["path"],
+                time.time(),
+                round((time.perf_counter() - started) * 1000, 1),
+                profiler
+            ))
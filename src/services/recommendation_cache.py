@@ -0,0 +1,183 @@
+from collections import OrderedDict, defaultdict
+from dotenv import load_dotenv
+from typing import NamedTuple, Optional
+from sqlalchemy import event, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlmodel import Session, select
+from src.models.cache_model import RecommendationCacheEntry
+from src.services.recommendation_service import recommend_for_user
+from src.services.similarity_service import recommend_also_searched
+from src.utils import sqlite
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+
+load_dotenv()
+
+# top N kept per user, requests for fewer are served from the same list
+RECOMMEND_CACHE_SIZE = int(os.getenv("RECOMMEND_CACHE_SIZE", "100"))
+RECOMMEND_CACHE_TTL = float(os.getenv("RECOMMEND_CACHE_TTL", "3600"))
+RECOMMEND_CACHE_MAX_ENTRIES = int(os.getenv("RECOMMEND_CACHE_MAX_ENTRIES", "10000"))
+RECOMMEND_REFRESH_DEBOUNCE = float(os.getenv("RECOMMEND_REFRESH_DEBOUNCE", "2"))
+
+MODES = {
+    "preferences": recommend_for_user,
+    "also_searched": recommend_also_searched
+}
+
+
+class CachedRecommendations(NamedTuple):
+    version: int
+    computed_at: float
+    results: list
+
+
+class RecommendationCache:
+    def __init__(
+        self,
+        size: int = RECOMMEND_CACHE_SIZE,
+        ttl: float = RECOMMEND_CACHE_TTL,
+        max_entries: int = RECOMMEND_CACHE_MAX_ENTRIES,
+        debounce: float = RECOMMEND_REFRESH_DEBOUNCE
+    ):
+        self.size = size
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.debounce = debounce
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self._entries: OrderedDict[tuple, CachedRecommendations] = OrderedDict()
+        # bumped on every committed change to a user's preferences or history
+        self._versions: dict[int, int] = defaultdict(int)
+        self._versions_lock = threading.Lock()
+        self._pending: dict[int, asyncio.Task] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def invalidate(self, session: Session, user_id: int):
+        # the persisted rows go stale in the caller's transaction, the memory entries once it commits
+        session.execute(
+            update(RecommendationCacheEntry).where(
+                RecommendationCacheEntry.user_id == user_id
+            ).values(stale=True)
+        )
+        event.listen(session, "after_commit", lambda _: self._changed(user_id), once=True)
+
+    def _changed(self, user_id: int):
+        with self._versions_lock:
+            self._versions[user_id] += 1
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        try:
+            loop.call_soon_threadsafe(self._schedule, user_id)
+        except RuntimeError:
+            pass
+
+    def _schedule(self, user_id: int):
+        # debounced: a burst of searches within the window ends in a single recompute
+        if user_id not in self._pending:
+            self._pending[user_id] = asyncio.get_running_loop().create_task(self._refresh_later(user_id))
+
+    async def _refresh_later(self, user_id: int):
+        try:
+            await asyncio.sleep(self.debounce)
+        finally:
+            self._pending.pop(user_id, None)
+
+        for key in [key for key in self._entries if key[0] == user_id]:
+            try:
+                await self._compute(key)
+            except Exception as e:
+                logging.warning(f"Recommendation refresh for user {user_id} failed: {e}")
+
+    def _fresh(self, user_id: int, entry: CachedRecommendations) -> bool:
+        return entry.version >= self._versions[user_id] and time.time() - entry.computed_at < self.ttl
+
+    def _remember(self, key: tuple, entry: CachedRecommendations):
+        current = self._entries.get(key)
+        if current is not None and current.version > entry.version:
+            return
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _load(self, session: Session, key: tuple) -> Optional[CachedRecommendations]:
+        user_id, mode, exclude_seen = key
+        row = session.exec(
+            select(RecommendationCacheEntry).where(
+                RecommendationCacheEntry.user_id == user_id,
+                RecommendationCacheEntry.mode == mode,
+                RecommendationCacheEntry.exclude_seen == exclude_seen
+            )
+        ).first()
+        if row is None:
+            return None
+        version = -1 if row.stale else self._versions[user_id]
+        return CachedRecommendations(version, row.computed_at, json.loads(row.results))
+
+    def _recompute(self, session: Session, key: tuple, version: int) -> CachedRecommendations:
+        user_id, mode, exclude_seen = key
+        results = MODES[mode](session, user_id, self.size, exclude_seen)
+        computed_at = time.time()
+        # a change that landed while computing leaves the row stale for the next read
+        stale = self._versions[user_id] != version
+
+        statement = insert(RecommendationCacheEntry).values(
+            user_id=user_id,
+            mode=mode,
+            exclude_seen=exclude_seen,
+            results=json.dumps(results),
+            computed_at=computed_at,
+            stale=stale
+        )
+        session.execute(statement.on_conflict_do_update(
+            index_elements=["user_id", "mode", "exclude_seen"],
+            set_={"results": statement.excluded.results, "computed_at": computed_at, "stale": stale}
+        ))
+        session.commit()
+        return CachedRecommendations(version, computed_at, results)
+
+    async def _compute(self, key: tuple) -> CachedRecommendations:
+        self.refreshes += 1
+        entry = await sqlite.run_db(self._recompute, key, self._versions[key[0]])
+        self._remember(key, entry)
+        return entry
+
+    async def get(self, user_id: int, mode: str = "preferences", limit: int = 10, exclude_seen: bool = True) -> list[dict]:
+        self._loop = asyncio.get_running_loop()
+        if limit > self.size:
+            return await sqlite.run_db(MODES[mode], user_id, limit, exclude_seen)
+
+        key = (user_id, mode, exclude_seen)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = await sqlite.run_db(self._load, key)
+            if entry is not None:
+                self._remember(key, entry)
+
+        if entry is None:
+            self.misses += 1
+            entry = await self._compute(key)
+        elif self._fresh(user_id, entry):
+            self.hits += 1
+            self._entries.move_to_end(key)
+        else:
+            # stale while revalidate: answer with what we have, recompute in the background
+            self.stale_hits += 1
+            self._schedule(user_id)
+        return entry.results[:limit]
+
+    async def stop(self):
+        pending, self._pending = list(self._pending.values()), {}
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+recommendation_cache = RecommendationCache()
@@ -0,0 +1,204 @@
+from dotenv import load_dotenv
+from typing import Iterable, NamedTuple, Optional
+from sqlalchemy import event
+from sqlmodel import Session, func, select
+from src.models.anisong_model import AnisongDB
+from src.models.user_model import UserHistory, UserPreference
+from src.utils.cache import normalize_text
+import numpy as np
+import os
+import threading
+
+load_dotenv()
+
+POPULARITY_WEIGHT = float(os.getenv("RECOMMEND_POPULARITY_WEIGHT", "0.1"))
+REINDEX_CHUNK_SIZE = 500
+# tags that AnisongDB rows are described by, each one is a feature column
+FEATURES = ("artist", "anime")
+
+
+class CatalogArrays(NamedTuple):
+    song_ids: np.ndarray
+    popularity: np.ndarray
+    # one column index per song and feature, -1 is the "no tag" column that always weighs 0
+    columns: dict[str, np.ndarray]
+
+
+class RecommendationIndex:
+    def __init__(self):
+        self.vocabulary: dict[str, int] = {}
+        self.arrays = CatalogArrays(
+            np.zeros(0, dtype=np.int64),
+            np.zeros(0, dtype=np.float32),
+            {feature: np.zeros(0, dtype=np.int32) for feature in FEATURES}
+        )
+        self.max_id = 0
+        self._lock = threading.Lock()
+        # ids of indexed rows an upsert rewrote since the last refresh
+        self._changed: set[int] = set()
+        self._changed_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.arrays.song_ids)
+
+    def _column(self, tag: Optional[str]) -> int:
+        if not tag:
+            return -1
+        return self.vocabulary.setdefault(normalize_text(tag), len(self.vocabulary))
+
+    def extend(self, rows: list[tuple]):
+        # rows of (id, artist, anime, popularity) with ids above everything already indexed
+        if not rows:
+            return
+        ids, artists, animes, popularity = zip(*rows)
+        tags = {"artist": artists, "anime": animes}
+        arrays = self.arrays
+
+        # built aside and swapped in at once, readers never see arrays of different lengths
+        self.arrays = CatalogArrays(
+            np.concatenate([arrays.song_ids, np.asarray(ids, dtype=np.int64)]),
+            np.concatenate([arrays.popularity, np.asarray([p or 0 for p in popularity], dtype=np.float32) / 100]),
+            {
+                feature: np.concatenate([
+                    arrays.columns[feature],
+                    np.asarray([self._column(tag) for tag in tags[feature]], dtype=np.int32)
+                ])
+                for feature in FEATURES
+            }
+        )
+        self.max_id = int(ids[-1])
+
+    def update(self, rows: list[tuple]):
+        # rows of (id, artist, anime, popularity) up to max_id, every one of them is indexed already.
+        # written to copies that are swapped in at once, like extend
+        if not rows:
+            return
+        arrays = self.arrays
+        ids, artists, animes, popularity = zip(*rows)
+        positions = np.searchsorted(arrays.song_ids, np.asarray(ids, dtype=np.int64))
+        tags = {"artist": artists, "anime": animes}
+
+        updated = arrays.popularity.copy()
+        updated[positions] = np.asarray([p or 0 for p in popularity], dtype=np.float32) / 100
+        columns = {}
+        for feature in FEATURES:
+            columns[feature] = arrays.columns[feature].copy()
+            columns[feature][positions] = [self._column(tag) for tag in tags[feature]]
+        self.arrays = CatalogArrays(arrays.song_ids, updated, columns)
+
+    def mark_changed(self, ids: Iterable[int]):
+        with self._changed_lock:
+            self._changed.update(ids)
+
+    def refresh(self, session: Session):
+        # new rows are read past the last indexed id, rows an upsert rewrote are read again by id
+        columns = (AnisongDB.id, AnisongDB.artist, AnisongDB.anime, AnisongDB.spotify_popularity)
+        with self._changed_lock:
+            changed, self._changed = self._changed, set()
+        latest = session.exec(select(func.max(AnisongDB.id))).one()
+        if latest in (None, self.max_id) and not changed:
+            return
+        with self._lock:
+            changed = sorted(song_id for song_id in changed if song_id <= self.max_id)
+            for start in range(0, len(changed), REINDEX_CHUNK_SIZE):
+                self.update(session.exec(
+                    select(*columns).where(AnisongDB.id.in_(changed[start:start + REINDEX_CHUNK_SIZE]))
+                ).all())
+            if latest is not None and latest > self.max_id:
+                self.extend(session.exec(select(*columns).where(AnisongDB.id > self.max_id).order_by(AnisongDB.id)).all())
+
+    def weights(self, preferences: dict[str, float]) -> np.ndarray:
+        vector = np.zeros(len(self.vocabulary) + 1, dtype=np.float32)
+        for tag, weight in preferences.items():
+            column = self.vocabulary.get(normalize_text(tag))
+            if column is not None and weight > 0:
+                vector[column] += weight
+        # scaled to 0..1 so popularity only separates songs that are liked about the same
+        top = vector.max()
+        if top > 0:
+            vector /= top
+        return vector
+
+    def scores(self, preferences: dict[str, float], arrays: Optional[CatalogArrays] = None) -> np.ndarray:
+        arrays = arrays or self.arrays
+        vector = self.weights(preferences)
+        scores = POPULARITY_WEIGHT * arrays.popularity
+        for column in arrays.columns.values():
+            scores += vector[column]
+        return scores
+
+    def top_k(self, preferences: dict[str, float], k: int, exclude: Optional[list[int]] = None):
+        arrays = self.arrays
+        scores = self.scores(preferences, arrays)
+
+        if exclude:
+            exclude = np.asarray(exclude, dtype=np.int64)
+            positions = np.searchsorted(arrays.song_ids, exclude)
+            found = positions < len(scores)
+            positions, exclude = positions[found], exclude[found]
+            scores[positions[arrays.song_ids[positions] == exclude]] = -np.inf
+
+        k = min(k, len(scores))
+        if k <= 0:
+            return [], []
+        # argpartition picks the k best in O(n), only those k get sorted
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best], kind="stable")]
+        best = best[np.isfinite(scores[best])]
+        return arrays.song_ids[best].tolist(), scores[best].tolist()
+
+
+recommendation_index = RecommendationIndex()
+
+
+def mark_anisongs_changed(session: Session, ids: Iterable[int]):
+    # handed to the index once the transaction commits, a refresh before that would read the old row
+    session.info.setdefault("anisongs_changed", set()).update(ids)
+
+
+@event.listens_for(Session, "after_commit")
+def _reindex_committed(session: Session):
+    changed = session.info.pop("anisongs_changed", None)
+    if changed:
+        recommendation_index.mark_changed(changed)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_rolled_back(session: Session):
+    session.info.pop("anisongs_changed", None)
+
+
+def recommend_for_user(session: Session, user_id: int, limit: int = 10, exclude_seen: bool = True) -> list[dict]:
+    recommendation_index.refresh(session)
+
+    preferences = {
+        tag: weight for tag, weight in session.exec(
+            select(UserPreference.tag, UserPreference.weight).where(UserPreference.user_id == user_id)
+        )
+    }
+    seen = None
+    if exclude_seen:
+        seen = session.exec(select(UserHistory.song_id).where(UserHistory.user_id == user_id).distinct()).all()
+
+    ids, scores = recommendation_index.top_k(preferences, limit, exclude=seen)
+    return song_results(session, ids, scores)
+
+
+def song_results(session: Session, ids: list[int], scores: list[float]) -> list[dict]:
+    if not ids:
+        return []
+
+    songs = {song.id: song for song in session.exec(select(AnisongDB).where(AnisongDB.id.in_(ids)))}
+    return [
+        {
+            "id": song_id,
+            "title": songs[song_id].title,
+            "artist": songs[song_id].artist,
+            "anime": songs[song_id].anime,
+            "spotify_url": songs[song_id].spotify_url,
+            "youtube_url": songs[song_id].youtube_url,
+            "score": round(score, 4)
+        }
+        for song_id, score in zip(ids, scores)
+        if song_id in songs
+    ]
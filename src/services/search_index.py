@@ -0,0 +1,213 @@
+from collections import Counter
+from dotenv import load_dotenv
+from typing import Optional
+from sqlalchemy import delete, event, func, text
+from sqlmodel import Session, SQLModel, select
+from src.models.anisong_model import AnisongDB
+from src.models.catalog_model import CatalogAnime, CatalogArtist, CatalogSong
+from src.models.search_model import SearchDocument, SearchGram
+from src.utils import sqlite
+import json
+import logging
+import os
+import re
+import sqlite3
+import unicodedata
+
+load_dotenv()
+
+SUGGEST_MIN_SIMILARITY = float(os.getenv("SUGGEST_MIN_SIMILARITY", "0.3"))
+RESOLVE_SIMILARITY = float(os.getenv("SEARCH_RESOLVE_SIMILARITY", "0.6"))
+PREFIX_BOOST = 0.5
+CANDIDATES = 200
+
+# long vowels are written several ways in romaji: shoujo, shōjo, shojo
+LONG_VOWELS = re.compile(r"ou|oo|uu|aa|ii|ee")
+
+
+def _fts5_available() -> bool:
+    try:
+        connection = sqlite3.connect(":memory:")
+        connection.execute("CREATE VIRTUAL TABLE probe USING fts5(key)")
+        connection.close()
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+FTS5_AVAILABLE = _fts5_available()
+
+
+@event.listens_for(SQLModel.metadata, "after_create")
+def _create_fts(target, connection, **kw):
+    # SQLModel has no virtual tables, the prefix index is created next to the regular ones
+    if FTS5_AVAILABLE:
+        connection.exec_driver_sql(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS searchfts "
+            "USING fts5(key, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+        )
+
+
+def fold(value: Optional[str]) -> str:
+    # case, accent, punctuation and romaji long vowel insensitive form used for matching
+    value = unicodedata.normalize("NFKD", value or "")
+    value = "".join(char for char in value if not unicodedata.combining(char)).casefold()
+    value = re.sub(r"[\W_]+", " ", value)
+    value = LONG_VOWELS.sub(lambda match: match.group(0)[0], value)
+    return " ".join(value.split())
+
+
+def trigrams(key: str) -> set[str]:
+    grams = set()
+    for word in key.split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def _catalog_names(session: Session) -> Counter:
+    names = Counter()
+    for (name,) in session.execute(select(CatalogAnime.name)):
+        names["anime", name] += 1
+    for (title,) in session.execute(select(CatalogSong.title)):
+        names["song", title] += 1
+    for (name,) in session.execute(select(CatalogArtist.name)):
+        names["artist", name] += 1
+    for title, artist, anime in session.execute(select(AnisongDB.title, AnisongDB.artist, AnisongDB.anime)):
+        names["song", title] += 1
+        names["artist", artist] += 1
+        names["anime", anime] += 1
+    return names
+
+
+def _insert_documents(session: Session, documents: list[SearchDocument]):
+    session.add_all(documents)
+    session.flush()
+    grams = [
+        {"gram": gram, "doc_id": document.id}
+        for document in documents
+        for gram in trigrams(document.key)
+    ]
+    if grams:
+        session.execute(SearchGram.__table__.insert(), grams)
+    if FTS5_AVAILABLE and documents:
+        session.execute(
+            text("INSERT INTO searchfts (rowid, key) VALUES (:id, :key)"),
+            [{"id": document.id, "key": document.key} for document in documents]
+        )
+
+
+def _documents(names: Counter) -> dict:
+    documents = {}
+    for (kind, name), count in names.items():
+        key = fold(name)
+        if not key:
+            continue
+        document = documents.get((kind, key))
+        if document is None:
+            documents[kind, key] = SearchDocument(kind=kind, name=name, key=key, grams=len(trigrams(key)), weight=count)
+        else:
+            document.weight += count
+    return documents
+
+
+def rebuild_search_index(session: Session) -> int:
+    documents = list(_documents(_catalog_names(session)).values())
+    session.execute(delete(SearchGram))
+    session.execute(delete(SearchDocument))
+    if FTS5_AVAILABLE:
+        session.execute(text("DELETE FROM searchfts"))
+    _insert_documents(session, documents)
+    session.commit()
+    return len(documents)
+
+
+def index_names(session: Session, names: list[tuple[str, str]]):
+    # adds names seen in a search, the caller commits
+    documents = _documents(Counter(name for name in names if name[1]))
+    if not documents:
+        return
+
+    existing = session.exec(
+        select(SearchDocument).where(SearchDocument.key.in_([key for _, key in documents]))
+    ).all()
+    for document in existing:
+        new = documents.pop((document.kind, document.key), None)
+        if new is not None:
+            document.weight += new.weight
+            session.add(document)
+    _insert_documents(session, list(documents.values()))
+
+
+def _rank(session: Session, key: str, kind: Optional[str]) -> list[tuple[float, float, SearchDocument]]:
+    prefix_hits = set()
+    if FTS5_AVAILABLE:
+        expression = " ".join(f'"{token}"*' for token in key.split())
+        prefix_hits = set(session.execute(
+            text("SELECT rowid FROM searchfts WHERE searchfts MATCH :expression ORDER BY rank LIMIT :limit"),
+            {"expression": expression, "limit": CANDIDATES}
+        ).scalars())
+
+    query_grams = trigrams(key)
+    shared = dict(session.execute(
+        select(SearchGram.doc_id, func.count()).where(
+            SearchGram.gram.in_(query_grams)
+        ).group_by(SearchGram.doc_id).order_by(func.count().desc()).limit(CANDIDATES)
+    ).all())
+
+    ids = prefix_hits | set(shared)
+    if not ids:
+        return []
+
+    statement = select(SearchDocument).where(SearchDocument.id.in_(ids))
+    if kind:
+        statement = statement.where(SearchDocument.kind == kind)
+
+    ranked = []
+    for document in session.exec(statement):
+        common = shared.get(document.id, 0)
+        similarity = common / (len(query_grams) + document.grams - common)
+        prefix = document.id in prefix_hits
+        if not prefix and similarity < SUGGEST_MIN_SIMILARITY:
+            continue
+        score = similarity + (PREFIX_BOOST if prefix else 0)
+        ranked.append((score, similarity, document))
+
+    ranked.sort(key=lambda item: (-item[0], -item[2].weight, len(item[2].name)))
+    return ranked
+
+
+def suggest(session: Session, q: str, limit: int = 10, kind: Optional[str] = None) -> list[dict]:
+    key = fold(q)
+    if not key:
+        return []
+    return [
+        {"kind": document.kind, "name": document.name, "score": round(score, 3)}
+        for score, _, document in _rank(session, key, kind)[:limit]
+    ]
+
+
+def best_match(session: Session, q: str) -> Optional[tuple[str, str]]:
+    # the closest known name, only when it is close enough to stand in for the query
+    key = fold(q)
+    if not key:
+        return None
+    # a longer name that merely starts with the query ("guilty" -> "guilty gear") is a suggestion, not a match
+    ranked = [
+        item for item in _rank(session, key, None)
+        if item[1] >= RESOLVE_SIMILARITY and not item[2].key.startswith(f"{key} ")
+    ]
+    if not ranked:
+        return None
+    _, _, document = max(ranked, key=lambda item: (item[1], item[2].weight))
+    return document.kind, document.name
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    sqlite.create_db_and_tables()
+    with Session(sqlite.engine) as session:
+        print(json.dumps({"documents": rebuild_search_index(session)}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+from collections import defaultdict
+from dotenv import load_dotenv
+from typing import Optional
+from sqlmodel import Session, func, select
+from src.models.anisong_model import AnisongDB
+from src.models.user_model import UserHistory
+from src.services.recommendation_service import song_results
+from src.utils import sqlite
+import argparse
+import asyncio
+import json
+import logging
+import numpy as np
+import os
+import threading
+
+load_dotenv()
+
+SIMILARITY_MODEL_PATH = os.getenv("SIMILARITY_MODEL_PATH", "./item_similarity.bin")
+SIMILARITY_NEIGHBORS = int(os.getenv("SIMILARITY_NEIGHBORS", "50"))
+# a user with thousands of searches would add millions of pairs, only their latest songs count
+SIMILARITY_MAX_ITEMS_PER_USER = int(os.getenv("SIMILARITY_MAX_ITEMS_PER_USER", "500"))
+SIMILARITY_UPDATE_INTERVAL = float(os.getenv("SIMILARITY_UPDATE_INTERVAL", "300"))
+
+MAGIC = b"ANISIM01"
+ALIGN = 64
+ARRAYS = {
+    "item_ids": np.int64,
+    "item_counts": np.int32,
+    "pair_keys": np.int64,
+    "pair_counts": np.int32,
+    "indptr": np.int64,
+    "neighbors": np.int64,
+    "scores": np.float32
+}
+
+
+def _pair_keys(low: np.ndarray, high: np.ndarray) -> np.ndarray:
+    low, high = np.minimum(low, high), np.maximum(low, high)
+    return (low << 32) | high
+
+
+class SimilarityModel:
+    # item_ids/item_counts: songs and how many users searched them
+    # pair_keys/pair_counts: upper triangle of the co-occurrence matrix, (a << 32) | b with a < b
+    # indptr/neighbors/scores: the best neighbors of every song by cosine, CSR rows in item_ids order
+    def __init__(self, arrays: Optional[dict] = None, max_history_id: int = 0):
+        self.arrays = arrays or {name: np.zeros(0 if name != "indptr" else 1, dtype=dtype) for name, dtype in ARRAYS.items()}
+        self.max_history_id = max_history_id
+
+    def __len__(self):
+        return len(self.arrays["item_ids"])
+
+    def _position(self, song_id: int) -> Optional[int]:
+        item_ids = self.arrays["item_ids"]
+        position = int(np.searchsorted(item_ids, song_id))
+        if position < len(item_ids) and item_ids[position] == song_id:
+            return position
+        return None
+
+    def neighbors_of(self, song_id: int, limit: int = SIMILARITY_NEIGHBORS):
+        position = self._position(song_id)
+        if position is None:
+            return [], []
+        indptr = self.arrays["indptr"]
+        start, end = int(indptr[position]), int(indptr[position + 1])
+        end = min(end, start + limit)
+        return self.arrays["neighbors"][start:end].tolist(), self.arrays["scores"][start:end].tolist()
+
+    def also_searched(self, song_ids: list[int], limit: int, exclude: Optional[list[int]] = None):
+        # sum of similarities to everything the user searched
+        indptr = self.arrays["indptr"]
+        positions = [position for position in map(self._position, song_ids) if position is not None]
+        if not positions:
+            return [], []
+
+        neighbors = np.concatenate([self.arrays["neighbors"][indptr[p]:indptr[p + 1]] for p in positions])
+        scores = np.concatenate([self.arrays["scores"][indptr[p]:indptr[p + 1]] for p in positions])
+        candidates, inverse = np.unique(neighbors, return_inverse=True)
+        totals = np.bincount(inverse, weights=scores).astype(np.float32)
+
+        if exclude:
+            totals[np.isin(candidates, np.asarray(exclude, dtype=np.int64))] = -np.inf
+        k = min(limit, len(totals))
+        if k <= 0:
+            return [], []
+        best = np.argpartition(-totals, k - 1)[:k]
+        best = best[np.argsort(-totals[best], kind="stable")]
+        best = best[np.isfinite(totals[best])]
+        return candidates[best].tolist(), totals[best].tolist()
+
+
+def _user_songs(session: Session, user_ids: list[int], max_history_id: int) -> dict[int, list[int]]:
+    # distinct songs per user up to max_history_id, latest first
+    rows = session.exec(
+        select(UserHistory.user_id, UserHistory.song_id, func.max(UserHistory.id).label("last")).where(
+            UserHistory.user_id.in_(user_ids),
+            UserHistory.id <= max_history_id
+        ).group_by(UserHistory.user_id, UserHistory.song_id).order_by(func.max(UserHistory.id).desc())
+    ).all()
+    songs = defaultdict(list)
+    for user_id, song_id, _ in rows:
+        songs[user_id].append(song_id)
+    return songs
+
+
+def _history_deltas(session: Session, max_history_id: int):
+    new_rows = session.exec(
+        select(UserHistory.id, UserHistory.user_id, UserHistory.song_id).where(
+            UserHistory.id > max_history_id
+        ).order_by(UserHistory.id)
+    ).all()
+    if not new_rows:
+        return None
+
+    added = defaultdict(dict)
+    for _, user_id, song_id in new_rows:
+        added[user_id][song_id] = None
+
+    known = _user_songs(session, list(added), max_history_id)
+    pair_keys = []
+    item_deltas = []
+    for user_id, songs in added.items():
+        seen = set(known.get(user_id, []))
+        # a song counts once per user, searching it again adds nothing
+        fresh = np.asarray([song for song in songs if song not in seen][-SIMILARITY_MAX_ITEMS_PER_USER:], dtype=np.int64)
+        if not len(fresh):
+            continue
+        older = np.asarray(known.get(user_id, [])[:SIMILARITY_MAX_ITEMS_PER_USER - len(fresh)], dtype=np.int64)
+
+        item_deltas.append(fresh)
+        pair_keys.append(_pair_keys(np.repeat(fresh, len(older)), np.tile(older, len(fresh))))
+        first, second = np.triu_indices(len(fresh), k=1)
+        pair_keys.append(_pair_keys(fresh[first], fresh[second]))
+
+    empty = np.zeros(0, dtype=np.int64)
+    return (
+        int(new_rows[-1][0]),
+        np.concatenate(item_deltas) if item_deltas else empty,
+        np.concatenate(pair_keys) if pair_keys else empty
+    )
+
+
+def _merge(keys: np.ndarray, counts: np.ndarray, new_keys: np.ndarray, dtype=np.int32):
+    keys, inverse = np.unique(np.concatenate([keys, new_keys]), return_inverse=True)
+    weights = np.concatenate([counts, np.ones(len(new_keys), dtype=counts.dtype)])
+    return keys, np.bincount(inverse, weights=weights, minlength=len(keys)).astype(dtype)
+
+
+def _neighbors(item_ids: np.ndarray, item_counts: np.ndarray, pair_keys: np.ndarray, pair_counts: np.ndarray, limit: int):
+    low, high = pair_keys >> 32, pair_keys & 0xFFFFFFFF
+    source = np.concatenate([low, high])
+    target = np.concatenate([high, low])
+    together = np.concatenate([pair_counts, pair_counts]).astype(np.float32)
+
+    # cosine over binary user vectors: |users of a and b| / sqrt(|users of a| * |users of b|)
+    source_counts = item_counts[np.searchsorted(item_ids, source)]
+    target_counts = item_counts[np.searchsorted(item_ids, target)]
+    scores = together / np.sqrt(source_counts * target_counts.astype(np.float32))
+
+    order = np.lexsort((-scores, source))
+    source, target, scores = source[order], target[order], scores[order]
+    rank = np.arange(len(source)) - np.searchsorted(source, source)
+    keep = rank < limit
+    source, target, scores = source[keep], target[keep], scores[keep]
+
+    indptr = np.concatenate([np.searchsorted(source, item_ids), [len(source)]]).astype(np.int64)
+    return indptr, target.astype(np.int64), scores.astype(np.float32)
+
+
+def update_model(session: Session, model: SimilarityModel, neighbors: int = SIMILARITY_NEIGHBORS) -> SimilarityModel:
+    # folds history rows newer than the model in, returns the same model when nothing is new
+    deltas = _history_deltas(session, model.max_history_id)
+    if deltas is None:
+        return model
+    max_history_id, new_items, new_pairs = deltas
+
+    arrays = model.arrays
+    item_ids, item_counts = _merge(arrays["item_ids"], arrays["item_counts"], new_items)
+    pair_keys, pair_counts = _merge(arrays["pair_keys"], arrays["pair_counts"], new_pairs)
+    indptr, neighbor_ids, scores = _neighbors(item_ids, item_counts, pair_keys, pair_counts, neighbors)
+
+    return SimilarityModel({
+        "item_ids": item_ids,
+        "item_counts": item_counts,
+        "pair_keys": pair_keys,
+        "pair_counts": pair_counts,
+        "indptr": indptr,
+        "neighbors": neighbor_ids,
+        "scores": scores
+    }, max_history_id)
+
+
+def write_model(model: SimilarityModel, path: str):
+    # MAGIC, header length, JSON header, then every array at a 64 byte aligned offset.
+    # written next to the target and renamed over it so readers never see half a file
+    layout = {}
+    offset = 0
+    for name, dtype in ARRAYS.items():
+        data = np.ascontiguousarray(model.arrays[name], dtype=dtype)
+        layout[name] = {"offset": offset, "length": len(data)}
+        offset += -(-data.nbytes // ALIGN) * ALIGN
+    header = json.dumps({"max_history_id": model.max_history_id, "arrays": layout}).encode()
+    data_start = -(-(len(MAGIC) + 8 + len(header)) // ALIGN) * ALIGN
+
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        for name, dtype in ARRAYS.items():
+            f.seek(data_start + layout[name]["offset"])
+            f.write(np.ascontiguousarray(model.arrays[name], dtype=dtype).tobytes())
+        f.truncate(data_start + offset)
+    os.replace(temporary, path)
+
+
+def read_model(path: str) -> SimilarityModel:
+    # the arrays are views into one read-only memory map, every worker shares the page cache
+    raw = np.memmap(path, dtype=np.uint8, mode="r")
+    if bytes(raw[:len(MAGIC)]) != MAGIC:
+        raise ValueError(f"{path} is not a similarity model")
+    header_length = int(raw[len(MAGIC):len(MAGIC) + 8].view(np.uint64)[0])
+    header = json.loads(bytes(raw[len(MAGIC) + 8:len(MAGIC) + 8 + header_length]))
+    data_start = -(-(len(MAGIC) + 8 + header_length) // ALIGN) * ALIGN
+
+    arrays = {}
+    for name, dtype in ARRAYS.items():
+        entry = header["arrays"][name]
+        arrays[name] = np.frombuffer(raw, dtype=dtype, count=entry["length"], offset=data_start + entry["offset"])
+    return SimilarityModel(arrays, header["max_history_id"])
+
+
+class SimilarityStore:
+    def __init__(self, path: str = SIMILARITY_MODEL_PATH):
+        self.path = path
+        self._model: Optional[SimilarityModel] = None
+        self._mtime: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def get(self) -> SimilarityModel:
+        # remapped when another worker or the ingest command replaced the file
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if self._model is None or mtime != self._mtime:
+            with self._lock:
+                if self._model is None or mtime != self._mtime:
+                    self._model = read_model(self.path) if mtime is not None else SimilarityModel()
+                    self._mtime = mtime
+        return self._model
+
+    def refresh(self, session: Session, full: bool = False) -> dict:
+        model = SimilarityModel() if full else self.get()
+        updated = update_model(session, model)
+        if updated is not model:
+            write_model(updated, self.path)
+        return {"songs": len(updated), "pairs": len(updated.arrays["pair_keys"]), "max_history_id": updated.max_history_id}
+
+
+similarity_store = SimilarityStore()
+
+
+class SimilarityUpdater:
+    def __init__(self, interval: float = SIMILARITY_UPDATE_INTERVAL):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await sqlite.run_db(similarity_store.refresh)
+            except Exception as e:
+                logging.warning(f"Similarity model update failed: {e}")
+
+    def start(self):
+        if self.interval <= 0:
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+
+similarity_updater = SimilarityUpdater()
+
+
+def similar_songs(session: Session, song_id: int, limit: int = 10) -> Optional[list[dict]]:
+    if session.get(AnisongDB, song_id) is None:
+        return None
+    ids, scores = similarity_store.get().neighbors_of(song_id, limit)
+    return song_results(session, ids, scores)
+
+
+def recommend_also_searched(session: Session, user_id: int, limit: int = 10, exclude_seen: bool = True) -> list[dict]:
+    history = session.exec(
+        select(UserHistory.song_id).where(UserHistory.user_id == user_id).order_by(UserHistory.id.desc())
+    ).all()
+    searched = list(dict.fromkeys(history))
+    ids, scores = similarity_store.get().also_searched(
+        searched[:SIMILARITY_MAX_ITEMS_PER_USER], limit, exclude=searched if exclude_seen else None
+    )
+    return song_results(session, ids, scores)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or update the item similarity model")
+    parser.add_argument("--full", action="store_true", help="rebuild from the whole history")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    sqlite.create_db_and_tables()
+    with Session(sqlite.engine) as session:
+        print(json.dumps(similarity_store.refresh(session, full=args.full)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,12 @@
+from collections import deque
 from dotenv import load_dotenv
+from typing import Optional
+from src.utils.http_client import get_http_clients
+from src.utils.metrics import spotify_search_requests, spotify_search_seconds
+from src.services.enrichment_cache import get_enrichment_cache, make_cache_key
+from src.utils.sqlite import run_in_db
+import asyncio
+import logging
 import os
 import httpx
 import time
@@ -10,33 +18,272 @@ SPOTIFY_CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET")
 TOKEN_URL = "https://accounts.spotify.com/api/token"
 SEARCH_URL = "https://api.spotify.com/v1/search"
 
-_cached_token = None
-_token_exp = 0
+TOKEN_REFRESH_MARGIN = float(os.getenv("SPOTIFY_TOKEN_REFRESH_MARGIN", "300"))
+TOKEN_EXPIRY_MARGIN = 30
+TOKEN_RETRY_DELAY = 5
+TOKEN_MAX_RETRY_DELAY = 60
 
-async def get_spotify_token():
-    global _cached_token, _token_exp
-    now = time.time()
-    
-    if _cached_token and now < _token_exp:
-        return _cached_token
-    
-    async with httpx.AsyncClient() as client:
-        auth = (SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET)
+SPOTIFY_STRATEGIES = ("sequential", "parallel", "hedged")
+SPOTIFY_STRATEGY = os.getenv("SPOTIFY_STRATEGY", "sequential")
+SPOTIFY_HEDGE_DELAY = float(os.getenv("SPOTIFY_HEDGE_DELAY", "0.3"))
+SPOTIFY_MAX_REQUESTS = int(os.getenv("SPOTIFY_MAX_REQUESTS", "10"))
+
+
+class SpotifyTokenManager:
+    def __init__(
+        self,
+        client_id: Optional[str] = SPOTIFY_CLIENT_ID,
+        client_secret: Optional[str] = SPOTIFY_CLIENT_SECRET,
+        refresh_margin: float = TOKEN_REFRESH_MARGIN
+    ):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.refresh_margin = refresh_margin
+        self.refresh_count = 0
+        self.refresh_failures = 0
+        self.last_refresh_latency = 0.0
+        self.total_refresh_latency = 0.0
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._refresh_at = 0.0
+        self._lock: Optional[asyncio.Lock] = None
+        self._lock_loop = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _get_lock(self) -> asyncio.Lock:
+        # a lock belongs to one event loop, tests and scripts may run several
+        loop = asyncio.get_running_loop()
+        if self._lock is None or self._lock_loop is not loop:
+            self._lock = asyncio.Lock()
+            self._lock_loop = loop
+        return self._lock
+
+    def _usable(self, rejected: Optional[str] = None) -> bool:
+        return bool(self._token) and self._token != rejected and time.time() < self._expires_at
+
+    async def get_token(self, client: Optional[httpx.AsyncClient] = None, rejected: Optional[str] = None):
+        if self._usable(rejected):
+            return self._token
+
+        async with self._get_lock():
+            # whoever held the lock before us may already have refreshed
+            if not self._usable(rejected):
+                await self._refresh(client)
+            return self._token
+
+    async def _refresh(self, client: Optional[httpx.AsyncClient] = None):
+        client = client or get_http_clients().spotify
+        auth = (self.client_id, self.client_secret)
         data = {"grant_type": "client_credentials"}
-        response = await client.post(TOKEN_URL, auth=auth, data=data)
-        response.raise_for_status()
-        
-        token_data = response.json()
-        
-        _cached_token = token_data["access_token"]
-        _token_exp = now + token_data["expires_in"] - 60
-        
-        return _cached_token
-    
-async def search_spotify(title, artist, anime=None):
-    token = await get_spotify_token()
-    headers = {"Authorization" : f"Bearer {token}"}
-    base_params = {"type": "track", "limit": 5, "market": "JP"}
+
+        started = time.perf_counter()
+        try:
+            response = await client.post(TOKEN_URL, auth=auth, data=data)
+            response.raise_for_status()
+            token_data = response.json()
+        except Exception:
+            self.refresh_failures += 1
+            raise
+        finally:
+            self.last_refresh_latency = time.perf_counter() - started
+            self.total_refresh_latency += self.last_refresh_latency
+
+        now = time.time()
+        expires_in = token_data["expires_in"]
+        self._token = token_data["access_token"]
+        self._expires_at = now + expires_in - min(TOKEN_EXPIRY_MARGIN, expires_in / 10)
+        self._refresh_at = now + max(expires_in - self.refresh_margin, expires_in / 2)
+        self.refresh_count += 1
+
+    async def _refresh_loop(self, client: Optional[httpx.AsyncClient]):
+        retry_delay = TOKEN_RETRY_DELAY
+        while True:
+            await asyncio.sleep(max(self._refresh_at - time.time(), 0))
+            try:
+                async with self._get_lock():
+                    if time.time() >= self._refresh_at:
+                        await self._refresh(client)
+                retry_delay = TOKEN_RETRY_DELAY
+            except Exception as e:
+                logging.warning(f"Spotify token refresh failed: {e}")
+                self._refresh_at = time.time() + retry_delay
+                retry_delay = min(retry_delay * 2, TOKEN_MAX_RETRY_DELAY)
+
+    def start(self, client: Optional[httpx.AsyncClient] = None):
+        if not (self.client_id and self.client_secret):
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._refresh_loop(client))
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    def metrics(self) -> dict:
+        return {
+            "refresh_count": self.refresh_count,
+            "refresh_failures": self.refresh_failures,
+            "last_refresh_latency": self.last_refresh_latency,
+            "total_refresh_latency": self.total_refresh_latency,
+            "expires_in": max(self._expires_at - time.time(), 0)
+        }
+
+
+spotify_tokens = SpotifyTokenManager()
+
+
+async def get_spotify_token(client: Optional[httpx.AsyncClient] = None):
+    return await spotify_tokens.get_token(client)
+
+class StrategyStats:
+    def __init__(self, window: int = 1024):
+        self.searches = 0
+        self.hits = 0
+        self.requests = 0
+        self.latencies: deque[float] = deque(maxlen=window)
+
+    def record(self, latency: float, hit: bool, requests: int):
+        self.searches += 1
+        self.hits += int(hit)
+        self.requests += requests
+        self.latencies.append(latency)
+
+    def summary(self) -> dict:
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if not latencies:
+                return 0.0
+            return latencies[min(int(p * len(latencies)), len(latencies) - 1)]
+
+        return {
+            "searches": self.searches,
+            "hits": self.hits,
+            "requests_per_search": self.requests / self.searches if self.searches else 0.0,
+            "p50": percentile(0.50),
+            "p95": percentile(0.95),
+            "mean": sum(latencies) / len(latencies) if latencies else 0.0
+        }
+
+
+strategy_stats = {strategy: StrategyStats() for strategy in SPOTIFY_STRATEGIES}
+
+_request_slots: Optional[asyncio.Semaphore] = None
+_request_slots_loop = None
+
+
+def _get_request_slots() -> asyncio.Semaphore:
+    # shared by every strategy so parallel/hedged fan-out stays within SPOTIFY_MAX_REQUESTS
+    global _request_slots, _request_slots_loop
+    loop = asyncio.get_running_loop()
+    if _request_slots is None or _request_slots_loop is not loop:
+        _request_slots = asyncio.Semaphore(SPOTIFY_MAX_REQUESTS)
+        _request_slots_loop = loop
+    return _request_slots
+
+
+def spotify_strategy_stats() -> dict:
+    return {strategy: stats.summary() for strategy, stats in strategy_stats.items()}
+
+
+async def _search_query(client: httpx.AsyncClient, token: str, q: str, counter: list):
+    params = {"type": "track", "limit": 5, "market": "JP", "q": q}
+
+    async with _get_request_slots():
+        counter.append(q)
+        response = await client.get(SEARCH_URL, headers={"Authorization" : f"Bearer {token}"}, params=params)
+        if response.status_code == 401:
+            # token revoked or expired early, refresh once and retry the same query
+            token = await spotify_tokens.get_token(client, rejected=token)
+            counter.append(q)
+            response = await client.get(SEARCH_URL, headers={"Authorization" : f"Bearer {token}"}, params=params)
+
+    if response.status_code != 200:
+        return False, None
+
+    items = response.json().get("tracks", {}).get("items", [])
+    if not items:
+        return True, None
+
+    track = items[0]
+    return True, {
+        "spotify_url": track["external_urls"]["spotify"],
+        "name": track["name"],
+        "artists": track["artists"][0]["name"],
+        "popularity": track["popularity"]
+    }
+
+
+def _decide(tasks: list[asyncio.Task]):
+    # the winner is the first query in priority order that found a track,
+    # a lower priority hit only counts once every query before it missed
+    for task in tasks:
+        if not task.done():
+            return "pending", None
+        if task.exception() is None and task.result()[1] is not None:
+            return "hit", task.result()[1]
+    return "exhausted", None
+
+
+async def _run_queries(client: httpx.AsyncClient, token: str, queries: list[str], hedge_delay: Optional[float], counter: list):
+    tasks: list[asyncio.Task] = []
+    try:
+        for q in queries:
+            tasks.append(asyncio.create_task(_search_query(client, token, q, counter)))
+
+            while True:
+                state, result = _decide(tasks)
+                if state == "hit":
+                    return tasks, result
+                if state == "exhausted":
+                    break
+
+                pending = [task for task in tasks if not task.done()]
+                done, _ = await asyncio.wait(pending, timeout=hedge_delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # hedge: the current queries are slow, start the next fallback next to them
+                    break
+
+        while True:
+            state, result = _decide(tasks)
+            if state != "pending":
+                return tasks, result
+            await asyncio.wait([task for task in tasks if not task.done()], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()
+
+
+async def search_spotify(
+    title,
+    artist,
+    anime=None,
+    client: Optional[httpx.AsyncClient] = None,
+    strategy: Optional[str] = None
+):
+    strategy = strategy or SPOTIFY_STRATEGY
+    if strategy not in SPOTIFY_STRATEGIES:
+        raise ValueError(f"Unknown spotify strategy: {strategy}")
+
+    cache = get_enrichment_cache()
+    cache_key = make_cache_key(title, artist, anime)
+    hit, cached = cache.peek("spotify", cache_key)
+    if not hit:
+        hit, cached = await run_in_db(cache.get, "spotify", cache_key, title=title, artist=artist)
+    if hit:
+        return cached
+
+    client = client or get_http_clients().spotify
+    token = await get_spotify_token(client)
     query = []
     
     if artist: 
@@ -46,25 +293,25 @@ async def search_spotify(title, artist, anime=None):
     
     if anime:
         query.append(f"{title} {anime}")
-    
-    async with httpx.AsyncClient() as client:
-        for q in query:
-            params = base_params | {"q": q}
-        
-            response = await client.get(SEARCH_URL, headers=headers, params=params)
-            if response.status_code != 200:
-                continue
-            
-            data = response.json()
-            items = data.get("tracks", {}).get("items", [])
-            
-            if not items:
-                continue
-            track = items[0]
-            return {
-                "spotify_url": track["external_urls"]["spotify"],
-                "name": track["name"],
-                "artists": track["artists"][0]["name"],
-                "popularity": track["popularity"]
-            }
-    
\ No newline at end of file
+
+    hedge_delay = {"sequential": None, "parallel": 0, "hedged": SPOTIFY_HEDGE_DELAY}[strategy]
+    counter = []
+    started = time.perf_counter()
+    tasks, result = await _run_queries(client, token, query, hedge_delay, counter)
+    elapsed = time.perf_counter() - started
+    strategy_stats[strategy].record(elapsed, result is not None, len(counter))
+    spotify_search_seconds.observe(elapsed, strategy, "hit" if result is not None else "miss")
+    spotify_search_requests.inc(strategy, amount=len(counter))
+
+    if result is not None:
+        await run_in_db(cache.set, "spotify", cache_key, result)
+        return result
+
+    finished = [task for task in tasks if task.done() and not task.cancelled()]
+    errors = [task.exception() for task in finished if task.exception() is not None]
+    if errors and len(errors) == len(tasks):
+        raise errors[0]
+
+    # only remember a miss when every query got an answer, a 429 or 5xx might have been the match
+    if len(finished) == len(tasks) and all(task.exception() is None and task.result()[0] for task in finished):
+        await run_in_db(cache.set, "spotify", cache_key, None)
@@ -1,16 +1,28 @@
+from dotenv import load_dotenv
+from typing import Optional
 from sqlmodel import Session, select
 from src.models.user_model import User
 from src.services.auth_services import hash_password
+import os
+
+load_dotenv()
+
+# comma separated usernames allowed to use the admin only tools, e.g. ?profile=1
+ADMIN_USERNAMES = {name.strip() for name in os.getenv("ADMIN_USERNAMES", "").split(",") if name.strip()}
 
 def get_user_by_username(session: Session, username: str):
     return session.exec(
         select(User).where(User.username == username)
     ).first()
 
-def create_user(session: Session, username: str, password: str):
-    hashed = hash_password(password)
+def create_user(session: Session, username: str, password: str, password_hash: Optional[str] = None):
+    hashed = password_hash or hash_password(password)
     user = User(username=username, password_hash=hashed)
     session.add(user)
     session.commit()
     session.refresh(user)
     return user
+
+def is_admin(session: Session, user_id: int) -> bool:
+    user = session.get(User, user_id)
+    return user is not None and user.username in ADMIN_USERNAMES
@@ -1,4 +1,8 @@
 from dotenv import load_dotenv
+from typing import Optional
+from src.utils.http_client import get_http_clients
+from src.services.enrichment_cache import get_enrichment_cache, make_cache_key
+from src.utils.sqlite import run_in_db
 import os
 import httpx
 
@@ -8,7 +12,21 @@ YOUTUBE_API_KEY = os.getenv("YOUTUBE_API_KEY")
 
 BASE_URL = "https://www.googleapis.com/youtube/v3/search"
 
-async def search_youtube(query: str):
+async def search_youtube(
+    query: str,
+    client: Optional[httpx.AsyncClient] = None,
+    title: Optional[str] = None,
+    artist: Optional[str] = None,
+    anime: Optional[str] = None
+):
+    cache = get_enrichment_cache()
+    cache_key = make_cache_key(title, artist, anime) if title else make_cache_key(query)
+    hit, cached = cache.peek("youtube", cache_key)
+    if not hit:
+        hit, cached = await run_in_db(cache.get, "youtube", cache_key, title=title, artist=artist)
+    if hit:
+        return cached
+
     params = {
         "part": "snippet",
         "q": query,
@@ -16,16 +34,19 @@ async def search_youtube(query: str):
         "type": "video",
         "key": YOUTUBE_API_KEY
     }
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(BASE_URL, params=params)
-            response.raise_for_status()
-            data = response.json()
-            if data["items"]:
-                video_id = data["items"][0]["id"]["videoId"]
-                return f"https://www.youtube.com/watch?v={video_id}"
-        except httpx.HTTPStatusError as e:
-            if e.response.status_code == 403:
-                return None
-            raise e
+    client = client or get_http_clients().youtube
+    try:
+        response = await client.get(BASE_URL, params=params)
+        response.raise_for_status()
+        data = response.json()
+        url = None
+        if data["items"]:
+            video_id = data["items"][0]["id"]["videoId"]
+            url = f"https://www.youtube.com/watch?v={video_id}"
+        await run_in_db(cache.set, "youtube", cache_key, url)
+        return url
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code == 403:
+            return None
+        raise e
     
\ No newline at end of file
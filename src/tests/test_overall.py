@@ -1,8 +1,22 @@
 from fastapi.testclient import TestClient
+import asyncio
+import time
+import httpx
 from pytest import fixture
-from sqlmodel import Session, SQLModel, create_engine
+from sqlmodel import Session, SQLModel, create_engine, select
 from src.services.user_services import get_user_by_username, create_user
-from src.services.anisong_services import  search_youtube, search_spotify, fetch_anisong_artist, fetch_anisong_criteria
+from src.services.youtube_services import search_youtube
+from src.services.spotify_services import search_spotify
+from src.services.anisong_services import fetch_anisong_artist, fetch_anisong_criteria, fetch_anisong_list, animethemes_cache
+from src.utils.cache import AsyncTTLCache, make_key
+from src.services.spotify_services import SpotifyTokenManager
+from src.utils.http_client import UpstreamClients, get_http_clients
+from src.services import enrichment_cache
+from src.services.enrichment_cache import EnrichmentCache, make_cache_key
+from src.models.anisong_model import AnisongDB
+from src.models.user_model import UserPreference
+from src.utils.sqlite import create_sqlite_engine
+import tempfile
 
 @fixture
 def client():
@@ -83,10 +97,25 @@ def test_auth_invalid_password(client):
     r = client.post("/auth/login", json={"username": "px1", "password": "wrong"})
     assert r.status_code == 401
 
+def test_auth_unreadable_hash_is_invalid_password(client):
+    from src.utils import sqlite
+    client.post("/auth/register", json={"username": "px2", "password": "pw"})
+    with Session(sqlite.engine) as session:
+        user = get_user_by_username(session, "px2")
+        user.password_hash = "not-a-bcrypt-hash"
+        session.add(user)
+        session.commit()
+    r = client.post("/auth/login", json={"username": "px2", "password": "pw"})
+    assert r.status_code == 401
+
 def test_auth_decode_token_fail(client):
+    from fastapi import HTTPException
+    from pytest import raises
     from src.routers.auth import get_current_user
-    get_current_user("abc.def.ghi")
-    
+    with raises(HTTPException) as error:
+        asyncio.run(get_current_user("abc.def.ghi"))
+    assert error.value.status_code == 401
+
 def test_get_preferences(client):
     headers = register_and_login(client)
     r = client.get("/preferences/", headers=headers)
@@ -269,4 +298,1405 @@ def test_add_preferences_invalid_weight(client):
 def test_add_preferences_negative_weight(client):
     headers = register_and_login(client)
     r = client.post("/preferences/", params={"tag": "Test", "weight": -3.0}, headers=headers)
-    assert r.status_code == 200
\ No newline at end of file
+    assert r.status_code == 200
+def fake_upstream_handler(request):
+    host = request.url.host
+    if host == "api.animethemes.moe":
+        return httpx.Response(200, json={"animethemes": [
+            {"type": "OP", "anime": {"name": "Guilty Crown"}, "song": {"title": "My Dearest", "artists": [{"name": "supercell"}]}},
+            {"type": "ED", "anime": {"name": "Guilty Crown"}, "song": {"title": "Departures", "artists": [{"name": "EGOIST"}]}}
+        ]})
+    if host == "www.googleapis.com":
+        return httpx.Response(200, json={"items": [{"id": {"videoId": "abc"}}]})
+    if host == "accounts.spotify.com":
+        return httpx.Response(200, json={"access_token": "tok", "expires_in": 3600})
+    if host == "api.spotify.com":
+        return httpx.Response(200, json={"tracks": {"items": [{
+            "external_urls": {"spotify": "https://open.spotify.com/track/1"},
+            "name": "My Dearest",
+            "artists": [{"name": "supercell"}],
+            "popularity": 50
+        }]}})
+    return httpx.Response(404)
+
+def memory_engine():
+    # a throwaway file database, the db executor uses it from several threads
+    engine = create_sqlite_engine(f"sqlite:///{tempfile.mkdtemp()}/test.db")
+    SQLModel.metadata.create_all(engine)
+    return engine
+
+@fixture
+def memory_cache(monkeypatch):
+    cache = EnrichmentCache(engine=memory_engine())
+    monkeypatch.setattr(enrichment_cache, "_cache", cache)
+    return cache
+
+@fixture
+def fake_clients(client, memory_cache):
+    from src.main import app
+    animethemes_cache.clear()
+    calls = []
+
+    def handler(request):
+        calls.append(request.url.host)
+        return fake_upstream_handler(request)
+
+    fake = UpstreamClients(transport=httpx.MockTransport(handler))
+    fake.calls = calls
+    app.dependency_overrides[get_http_clients] = lambda: fake
+    yield fake
+    app.dependency_overrides.pop(get_http_clients, None)
+
+def test_upstream_clients_are_reused():
+    clients = UpstreamClients()
+    assert clients.get("animethemes") is clients.animethemes
+    assert clients.youtube is not clients.spotify
+
+def test_upstream_clients_closed_on_shutdown():
+    clients = UpstreamClients()
+    clients.open()
+    opened = [clients.animethemes, clients.youtube, clients.spotify]
+    asyncio.run(clients.aclose())
+    assert all(c.is_closed for c in opened)
+
+def test_themes_use_injected_clients(client, fake_clients):
+    r = client.get("/anisong/themes", params={"theme_type": "OP", "limit": 2})
+    assert r.status_code == 200
+    data = r.json()
+    assert data["count"] == 2
+    assert data["results"][0]["youtube_url"] == "https://www.youtube.com/watch?v=abc"
+    assert "api.animethemes.moe" in fake_clients.calls
+
+def test_enrich_songs_keeps_order_and_isolates_failures(monkeypatch):
+    from src.services import enrichment_service
+
+    async def fake_youtube(query, client=None, **kwargs):
+        if query.startswith("bad"):
+            raise httpx.ConnectError("boom")
+        await asyncio.sleep(0.01 if query.startswith("slow") else 0)
+        return f"yt:{query.split()[0]}"
+
+    async def fake_spotify(title, artist, anime=None, client=None):
+        return f"sp:{title}"
+
+    monkeypatch.setattr(enrichment_service, "search_youtube", fake_youtube)
+    monkeypatch.setattr(enrichment_service, "search_spotify", fake_spotify)
+
+    songs = [
+        {"anime": "A", "song_title": "slow", "artists": ["x"], "theme_type": "OP"},
+        {"anime": "B", "song_title": "bad", "artists": [], "theme_type": "ED"},
+        {"anime": "C", "song_title": "fast", "artists": ["y"], "theme_type": "OP"}
+    ]
+    results = asyncio.run(enrichment_service.enrich_songs(songs, clients=UpstreamClients()))
+
+    assert [r["song_title"] for r in results] == ["slow", "bad", "fast"]
+    assert results[0]["youtube_url"] == "yt:slow"
+    assert results[1]["youtube_url"] is None
+    assert results[1]["spotify_url"] == "sp:bad"
+
+def test_enrich_songs_passes_anime_to_spotify(monkeypatch):
+    from src.services import enrichment_service
+    seen = []
+
+    async def fake_spotify(title, artist, anime=None, client=None):
+        seen.append((title, artist, anime))
+
+    monkeypatch.setattr(enrichment_service, "search_spotify", fake_spotify)
+    songs = [{"anime": "Guilty Crown", "song_title": "My Dearest", "artists": ["supercell"]}]
+    asyncio.run(enrichment_service.enrich_songs(songs, provider="spotify", clients=UpstreamClients()))
+    # the anime is what the third fallback query searches with
+    assert seen == [("My Dearest", "supercell", "Guilty Crown")]
+
+def test_enrich_songs_respects_provider_concurrency(monkeypatch):
+    from src.services import enrichment_service
+    in_flight = {"now": 0, "peak": 0}
+
+    async def fake_spotify(title, artist, anime=None, client=None):
+        in_flight["now"] += 1
+        in_flight["peak"] = max(in_flight["peak"], in_flight["now"])
+        await asyncio.sleep(0.01)
+        in_flight["now"] -= 1
+        return title
+
+    monkeypatch.setattr(enrichment_service, "search_spotify", fake_spotify)
+    songs = [{"anime": "A", "song_title": str(i), "artists": []} for i in range(10)]
+    results = asyncio.run(enrichment_service.enrich_songs(
+        songs, provider="spotify", clients=UpstreamClients(), spotify_concurrency=3
+    ))
+
+    assert in_flight["peak"] == 3
+    assert [r["spotify_url"] for r in results] == [str(i) for i in range(10)]
+    assert all(r["youtube_url"] is None for r in results)
+
+def test_enrichment_cache_serves_repeat_lookups(memory_cache):
+    calls = []
+
+    def handler(request):
+        calls.append(request.url.host)
+        return fake_upstream_handler(request)
+
+    clients = UpstreamClients(transport=httpx.MockTransport(handler))
+
+    async def lookup():
+        first = await search_youtube("q", client=clients.youtube, title="My Dearest", artist="supercell", anime="Guilty Crown")
+        second = await search_youtube("q", client=clients.youtube, title="my  dearest", artist="SUPERCELL", anime="guilty crown")
+        return first, second
+
+    first, second = asyncio.run(lookup())
+    assert first == second == "https://www.youtube.com/watch?v=abc"
+    assert calls.count("www.googleapis.com") == 1
+    assert memory_cache.stats["youtube"] == {"hits": 1, "misses": 1, "catalog_hits": 0, "evictions": 0}
+
+def test_enrichment_cache_ttl_and_eviction():
+    cache = EnrichmentCache(engine=memory_engine(), ttl={"youtube": 60}, max_entries=2)
+    cache.set("youtube", "a", "url-a")
+    cache.set("youtube", "b", None)
+    assert cache.get("youtube", "a") == (True, "url-a")
+    assert cache.get("youtube", "b") == (True, None)
+
+    cache.ttl["youtube"] = 0
+    assert cache.get("youtube", "a") == (False, None)
+
+    cache.set("youtube", "c", "url-c")
+    assert cache.evict("youtube") == 1
+    assert cache.stats["youtube"]["evictions"] == 1
+
+def test_enrichment_cache_reads_anisong_catalog():
+    engine = memory_engine()
+    with Session(engine) as session:
+        session.add(AnisongDB(title="Departures", artist="EGOIST", anime="Guilty Crown",
+                              spotify_url="https://open.spotify.com/track/2", spotify_popularity=40,
+                              youtube_url="https://www.youtube.com/watch?v=dep"))
+        session.commit()
+
+    cache = EnrichmentCache(engine=engine)
+    key = make_cache_key("Departures", "EGOIST", "Guilty Crown")
+    assert cache.get("youtube", key, title="Departures", artist="EGOIST") == (True, "https://www.youtube.com/watch?v=dep")
+    hit, spotify = cache.get("spotify", key, title="Departures", artist="EGOIST")
+    assert hit and spotify["popularity"] == 40
+    assert cache.stats["spotify"]["catalog_hits"] == 1
+
+def test_youtube_quota_error_is_not_cached(memory_cache):
+    clients = UpstreamClients(transport=httpx.MockTransport(lambda request: httpx.Response(403)))
+    assert asyncio.run(search_youtube("q", client=clients.youtube, title="t")) is None
+    assert memory_cache.get("youtube", make_cache_key("t")) == (False, None)
+
+def test_animethemes_burst_is_single_flight():
+    animethemes_cache.clear()
+    calls = []
+
+    async def handler(request):
+        calls.append(str(request.url))
+        await asyncio.sleep(0.05)
+        return fake_upstream_handler(request)
+
+    clients = UpstreamClients(transport=httpx.MockTransport(handler))
+
+    async def burst():
+        return await asyncio.gather(*[fetch_anisong_list("OP", 3, client=clients.animethemes) for _ in range(10)])
+
+    results = asyncio.run(burst())
+    assert len(calls) == 1
+    assert all(r == results[0] for r in results)
+    assert animethemes_cache.coalesced >= 9
+
+    asyncio.run(fetch_anisong_list("OP", 3, client=clients.animethemes))
+    assert len(calls) == 1
+    animethemes_cache.clear()
+
+def test_ttl_cache_lru_and_byte_bound():
+    cache = AsyncTTLCache(ttl=60, max_entries=2, max_bytes=100)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") == (False, None)
+    assert cache.get("a") == (True, 1)
+
+    cache.set("big", "x" * 98)
+    assert len(cache) == 1 and cache.size == 100
+
+    cache.ttl = 0
+    cache.set("d", 4)
+    assert cache.get("d") == (False, None)
+
+def test_ttl_cache_errors_reach_every_waiter_and_are_not_cached():
+    cache = AsyncTTLCache(ttl=60)
+    loads = []
+
+    async def failing():
+        loads.append(1)
+        await asyncio.sleep(0.01)
+        raise httpx.ConnectError("down")
+
+    async def burst():
+        return await asyncio.gather(*[cache.get_or_load("k", failing) for _ in range(3)], return_exceptions=True)
+
+    results = asyncio.run(burst())
+    assert len(loads) == 1
+    assert all(isinstance(r, httpx.ConnectError) for r in results)
+    assert cache.get("k") == (False, None)
+
+def test_make_key_normalizes_text():
+    assert make_key("name", " Guilty  CROWN ", 5) == make_key("name", "guilty crown", 5)
+
+def spotify_token_transport(calls, search_status=None, expires_in=3600):
+    async def handler(request):
+        if request.url.host == "accounts.spotify.com":
+            calls.append("token")
+            await asyncio.sleep(0.02)
+            return httpx.Response(200, json={"access_token": f"tok{len(calls)}", "expires_in": expires_in})
+        if search_status and request.headers["Authorization"] == "Bearer tok1":
+            return httpx.Response(search_status)
+        return fake_upstream_handler(request)
+    return httpx.MockTransport(handler)
+
+def test_spotify_token_refresh_is_serialized():
+    calls = []
+    manager = SpotifyTokenManager("id", "secret")
+    client = UpstreamClients(transport=spotify_token_transport(calls)).spotify
+
+    async def burst():
+        return await asyncio.gather(*[manager.get_token(client) for _ in range(20)])
+
+    tokens = asyncio.run(burst())
+    assert calls == ["token"]
+    assert set(tokens) == {"tok1"}
+    assert manager.metrics()["refresh_count"] == 1
+    assert manager.metrics()["last_refresh_latency"] > 0
+
+def test_spotify_token_background_refresh():
+    calls = []
+    manager = SpotifyTokenManager("id", "secret")
+    client = UpstreamClients(transport=spotify_token_transport(calls, expires_in=0.4)).spotify
+
+    async def run():
+        manager.start(client)
+        await asyncio.sleep(0.05)
+        first = await manager.get_token(client)
+        await asyncio.sleep(0.2)
+        second = await manager.get_token(client)
+        await manager.stop()
+        return first, second
+
+    first, second = asyncio.run(run())
+    # the second token was fetched ahead of expiry by the background task, not by get_token
+    assert (first, second) == ("tok1", "tok2")
+    assert calls == ["token", "token"]
+    assert manager._task is None
+
+def test_spotify_search_retries_401_with_fresh_token(monkeypatch, memory_cache):
+    from src.services import spotify_services
+    calls = []
+    manager = SpotifyTokenManager("id", "secret")
+    monkeypatch.setattr(spotify_services, "spotify_tokens", manager)
+    client = UpstreamClients(transport=spotify_token_transport(calls, search_status=401)).spotify
+
+    result = asyncio.run(spotify_services.search_spotify("My Dearest", "supercell", client=client))
+    assert result["popularity"] == 50
+    assert calls == ["token", "token"]
+
+def spotify_strategy_transport(calls, delays, hits, statuses=(200, 200, 200)):
+    # hits/delays/statuses are indexed by query priority: 0 = track+artist, 1 = track, 2 = title+anime
+    async def handler(request):
+        if request.url.host == "accounts.spotify.com":
+            return httpx.Response(200, json={"access_token": "tok", "expires_in": 3600})
+        q = request.url.params["q"]
+        priority = 0 if "artist:" in q else 1 if q.startswith("track:") else 2
+        calls.append(priority)
+        await asyncio.sleep(delays[priority])
+        if statuses[priority] != 200:
+            return httpx.Response(statuses[priority])
+        items = [{
+            "external_urls": {"spotify": f"https://open.spotify.com/track/{priority}"},
+            "name": "t",
+            "artists": [{"name": "a"}],
+            "popularity": priority
+        }] if hits[priority] else []
+        return httpx.Response(200, json={"tracks": {"items": items}})
+    return httpx.MockTransport(handler)
+
+def run_strategy(monkeypatch, strategy, delays, hits, statuses=(200, 200, 200)):
+    from src.services import spotify_services
+    monkeypatch.setattr(spotify_services, "spotify_tokens", SpotifyTokenManager("id", "secret"))
+    monkeypatch.setattr(enrichment_cache, "_cache", EnrichmentCache(engine=memory_engine()))
+    monkeypatch.setattr(spotify_services, "strategy_stats", {s: spotify_services.StrategyStats() for s in spotify_services.SPOTIFY_STRATEGIES})
+    calls = []
+    client = UpstreamClients(transport=spotify_strategy_transport(calls, delays, hits, statuses)).spotify
+    result = asyncio.run(spotify_services.search_spotify("t", "a", "anime", client=client, strategy=strategy))
+    return result, calls, spotify_services.spotify_strategy_stats()[strategy]
+
+def test_spotify_sequential_strategy(monkeypatch):
+    result, calls, stats = run_strategy(monkeypatch, "sequential", [0, 0, 0], [False, False, True])
+    assert result["popularity"] == 2
+    assert calls == [0, 1, 2]
+    assert stats["searches"] == 1 and stats["requests_per_search"] == 3
+
+def test_spotify_strategy_metrics_exported(monkeypatch, client):
+    from src.utils.metrics import spotify_search_requests, spotify_search_seconds
+    hits = spotify_search_seconds.count("sequential", "hit")
+    requests = spotify_search_requests.value("sequential")
+
+    run_strategy(monkeypatch, "sequential", [0, 0, 0], [False, True, True])
+
+    assert spotify_search_seconds.count("sequential", "hit") == hits + 1
+    assert spotify_search_requests.value("sequential") == requests + 2
+    body = client.get("/metrics").text
+    assert 'spotify_search_duration_seconds_count{strategy="sequential",outcome="hit"}' in body
+    assert 'spotify_search_requests_total{strategy="sequential"}' in body
+
+def test_spotify_parallel_strategy_prefers_priority(monkeypatch):
+    result, calls, _ = run_strategy(monkeypatch, "parallel", [0.05, 0, 0], [True, True, True])
+    assert result["popularity"] == 0
+    assert sorted(calls) == [0, 1, 2]
+
+def test_spotify_hedged_strategy_only_hedges_slow_queries(monkeypatch):
+    from src.services import spotify_services
+    monkeypatch.setattr(spotify_services, "SPOTIFY_HEDGE_DELAY", 0.02)
+
+    result, calls, _ = run_strategy(monkeypatch, "hedged", [0, 0, 0], [True, True, True])
+    assert result["popularity"] == 0 and calls == [0]
+
+    result, calls, _ = run_strategy(monkeypatch, "hedged", [0.2, 0, 0], [False, True, True])
+    assert result["popularity"] == 1
+    assert calls[:2] == [0, 1]
+
+def test_spotify_miss_not_cached_after_upstream_error(monkeypatch):
+    result, calls, _ = run_strategy(monkeypatch, "parallel", [0, 0, 0], [False, False, False], statuses=(429, 200, 200))
+    assert result is None and sorted(calls) == [0, 1, 2]
+    cache = enrichment_cache._cache
+    key = make_cache_key("t", "a", "anime")
+    assert cache.peek("spotify", key) == (False, None)
+    assert cache.get("spotify", key) == (False, None)
+
+    # every query answered and none matched, that miss is remembered
+    run_strategy(monkeypatch, "parallel", [0, 0, 0], [False, False, False])
+    assert enrichment_cache._cache.peek("spotify", key) == (True, None)
+
+def catalog_transport(calls, delay=0.05):
+    async def handler(request):
+        path = request.url.path
+        if request.url.host == "api.animethemes.moe":
+            calls.append(path)
+            await asyncio.sleep(delay)
+            name = request.url.params.get("filter[name]")
+            if path == "/anime" and name == "Guilty Crown":
+                return httpx.Response(200, json={"anime": [{"name": "Guilty Crown", "animethemes": [
+                    {"type": "OP", "song": {"title": "My Dearest", "artists": [{"name": "supercell"}]}},
+                    {"type": "ED", "song": {"title": "Departures", "artists": [{"name": "EGOIST"}]}}
+                ]}]})
+            if path == "/artist" and name == "EGOIST":
+                return httpx.Response(200, json={"artists": [{"name": "EGOIST", "songs": [
+                    {"title": "Departures", "animethemes": [{"type": "ED", "anime": {"name": "Guilty Crown"}}]}
+                ]}]})
+            if path == "/animetheme":
+                return fake_upstream_handler(request)
+            return httpx.Response(200, json={"anime": [], "artists": []})
+        return fake_upstream_handler(request)
+    return httpx.MockTransport(handler)
+
+def test_search_and_resolve_runs_queries_concurrently(monkeypatch, memory_cache):
+    from src.utils import sqlite
+    monkeypatch.setattr(sqlite, "engine", memory_cache.engine)
+    from src.services.anisong_services import search_and_resolve_anisong
+    animethemes_cache.clear()
+    calls = []
+    clients = UpstreamClients(transport=catalog_transport(calls))
+
+    async def run():
+        started = asyncio.get_running_loop().time()
+        songs = await search_and_resolve_anisong(["Guilty Crown", "EGOIST", "OP"], 1, clients=clients)
+        return songs, asyncio.get_running_loop().time() - started
+
+    songs, elapsed = asyncio.run(run())
+    titles = [(song["song_title"], song["anime"]) for song in songs]
+
+    # Departures comes back from both the name and the artist query but is resolved once
+    assert titles.count(("Departures", "Guilty Crown")) == 1
+    assert ("My Dearest", "Guilty Crown") in titles
+    assert len(songs) == 2
+    assert all(song["youtube_url"] for song in songs)
+    # 3 queries x up to 3 fallbacks, all in flight together: about one round trip, not nine
+    assert elapsed < 0.3
+    animethemes_cache.clear()
+
+def test_search_and_resolve_applies_limit(monkeypatch, memory_cache):
+    from src.utils import sqlite
+    monkeypatch.setattr(sqlite, "engine", memory_cache.engine)
+    from src.services.anisong_services import search_and_resolve_anisong
+    animethemes_cache.clear()
+    clients = UpstreamClients(transport=catalog_transport([]))
+
+    songs = asyncio.run(search_and_resolve_anisong(["Guilty Crown", "EGOIST", "OP"], 1, limit=1, clients=clients))
+
+    assert len(songs) == 1
+    animethemes_cache.clear()
+
+def test_fetch_anisong_any_prefers_priority_order():
+    from src.services.anisong_services import fetch_anisong_any
+    animethemes_cache.clear()
+    calls = []
+    client = UpstreamClients(transport=catalog_transport(calls, delay=0)).animethemes
+
+    assert asyncio.run(fetch_anisong_any("EGOIST", client=client))[0]["theme_type"] == "ED"
+    assert asyncio.run(fetch_anisong_any("nothing", client=client)) == []
+    assert "/anime" in calls and "/artist" in calls
+    animethemes_cache.clear()
+
+def test_save_search_results_upserts_in_one_transaction():
+    from sqlalchemy import event
+    from src.models.user_model import UserHistory
+    from src.services.anisong_services import save_search_results
+    session = setup_db()
+    commits = []
+    event.listen(session.get_bind(), "commit", lambda conn: commits.append(1))
+
+    songs = [
+        {"anime": "Guilty Crown", "song_title": "My Dearest", "artists": ["supercell"],
+         "youtube_url": "https://www.youtube.com/watch?v=abc",
+         "spotify_url": {"spotify_url": "https://open.spotify.com/track/1", "popularity": 50}},
+        {"anime": "Guilty Crown", "song_title": "Departures", "artists": ["EGOIST"],
+         "youtube_url": None, "spotify_url": None}
+    ]
+    first = save_search_results(session, songs, 1)
+    assert len(commits) == 1
+
+    songs[0]["youtube_url"] = None
+    songs[1]["youtube_url"] = "https://www.youtube.com/watch?v=dep"
+    second = save_search_results(session, songs, 1)
+    assert first == second
+
+    rows = {song.title: song for song in session.exec(select(AnisongDB)).all()}
+    assert len(rows) == 2
+    # an empty lookup never wipes a link that was already stored
+    assert rows["My Dearest"].youtube_url == "https://www.youtube.com/watch?v=abc"
+    assert rows["My Dearest"].spotify_popularity == 50
+    assert rows["Departures"].youtube_url == "https://www.youtube.com/watch?v=dep"
+    assert len(session.exec(select(UserHistory)).all()) == 4
+
+def test_search_route_writes_each_song_once(client, fake_clients):
+    from src.models.user_model import UserHistory
+    from src.utils.sqlite import engine
+    headers = register_and_login(client)
+    with Session(engine) as session:
+        before = len(session.exec(select(UserHistory)).all())
+
+    r = client.post("/anisong/search", params=[("q", "OP")], headers=headers)
+    assert r.status_code == 200
+    with Session(engine) as session:
+        assert len(session.exec(select(UserHistory)).all()) - before == len(r.json())
+
+def test_preference_deltas_are_aggregated_and_upserted():
+    from src.services.preferences_service import aggregate_preference_deltas, apply_preference_deltas, get_user_preferences
+    session = setup_db()
+    songs = [
+        {"anime": "Guilty Crown", "artists": ["supercell"]},
+        {"anime": "Guilty Crown", "artists": ["EGOIST"]},
+        {"anime": None, "artists": []}
+    ]
+    deltas = aggregate_preference_deltas(songs)
+    assert deltas == {"Guilty Crown": 2, "supercell": 1, "EGOIST": 1, "Unknown": 1}
+
+    apply_preference_deltas(session, 1, deltas)
+    apply_preference_deltas(session, 1, {"EGOIST": 2.5})
+    weights = {pref.tag: pref.weight for pref in get_user_preferences(session, 1)}
+    assert weights == {"Guilty Crown": 2, "supercell": 1, "EGOIST": 3.5, "Unknown": 1}
+
+def test_add_preference_replaces_weight():
+    from src.services.preferences_service import add_preference, get_user_preferences
+    session = setup_db()
+    add_preference(session, 1, "K-On!", 2.0)
+    pref = add_preference(session, 1, "K-On!", 5.0)
+    assert pref.weight == 5.0
+    assert len(get_user_preferences(session, 1)) == 1
+
+def test_create_db_merges_duplicate_preferences(monkeypatch, tmp_path):
+    from src.utils import sqlite
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as connection:
+        connection.exec_driver_sql("CREATE TABLE userpreference (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, tag VARCHAR NOT NULL, weight FLOAT NOT NULL)")
+        connection.exec_driver_sql("INSERT INTO userpreference (user_id, tag, weight) VALUES (1, 'a', 1), (1, 'a', 2), (1, 'b', 1), (2, 'a', 4)")
+
+    monkeypatch.setattr(sqlite, "engine", engine)
+    sqlite.create_db_and_tables()
+    with engine.connect() as connection:
+        rows = connection.exec_driver_sql("SELECT user_id, tag, weight FROM userpreference ORDER BY user_id, tag").fetchall()
+    assert [tuple(row) for row in rows] == [(1, "a", 3.0), (1, "b", 1.0), (2, "a", 4.0)]
+
+def test_create_db_merges_duplicate_anisongs(monkeypatch, tmp_path):
+    from src.utils import sqlite
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as connection:
+        connection.exec_driver_sql("CREATE TABLE anisongdb (id INTEGER PRIMARY KEY, title VARCHAR NOT NULL, artist VARCHAR NOT NULL, anime VARCHAR, spotify_url VARCHAR, spotify_popularity INTEGER, youtube_url VARCHAR)")
+        connection.exec_driver_sql("CREATE TABLE userhistory (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, song_id INTEGER NOT NULL, score FLOAT NOT NULL)")
+        connection.exec_driver_sql("""
+            INSERT INTO anisongdb (title, artist, anime, spotify_url, spotify_popularity, youtube_url) VALUES
+            ('Departures', 'EGOIST', NULL, NULL, 0, 'yt:1'),
+            ('Departures', 'EGOIST', 'Guilty Crown', 'sp:1', 40, NULL),
+            ('My Dearest', 'supercell', 'Guilty Crown', NULL, 0, NULL)
+        """)
+        connection.exec_driver_sql("INSERT INTO userhistory (user_id, song_id, score) VALUES (1, 2, 1), (1, 3, 1)")
+
+    monkeypatch.setattr(sqlite, "engine", engine)
+    sqlite.create_db_and_tables()
+    with engine.connect() as connection:
+        songs = connection.exec_driver_sql("SELECT id, title, anime, spotify_url, spotify_popularity, youtube_url FROM anisongdb ORDER BY id").fetchall()
+        history = connection.exec_driver_sql("SELECT song_id FROM userhistory ORDER BY id").fetchall()
+    assert [tuple(row) for row in songs] == [
+        (1, "Departures", "Guilty Crown", "sp:1", 40, "yt:1"),
+        (3, "My Dearest", "Guilty Crown", None, 0, None)
+    ]
+    assert [row[0] for row in history] == [1, 3]
+
+def test_sqlite_engine_is_tuned():
+    engine = memory_engine()
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert connection.exec_driver_sql("PRAGMA synchronous").scalar() == 1
+        assert connection.exec_driver_sql("PRAGMA busy_timeout").scalar() == 5000
+
+def test_db_writes_do_not_stall_event_loop(monkeypatch):
+    from src.utils import sqlite
+    from src.services.preferences_service import apply_preference_deltas
+    monkeypatch.setattr(sqlite, "engine", memory_engine())
+
+    def slow_write(session, user_id, deltas):
+        apply_preference_deltas(session, user_id, deltas)
+        # stands in for a slow fsync or a writer waiting on the busy timeout
+        time.sleep(0.2)
+
+    async def run():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        await sqlite.run_db(slow_write, 1, {"EGOIST": 1})
+        task.cancel()
+        return ticks
+
+    assert asyncio.run(run()) >= 10
+    with Session(sqlite.engine) as session:
+        assert session.exec(select(UserPreference)).one().weight == 1
+
+def test_password_pool_hashes_in_worker_process():
+    from src.services.auth_services import BCRYPT_ROUNDS, PasswordPool, hash_password, verify_password
+    pool = PasswordPool(workers=1, limit=4)
+
+    async def run():
+        hashed = await pool.run(hash_password, "pw")
+        return hashed, await pool.run(verify_password, "pw", hashed)
+
+    try:
+        hashed, valid = asyncio.run(run())
+    finally:
+        pool.shutdown()
+    assert valid
+    assert hashed.split("$")[2] == f"{BCRYPT_ROUNDS:02d}"
+
+def test_login_overload_returns_503(client, monkeypatch):
+    from src.services.auth_services import password_pool
+    client.post("/auth/register", json={"username": "busy", "password": "pw"})
+    monkeypatch.setattr(password_pool, "limit", 0)
+    r = client.post("/auth/login", json={"username": "busy", "password": "pw"})
+    assert r.status_code == 503
+    assert r.headers["Retry-After"] == "1"
+
+def test_token_cache_skips_decode_on_hit(monkeypatch):
+    from src.services import auth_services
+    from src.models.user_model import Principal
+    monkeypatch.setattr(auth_services, "token_cache", auth_services.TokenCache(max_entries=8))
+    token = auth_services.create_token(7)
+    calls = []
+    decode = auth_services.decode_token
+    monkeypatch.setattr(auth_services, "decode_token", lambda t: calls.append(t) or decode(t))
+
+    first = auth_services.authenticate(token)
+    second = auth_services.authenticate(token)
+    assert first == second
+    assert isinstance(first, Principal) and first.user_id == 7
+    assert len(calls) == 1
+    assert auth_services.token_cache.hits == 1
+
+def test_token_cache_expires_at_token_exp(monkeypatch):
+    from src.services.auth_services import TokenCache
+    from src.models.user_model import Principal
+    cache = TokenCache(max_entries=8)
+    cache.put(b"live", Principal(user_id=1, expires_at=int(time.time()) + 60))
+    cache.put(b"dead", Principal(user_id=2, expires_at=int(time.time()) - 1))
+    assert cache.get(b"live").user_id == 1
+    assert cache.get(b"dead") is None
+    assert len(cache._entries) == 1
+
+def test_token_cache_is_bounded():
+    from src.services.auth_services import TokenCache
+    from src.models.user_model import Principal
+    cache = TokenCache(max_entries=2)
+    expires = int(time.time()) + 60
+    for i in range(3):
+        cache.put(bytes([i]), Principal(user_id=i, expires_at=expires))
+    assert cache.get(bytes([0])) is None
+    assert cache.get(bytes([2])).user_id == 2
+
+def test_protected_route_uses_cached_principal(client):
+    from src.services.auth_services import token_cache
+    headers = register_and_login(client)
+    token_cache.clear()
+    hits = token_cache.hits
+    assert client.get("/preferences/", headers=headers).status_code == 200
+    assert client.get("/preferences/", headers=headers).status_code == 200
+    assert token_cache.hits == hits + 1
+
+def catalog_pages(calls):
+    # two pages of /animetheme, newest first, the way the ingest asks for them
+    pages = {
+        "1": {"animethemes": [
+            {"id": 11, "type": "OP", "sequence": 1, "updated_at": "2024-03-01T00:00:00Z",
+             "anime": {"id": 1, "name": "Guilty Crown", "year": 2011, "season": "Fall", "updated_at": "2024-01-01T00:00:00Z"},
+             "song": {"id": 101, "title": "My Dearest", "updated_at": "2024-01-01T00:00:00Z",
+                      "artists": [{"id": 201, "name": "supercell", "updated_at": "2024-01-01T00:00:00Z"}]}}
+        ], "links": {"next": "https://api.animethemes.moe/animetheme?page[number]=2"}},
+        "2": {"animethemes": [
+            {"id": 12, "type": "ED", "sequence": 1, "updated_at": "2024-02-01T00:00:00Z",
+             "anime": {"id": 1, "name": "Guilty Crown", "year": 2011, "season": "Fall", "updated_at": "2024-01-01T00:00:00Z"},
+             "song": {"id": 102, "title": "Departures", "updated_at": "2024-01-01T00:00:00Z",
+                      "artists": [{"id": 202, "name": "EGOIST", "updated_at": "2024-01-01T00:00:00Z"}]}}
+        ], "links": {"next": None}}
+    }
+
+    def handler(request):
+        calls.append(str(request.url))
+        return httpx.Response(200, json=pages[request.url.params.get("page[number]", "1")])
+    return httpx.MockTransport(handler)
+
+def test_catalog_ingest_resumes_and_is_incremental(monkeypatch):
+    from src.utils import sqlite
+    from src.services.catalog_service import ingest_resource
+    from src.models.catalog_model import CatalogSongArtist, CatalogSyncState, CatalogTheme
+    monkeypatch.setattr(sqlite, "engine", memory_engine())
+    calls = []
+
+    async def run(**kwargs):
+        async with httpx.AsyncClient(transport=catalog_pages(calls)) as c:
+            return await ingest_resource("animetheme", c, delay=0, **kwargs)
+
+    first = asyncio.run(run(max_pages=1))
+    assert first["complete"] is False
+    second = asyncio.run(run())
+    assert second["complete"] is True
+    assert "page[number]=2" in calls[1]
+
+    with Session(sqlite.engine) as session:
+        assert len(session.exec(select(CatalogTheme)).all()) == 2
+        assert len(session.exec(select(CatalogSongArtist)).all()) == 2
+        state = session.get(CatalogSyncState, "animetheme")
+        assert state.synced_until == "2024-03-01T00:00:00Z"
+        assert state.next_url is None
+
+    # nothing changed upstream, the next run stops after the first page
+    calls.clear()
+    asyncio.run(run())
+    assert len(calls) == 1
+
+def test_local_first_fetch_skips_upstream(monkeypatch, tmp_path):
+    import json
+    from src.utils import sqlite
+    from src.services import catalog_service
+    from src.services.anisong_services import fetch_anisong_name
+    monkeypatch.setattr(sqlite, "engine", memory_engine())
+    monkeypatch.setattr(catalog_service, "CATALOG_MODE", "local-first")
+    animethemes_cache.clear()
+
+    dump = tmp_path / "catalog.json"
+    dump.write_text(json.dumps({"anime": [{"id": 1, "name": "Guilty Crown", "year": 2011, "season": "Fall", "animethemes": [
+        {"id": 11, "type": "OP", "sequence": 1, "song": {"id": 101, "title": "My Dearest", "artists": [{"id": 201, "name": "supercell"}]}},
+        {"id": 12, "type": "ED", "sequence": 1, "song": {"id": 102, "title": "Departures", "artists": [{"id": 202, "name": "EGOIST"}]}}
+    ]}]}))
+    with Session(sqlite.engine) as session:
+        assert catalog_service.load_dump(session, str(dump))["animethemes"] == 2
+
+    calls = []
+
+    async def run():
+        async with httpx.AsyncClient(transport=catalog_transport(calls, delay=0)) as c:
+            local = await fetch_anisong_name("guilty  crown", client=c)
+            artist = await fetch_anisong_artist("EGOIST", client=c)
+            season = await fetch_anisong_criteria(season="fall", client=c)
+            missing = await fetch_anisong_name("Unknown Show", client=c)
+            return local, artist, season, missing
+
+    local, artist, season, missing = asyncio.run(run())
+    assert [song["song_title"] for song in local] == ["My Dearest", "Departures"]
+    assert local[0]["artists"] == ["supercell"]
+    assert artist == [{"anime": "Guilty Crown", "song_title": "Departures", "artists": ["EGOIST"], "theme_type": "ED", "year": 2011, "season": "Fall"}]
+    assert len(season) == 2
+    assert missing == []
+    # only the miss went upstream
+    assert calls == ["/anime"]
+
+def search_index_session():
+    from src.services.search_index import index_names
+    session = Session(memory_engine())
+    index_names(session, [
+        ("anime", "Shingeki no Kyojin"), ("anime", "Guilty Crown"), ("anime", "Guilty Gear"),
+        ("song", "My Dearest"), ("artist", "supercell"), ("artist", "EGOIST"), ("anime", "Guilty Crown")
+    ])
+    session.commit()
+    return session
+
+def test_search_index_folds_case_accents_and_romaji():
+    from src.services.search_index import fold
+    assert fold("Shingeki no Kyōjin!") == fold("shingeki  no KYOUJIN") == "shingeki no kyojin"
+
+def test_suggest_prefix_and_typo():
+    from src.services.search_index import suggest
+    session = search_index_session()
+    prefix = suggest(session, "guil")
+    assert {r["name"] for r in prefix[:2]} == {"Guilty Crown", "Guilty Gear"}
+    assert suggest(session, "egoist", kind="anime") == []
+    assert suggest(session, "supercel")[0]["name"] == "supercell"
+    assert suggest(session, "shingeki no kyoujin")[0]["name"] == "Shingeki no Kyojin"
+
+def test_best_match_needs_a_close_name():
+    from src.services.search_index import best_match
+    session = search_index_session()
+    assert best_match(session, "guilty crwn") == ("anime", "Guilty Crown")
+    assert best_match(session, "EGOIST") == ("artist", "EGOIST")
+    assert best_match(session, "guilty") is None
+    assert best_match(session, "naruto") is None
+
+def test_suggest_route(client):
+    from src.utils import sqlite
+    from src.services.search_index import index_names
+    with Session(sqlite.engine) as session:
+        index_names(session, [("anime", "Guilty Crown")])
+        session.commit()
+    r = client.get("/anisong/suggest", params={"q": "guilty crow"})
+    assert r.status_code == 200
+    assert r.json()["results"][0] == {"kind": "anime", "name": "Guilty Crown", "score": r.json()["results"][0]["score"]}
+
+def test_search_resolves_typo_through_index(monkeypatch, memory_cache):
+    from src.utils import sqlite
+    from src.services.search_index import index_names
+    from src.services.anisong_services import search_query
+    monkeypatch.setattr(sqlite, "engine", memory_cache.engine)
+    with Session(memory_cache.engine) as session:
+        index_names(session, [("anime", "Guilty Crown")])
+        session.commit()
+    animethemes_cache.clear()
+    calls = []
+
+    async def run():
+        async with httpx.AsyncClient(transport=catalog_transport(calls, delay=0)) as c:
+            return await search_query("guilty crwn", client=c)
+
+    songs = asyncio.run(run())
+    assert [song["song_title"] for song in songs] == ["My Dearest", "Departures"]
+    assert calls == ["/anime"]
+
+def test_recommendation_index_scores_by_preferences():
+    from src.services.recommendation_service import RecommendationIndex
+    index = RecommendationIndex()
+    index.extend([(1, "supercell", "Guilty Crown", 10), (2, "EGOIST", "Guilty Crown", 90)])
+    index.extend([(3, "LiSA", "Demon Slayer", 100), (4, "EGOIST", None, 0)])
+    assert len(index) == 4 and index.max_id == 4
+
+    ids, scores = index.top_k({"egoist": 5, "Guilty Crown": 2}, 3)
+    assert ids == [2, 4, 1]
+    assert scores[0] > scores[1] > scores[2]
+    # without preferences popularity decides
+    assert index.top_k({}, 2)[0] == [3, 2]
+    assert index.top_k({"EGOIST": 1}, 10, exclude=[2, 99])[0][0] == 4
+
+def test_recommendation_index_follows_upserted_rows(monkeypatch):
+    from src.services import recommendation_service
+    from src.services.anisong_services import upsert_anisongs
+    index = recommendation_service.RecommendationIndex()
+    monkeypatch.setattr(recommendation_service, "recommendation_index", index)
+    row = {"title": "Departures", "artist": "EGOIST", "anime": None, "spotify_url": None, "spotify_popularity": None, "youtube_url": None}
+    engine = memory_engine()
+    with Session(engine) as session:
+        upsert_anisongs(session, [row, {**row, "title": "Other", "artist": "Other Artist", "spotify_popularity": 50}])
+        session.commit()
+        index.refresh(session)
+        assert index.top_k({}, 1)[0] == [2]
+
+        # the same song found again, now with its Spotify match and anime
+        upsert_anisongs(session, [{**row, "anime": "Guilty Crown", "spotify_popularity": 90}])
+        session.rollback()
+        index.refresh(session)
+        assert index.top_k({}, 1)[0] == [2]
+
+        upsert_anisongs(session, [{**row, "anime": "Guilty Crown", "spotify_popularity": 90}])
+        session.commit()
+        index.refresh(session)
+    assert len(index) == 2
+    assert index.top_k({}, 1)[0] == [1]
+    assert index.top_k({"Guilty Crown": 1}, 2)[0] == [1, 2]
+
+def test_recommendations_route(client):
+    headers = register_and_login(client)
+    from src.utils import sqlite
+    from src.services.anisong_services import upsert_anisongs
+    from src.services.recommendation_service import recommendation_index
+    with Session(sqlite.engine) as session:
+        upsert_anisongs(session, [
+            {"title": "Rec Song A", "artist": "Rec Artist", "anime": "Rec Anime", "spotify_url": None, "spotify_popularity": 1, "youtube_url": None},
+            {"title": "Rec Song B", "artist": "Other Artist", "anime": "Other Anime", "spotify_url": None, "spotify_popularity": 1, "youtube_url": None}
+        ])
+        session.commit()
+    client.post("/preferences/", params={"tag": "Rec Artist", "weight": 1e9}, headers=headers)
+
+    r = client.get("/recommendations/", params={"limit": 1}, headers=headers)
+    assert r.status_code == 200
+    assert r.json()["results"][0]["title"] == "Rec Song A"
+    assert len(recommendation_index) > 0
+    assert client.get("/recommendations/").status_code == 401
+
+def history_engine(rows):
+    from src.models.user_model import UserHistory
+    engine = memory_engine()
+    with Session(engine) as session:
+        session.add_all([UserHistory(user_id=user_id, song_id=song_id, score=1.0) for user_id, song_id in rows])
+        session.commit()
+    return engine
+
+def test_similarity_model_incremental_matches_full_build(tmp_path):
+    import numpy as np
+    from src.models.user_model import UserHistory
+    from src.services.similarity_service import SimilarityModel, read_model, update_model, write_model
+    engine = history_engine([(1, 10), (1, 20), (1, 30), (2, 10), (2, 20), (3, 10), (3, 40), (3, 10)])
+
+    with Session(engine) as session:
+        model = update_model(session, SimilarityModel())
+        neighbors, scores = model.neighbors_of(20)
+        assert neighbors[0] == 10
+        # 10 and 20 were searched together by 2 of the 3 users of 10 and both users of 20
+        assert abs(scores[0] - 2 / (3 * 2) ** 0.5) < 1e-6
+        assert update_model(session, model) is model
+
+        session.add_all([UserHistory(user_id=3, song_id=20, score=1.0), UserHistory(user_id=4, song_id=40, score=1.0)])
+        session.commit()
+        incremental = update_model(session, model)
+        full = update_model(session, SimilarityModel())
+
+    for name in full.arrays:
+        assert np.array_equal(incremental.arrays[name], full.arrays[name])
+
+    path = str(tmp_path / "model.bin")
+    write_model(incremental, path)
+    mapped = read_model(path)
+    assert isinstance(mapped.arrays["scores"].base, np.memmap)
+    assert mapped.max_history_id == incremental.max_history_id
+    assert mapped.neighbors_of(10) == incremental.neighbors_of(10)
+    assert mapped.also_searched([40], 5, exclude=[40]) == incremental.also_searched([40], 5, exclude=[40])
+
+def test_similar_route(client, monkeypatch, tmp_path):
+    from src.utils import sqlite
+    from src.services import similarity_service
+    from src.services.anisong_services import upsert_anisongs
+    from src.models.user_model import UserHistory
+    with Session(sqlite.engine) as session:
+        ids = upsert_anisongs(session, [
+            {"title": f"Sim Song {i}", "artist": "Sim Artist", "anime": "Sim Anime", "spotify_url": None, "spotify_popularity": 0, "youtube_url": None}
+            for i in range(3)
+        ])
+        first, second, third = (ids[(f"Sim Song {i}", "Sim Artist")] for i in range(3))
+        session.add_all([UserHistory(user_id=1, song_id=song_id, score=1.0) for song_id in (first, second)])
+        session.commit()
+
+    store = similarity_service.SimilarityStore(str(tmp_path / "model.bin"))
+    monkeypatch.setattr(similarity_service, "similarity_store", store)
+    with Session(sqlite.engine) as session:
+        store.refresh(session, full=True)
+
+    r = client.get(f"/anisong/{first}/similar")
+    assert r.status_code == 200
+    assert second in [song["id"] for song in r.json()["results"]]
+    assert client.get(f"/anisong/{third}/similar").json() == {"count": 0, "results": []}
+    assert client.get("/anisong/999999999/similar").status_code == 404
+
+    headers = register_and_login(client)
+    r = client.get("/recommendations/", params={"mode": "also_searched"}, headers=headers)
+    assert r.status_code == 200
+
+def test_recommendation_cache_debounces_and_serves_stale(monkeypatch):
+    from src.utils import sqlite
+    from src.services import recommendation_cache as cache_module
+    monkeypatch.setattr(sqlite, "engine", memory_engine())
+    computed = []
+
+    def fake_recommend(session, user_id, limit, exclude_seen):
+        computed.append(user_id)
+        return [{"id": len(computed)}]
+
+    monkeypatch.setitem(cache_module.MODES, "preferences", fake_recommend)
+    cache = cache_module.RecommendationCache(debounce=0.05)
+
+    async def run():
+        first = await cache.get(1)
+        again = await cache.get(1)
+        for _ in range(3):
+            with Session(sqlite.engine) as session:
+                cache.invalidate(session, 1)
+                session.commit()
+        stale = await cache.get(1)
+        await asyncio.sleep(0.2)
+        fresh = await cache.get(1)
+        return first, again, stale, fresh
+
+    first, again, stale, fresh = asyncio.run(run())
+    assert first == again == stale == [{"id": 1}]
+    assert fresh == [{"id": 2}]
+    # three changes in a burst, one recompute
+    assert len(computed) == 2
+    assert (cache.misses, cache.stale_hits, cache.hits) == (1, 1, 2)
+
+    # a new worker starts from the persisted rows, a stale row is served and refreshed
+    restarted = cache_module.RecommendationCache(debounce=0.05)
+    assert asyncio.run(restarted.get(1)) == [{"id": 2}]
+    assert len(computed) == 2 and restarted.hits == 1
+    with Session(sqlite.engine) as session:
+        restarted.invalidate(session, 1)
+        session.commit()
+    other = cache_module.RecommendationCache(debounce=0.05)
+    assert asyncio.run(other.get(1)) == [{"id": 2}]
+    assert other.stale_hits == 1
+
+def test_enrich_songs_as_completed_yields_fastest_first(monkeypatch):
+    from src.services import enrichment_service
+    delays = {"slow": 0.2, "fast": 0.01}
+
+    async def fake_youtube(query, client=None, title=None, artist=None, anime=None):
+        await asyncio.sleep(delays[title])
+        return f"yt:{title}"
+
+    monkeypatch.setattr(enrichment_service, "search_youtube", fake_youtube)
+    songs = [{"song_title": "slow", "artists": ["a"]}, {"song_title": "fast", "artists": ["b"]}]
+
+    async def run():
+        return [item async for item in enrichment_service.enrich_songs_as_completed(songs, provider="youtube", clients=UpstreamClients())]
+
+    results = asyncio.run(run())
+    assert [index for index, _ in results] == [1, 0]
+    assert results[0][1]["youtube_url"] == "yt:fast"
+
+def test_themes_streams_ndjson(client, fake_clients):
+    import json
+    r = client.get("/anisong/themes", params={"theme_type": "OP", "limit": 2}, headers={"Accept": "application/x-ndjson"})
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("application/x-ndjson")
+    frames = [json.loads(line) for line in r.text.splitlines()]
+    assert [frame["type"] for frame in frames] == ["result", "result", "summary"]
+    assert {frame["song"]["song_title"] for frame in frames[:2]} == {"My Dearest", "Departures"}
+    assert frames[-1]["count"] == 2
+
+    # without the header nothing changes
+    assert client.get("/anisong/themes", params={"theme_type": "OP", "limit": 2}).json()["count"] == 2
+
+def test_search_streams_sse(client, fake_clients):
+    headers = register_and_login(client)
+    headers["Accept"] = "text/event-stream"
+    r = client.post("/anisong/search", params=[("q", "OP")], headers=headers)
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("text/event-stream")
+    events = [block.split("\n")[0] for block in r.text.strip().split("\n\n")]
+    assert events == ["event: result", "event: result", "event: summary"]
+
+def test_search_stream_applies_limit(client, fake_clients):
+    import json
+    headers = register_and_login(client)
+    headers["Accept"] = "application/x-ndjson"
+    r = client.post("/anisong/search", params=[("q", "OP"), ("limit", "1")], headers=headers)
+    frames = [json.loads(line) for line in r.text.splitlines()]
+    assert [frame["type"] for frame in frames] == ["result", "summary"]
+
+def paged_transport(calls, pages=3):
+    # /anime answers page[number] with one anime per page and a links.next until the last page
+    def handler(request):
+        if request.url.host != "api.animethemes.moe":
+            return fake_upstream_handler(request)
+        number = int(request.url.params.get("page[number]", 1))
+        calls.append(number)
+        next_url = None
+        if number < pages:
+            next_url = str(request.url.copy_set_param("page[number]", number + 1))
+        return httpx.Response(200, json={
+            "anime": [{"name": f"Anime {number}", "animethemes": [
+                {"type": "OP", "song": {"title": f"Song {number}", "artists": [{"name": "supercell"}]}}
+            ]}],
+            "links": {"next": next_url}
+        })
+    return httpx.MockTransport(handler)
+
+def test_iter_listing_follows_next_links_and_prefetches():
+    from src.services.anisong_services import iter_listing, listing_url
+    animethemes_cache.clear()
+    calls = []
+    clients = UpstreamClients(transport=paged_transport(calls))
+
+    async def run():
+        songs = iter_listing("criteria", listing_url("criteria", 1, year=2011), clients.animethemes)
+        first = await anext(songs)
+        await asyncio.sleep(0.01)
+        # page 2 is on its way while page 1 is still being consumed
+        requested = list(calls)
+        rest = [song async for song in songs]
+        return first, requested, rest
+
+    first, requested, rest = asyncio.run(run())
+    assert first["song_title"] == "Song 1"
+    assert requested == [1, 2]
+    assert [song["song_title"] for song in rest] == ["Song 2", "Song 3"]
+    assert calls == [1, 2, 3]
+
+def test_criteria_cursor_pagination(client, memory_cache):
+    from src.main import app
+    animethemes_cache.clear()
+    calls = []
+    app.dependency_overrides[get_http_clients] = lambda: UpstreamClients(transport=paged_transport(calls))
+    try:
+        r = client.get("/anisong/criteria", params={"year": 2011, "limit": 1, "paginate": True})
+        assert r.status_code == 200
+        page = r.json()
+        titles = [song["song_title"] for song in page["results"]]
+        while page["next_cursor"]:
+            page = client.get("/anisong/criteria", params={"year": 2011, "limit": 1, "cursor": page["next_cursor"]}).json()
+            titles += [song["song_title"] for song in page["results"]]
+        assert titles == ["Song 1", "Song 2", "Song 3"]
+        # every page after the first was prefetched, none was requested twice
+        assert sorted(calls) == [1, 2, 3]
+
+        assert client.get("/anisong/criteria", params={"cursor": "not a cursor"}).status_code == 400
+        from src.services.anisong_services import encode_cursor
+        foreign = encode_cursor("criteria", "https://example.com/anime?page[number]=2")
+        assert client.get("/anisong/criteria", params={"cursor": foreign}).status_code == 400
+        other_listing = encode_cursor("themes", "https://api.animethemes.moe/anime?page[number]=2")
+        assert client.get("/anisong/criteria", params={"cursor": other_listing}).status_code == 400
+    finally:
+        app.dependency_overrides.pop(get_http_clients, None)
+
+def test_streamed_listing_walks_every_page(client, memory_cache):
+    import json
+    from src.main import app
+    animethemes_cache.clear()
+    app.dependency_overrides[get_http_clients] = lambda: UpstreamClients(transport=paged_transport([], pages=4))
+    try:
+        r = client.get(
+            "/anisong/criteria",
+            params={"year": 2011, "limit": 1, "paginate": True},
+            headers={"Accept": "application/x-ndjson"}
+        )
+        frames = [json.loads(line) for line in r.text.splitlines()]
+        assert frames[-1]["count"] == 4 and frames[-1]["truncated"] is False
+        assert sorted(frame["song"]["song_title"] for frame in frames[:-1]) == ["Song 1", "Song 2", "Song 3", "Song 4"]
+    finally:
+        app.dependency_overrides.pop(get_http_clients, None)
+
+def test_streamed_listing_stops_at_caps(client, memory_cache, monkeypatch):
+    import json
+    from src.main import app
+    from src.routers import anisong
+    animethemes_cache.clear()
+    calls = []
+    app.dependency_overrides[get_http_clients] = lambda: UpstreamClients(transport=paged_transport(calls, pages=4))
+
+    def walk():
+        r = client.get(
+            "/anisong/criteria",
+            params={"year": 2011, "limit": 1, "paginate": True},
+            headers={"Accept": "application/x-ndjson"}
+        )
+        return [json.loads(line) for line in r.text.splitlines()]
+
+    try:
+        monkeypatch.setattr(anisong, "STREAM_MAX_PAGES", 2)
+        frames = walk()
+        assert frames[-1]["count"] == 2 and frames[-1]["truncated"] is True
+        # the page after the cap is not even prefetched
+        assert sorted(calls) == [1, 2]
+
+        monkeypatch.setattr(anisong, "STREAM_MAX_PAGES", 0)
+        monkeypatch.setattr(anisong, "STREAM_MAX_SONGS", 3)
+        frames = walk()
+        assert frames[-1]["count"] == 3 and frames[-1]["truncated"] is True
+    finally:
+        app.dependency_overrides.pop(get_http_clients, None)
+
+def test_job_queue_priorities_retries_and_batched_writes(monkeypatch, memory_cache):
+    from src.utils import sqlite
+    from src.services import enrichment_service
+    from src.services.job_queue import JobQueue, JobQueueFull
+    monkeypatch.setattr(sqlite, "engine", memory_cache.engine)
+    order, attempts = [], {}
+
+    async def fake_youtube(query, client=None, title=None, artist=None, anime=None):
+        attempts[title] = attempts.get(title, 0) + 1
+        order.append(title)
+        if title == "flaky" and attempts[title] == 1:
+            raise httpx.ConnectError("down")
+        return f"yt:{title}"
+
+    monkeypatch.setattr(enrichment_service, "search_youtube", fake_youtube)
+    queue = JobQueue(workers=1, size=4, retry_delay=0.01, flush_interval=60)
+
+    async def run():
+        low = queue.submit([{"song_title": "later", "artists": ["a"]}], "youtube", UpstreamClients(), priority="low")
+        high = queue.submit(
+            [{"song_title": "first", "artists": ["b"]}, {"song_title": "flaky", "artists": ["c"]}],
+            "youtube", UpstreamClients(), priority="high"
+        )
+        try:
+            queue.submit([{"song_title": "x"}] * 2, "youtube", UpstreamClients())
+            full = False
+        except JobQueueFull:
+            full = True
+        followed = [index async for index, _ in high.follow()]
+        while not low.finished:
+            await asyncio.sleep(0.01)
+        await queue.stop()
+        return low, high, full, followed
+
+    low, high, full, followed = asyncio.run(run())
+    assert full
+    # the high priority job runs first, the failed lookup is retried after the low one
+    assert order == ["first", "flaky", "later", "flaky"]
+    assert high.status == low.status == "done"
+    assert sorted(followed) == [0, 1]
+    assert [song["youtube_url"] for song in high.results] == ["yt:first", "yt:flaky"]
+    with Session(memory_cache.engine) as session:
+        titles = set(session.exec(select(AnisongDB.title)).all())
+    assert {"first", "flaky", "later"} <= titles
+
+def test_job_queue_does_not_retry_unexpected_errors(monkeypatch, memory_cache):
+    from src.utils import sqlite
+    from src.services import enrichment_service
+    from src.services.job_queue import JobQueue
+    monkeypatch.setattr(sqlite, "engine", memory_cache.engine)
+    attempts = []
+
+    async def broken_youtube(query, client=None, title=None, artist=None, anime=None):
+        attempts.append(title)
+        raise KeyError("items")
+
+    monkeypatch.setattr(enrichment_service, "search_youtube", broken_youtube)
+    queue = JobQueue(workers=1, retry_delay=0.01, flush_interval=60)
+
+    async def run():
+        job = queue.submit([{"song_title": "broken", "artists": ["a"]}], "youtube", UpstreamClients())
+        while not job.finished:
+            await asyncio.sleep(0.01)
+        await queue.stop()
+        return job
+
+    job = asyncio.run(run())
+    # only upstream errors are retried, the worker survives the rest and the job still ends
+    assert attempts == ["broken"]
+    assert job.status == "done"
+    assert job.results == [None]
+
+def test_background_search_job(client, fake_clients):
+    import json
+    headers = register_and_login(client)
+    r = client.post("/anisong/search", params=[("q", "OP"), ("background", "true")], headers=headers)
+    assert r.status_code == 202
+    body = r.json()
+    assert body["count"] == 2 and "youtube_url" not in body["results"][0]
+
+    deadline = time.time() + 5
+    job = client.get(body["status_url"]).json()
+    while job["status"] != "done" and time.time() < deadline:
+        time.sleep(0.05)
+        job = client.get(body["status_url"]).json()
+    assert job["status"] == "done"
+    assert job["completed"] == 2 and job["failed"] == 0
+    assert all(song["youtube_url"] == "https://www.youtube.com/watch?v=abc" for song in job["results"])
+
+    streamed = client.get(body["status_url"], headers={"Accept": "application/x-ndjson"})
+    frames = [json.loads(line) for line in streamed.text.splitlines()]
+    assert [frame["type"] for frame in frames] == ["result", "result", "summary"]
+    assert frames[-1]["job_id"] == body["job_id"]
+
+    assert client.get("/jobs/missing").status_code == 404
+
+def test_background_search_applies_limit(client, fake_clients):
+    headers = register_and_login(client)
+    r = client.post("/anisong/search", params=[("q", "OP"), ("limit", "1"), ("background", "true")], headers=headers)
+    assert r.status_code == 202
+    body = r.json()
+    assert body["count"] == 1
+
+    deadline = time.time() + 5
+    job = client.get(body["status_url"]).json()
+    while job["status"] != "done" and time.time() < deadline:
+        time.sleep(0.05)
+        job = client.get(body["status_url"]).json()
+    assert job["completed"] == 1 and len(job["results"]) == 1
+
+def test_background_listing_job(client, fake_clients):
+    r = client.get("/anisong/themes", params={"theme_type": "OP", "limit": 2, "background": True})
+    assert r.status_code == 202
+    assert {song["song_title"] for song in r.json()["results"]} == {"My Dearest", "Departures"}
+
+def test_histogram_renders_cumulative_buckets():
+    from src.utils.metrics import Registry
+    registry = Registry()
+    histogram = registry.histogram("demo_seconds", "Demo", ("route",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 3):
+        histogram.observe(value, "/a\"b")
+    text = registry.render()
+    assert 'demo_seconds_bucket{route="/a\\"b",le="0.1"} 1' in text
+    assert 'demo_seconds_bucket{route="/a\\"b",le="1.0"} 3' in text
+    assert 'demo_seconds_bucket{route="/a\\"b",le="+Inf"} 4' in text
+    assert 'demo_seconds_count{route="/a\\"b"} 4' in text
+
+def test_metrics_endpoint(client, fake_clients):
+    client.get("/anisong/themes", params={"theme_type": "OP", "limit": 2})
+    client.get("/anisong/themes", params={"theme_type": "OP", "limit": 2})
+    client.get("/anisong/1/similar")
+    r = client.get("/metrics")
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("text/plain")
+    text = r.text
+    assert 'http_request_duration_seconds_count{method="GET",route="/anisong/themes",status="200"}' in text
+    # the route template, not the song id
+    assert 'route="/anisong/{song_id}/similar"' in text
+    assert 'upstream_request_duration_seconds_count{upstream="animethemes",status="200"}' in text
+    assert 'upstream_request_duration_seconds_count{upstream="youtube",status="200"}' in text
+    assert 'sqlite_transaction_duration_seconds_count{outcome="commit"}' in text
+    assert 'cache_hits_total{cache="animethemes"}' in text
+    assert 'spotify_token_refreshes_total{outcome="success"}' in text
+
+def test_server_timing_header(client, fake_clients):
+    headers = register_and_login(client)
+    r = client.post("/anisong/search", params=[("q", "OP")], headers=headers)
+    assert r.status_code == 200
+    timing = r.headers["server-timing"]
+    phases = {part.split(";")[0] for part in timing.split(", ")}
+    assert {"candidates", "animethemes", "enrich", "youtube", "spotify", "db", "db_commit", "save", "preferences", "total"} <= phases
+
+def test_profile_is_admin_only(client, fake_clients, monkeypatch):
+    from src.services import user_services
+    headers = register_and_login(client)
+    params = {"theme_type": "OP", "limit": 2, "profile": 1}
+    assert client.get("/anisong/themes", params=params).status_code == 403
+    assert client.get("/anisong/themes", params=params, headers=headers).status_code == 403
+    assert client.get("/profiles/", headers=headers).status_code == 403
+
+    monkeypatch.setattr(user_services, "ADMIN_USERNAMES", {"testuser"})
+    r = client.get("/anisong/themes", params=params, headers=headers)
+    assert r.status_code == 200 and r.json()["count"] == 2
+    profile_id = r.headers["x-profile-id"]
+    assert profile_id in [p["id"] for p in client.get("/profiles/", headers=headers).json()["results"]]
+
+    text = client.get(f"/profiles/{profile_id}", headers=headers)
+    assert "function calls" in text.text
+    dump = client.get(f"/profiles/{profile_id}", params={"format": "pstats"}, headers=headers)
+    assert dump.headers["content-type"] == "application/octet-stream" and dump.content
+    assert client.get("/profiles/missing", headers=headers).status_code == 404
+
+def test_song_result_flattens_spotify_match():
+    from src.services.anisong_services import song_result
+    song = {
+        "anime": "Guilty Crown",
+        "song_title": "My Dearest",
+        "artists": ["supercell"],
+        "youtube_url": None,
+        "spotify_url": {"spotify_url": "https://open.spotify.com/track/1", "name": "My Dearest", "artists": "supercell", "popularity": 50}
+    }
+    result = song_result(song)
+    assert result["spotify_url"] == "https://open.spotify.com/track/1" and result["spotify_popularity"] == 50
+    assert song_result(song, ("song_title", "spotify_popularity")) == {"song_title": "My Dearest", "spotify_popularity": 50}
+    # AnimeThemes data that was not enriched yet keeps its keys
+    assert "spotify_url" not in song_result({"song_title": "Departures"})
+
+def test_themes_fields_projection(client, fake_clients):
+    r = client.get("/anisong/themes", params={"theme_type": "OP", "limit": 2, "fields": "song_title,spotify_url"})
+    assert r.status_code == 200
+    results = r.json()["results"]
+    assert [set(song) for song in results] == [{"song_title", "spotify_url"}] * 2
+    assert all(song["spotify_url"] == "https://open.spotify.com/track/1" for song in results)
+
+    r = client.get("/anisong/themes", params={"theme_type": "OP", "limit": 2, "fields": "song_title,name"})
+    assert r.status_code == 400 and "name" in r.json()["detail"]
+
+def test_themes_etag_and_not_modified(client, fake_clients):
+    from src.utils.http_cache import response_etags
+    for etags in response_etags.values():
+        etags.clear()
+    params = {"theme_type": "OP", "limit": 2}
+
+    r = client.get("/anisong/themes", params=params)
+    assert r.status_code == 200
+    etag = r.headers["etag"]
+    assert r.headers["cache-control"] == "public, max-age=600"
+    assert "Accept" in r.headers["vary"]
+
+    # answered from the remembered ETag, the route and the upstreams are not called
+    calls = len(fake_clients.calls)
+    r = client.get("/anisong/themes", params=params, headers={"If-None-Match": f"W/{etag}"})
+    assert r.status_code == 304 and r.content == b"" and r.headers["etag"] == etag
+    assert len(fake_clients.calls) == calls
+
+    assert client.get("/anisong/themes", params=params, headers={"If-None-Match": '"stale"'}).status_code == 200
+    projected = client.get("/anisong/themes", params={**params, "fields": "song_title"}, headers={"If-None-Match": etag})
+    assert projected.status_code == 200 and projected.headers["etag"] != etag
+
+    # once forgotten the route runs again, an unchanged body still ends in a 304
+    themes = response_etags["/anisong/themes"]
+    themes.clear()
+    misses = themes.misses
+    r = client.get("/anisong/themes", params=params, headers={"If-None-Match": etag})
+    assert r.status_code == 304 and themes.misses == misses + 1
+
+def test_streamed_and_error_answers_have_no_etag(client, fake_clients):
+    r = client.get("/anisong/themes", params={"theme_type": "OP", "limit": 2}, headers={"Accept": "application/x-ndjson"})
+    assert r.status_code == 200 and "etag" not in r.headers
+    r = client.get("/anisong/themes", params={"theme_type": "OP", "fields": "name"})
+    assert r.status_code == 400 and "etag" not in r.headers
+
+def test_metrics_count_catalog_hits_once(memory_cache):
+    from src.routers.metrics import registry
+    with Session(memory_cache.engine) as session:
+        session.add(AnisongDB(title="Departures", artist="EGOIST", anime="Guilty Crown",
+                              youtube_url="https://www.youtube.com/watch?v=dep"))
+        session.commit()
+
+    key = make_cache_key("Departures", "EGOIST", "Guilty Crown")
+    assert memory_cache.get("youtube", key, title="Departures", artist="EGOIST")[0]
+    text = registry.render()
+    assert 'cache_hits_total{cache="enrichment_youtube"} 1.0' in text
+    assert 'enrichment_catalog_hits_total{provider="youtube"} 1.0' in text
+
+def test_enrich_songs_reads_the_cache_in_one_batch(memory_cache, monkeypatch):
+    from sqlalchemy import event
+    from src.services import enrichment_cache as cache_module
+    from src.services.enrichment_service import enrich_songs
+    songs = [{"anime": "Anime", "song_title": f"Song {i}", "artists": ["Artist"]} for i in range(9)]
+    for song in songs:
+        key = make_cache_key(song["song_title"], "Artist", "Anime")
+        memory_cache.set("youtube", key, f"yt:{song['song_title']}")
+        memory_cache.set("spotify", key, {"spotify_url": f"sp:{song['song_title']}", "popularity": 1})
+
+    # a fresh process over the same table, nothing in memory yet
+    cold = EnrichmentCache(engine=memory_cache.engine)
+    monkeypatch.setattr(cache_module, "_cache", cold)
+    statements = []
+    event.listen(cold.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+    def upstream(request):
+        raise AssertionError(f"unexpected upstream call {request.url}")
+    clients = UpstreamClients(transport=httpx.MockTransport(upstream))
+
+    results = asyncio.run(enrich_songs(songs, clients=clients))
+    assert [r["youtube_url"] for r in results] == [f"yt:Song {i}" for i in range(9)]
+    assert len([s for s in statements if "enrichmentcacheentry" in s.lower()]) == 2
+
+    statements.clear()
+    asyncio.run(enrich_songs(songs, clients=clients))
+    assert statements == []
+    assert cold.stats["youtube"]["hits"] == 18
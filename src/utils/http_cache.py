@@ -0,0 +1,112 @@
+from dotenv import load_dotenv
+from fastapi import Request
+from starlette.datastructures import MutableHeaders
+from urllib.parse import parse_qsl
+from src.utils.cache import AsyncTTLCache
+from src.utils.streaming import stream_format
+import hashlib
+import os
+
+load_dotenv()
+
+# seconds a client or CDN may reuse an answer before asking again, 0 always revalidates
+ROUTE_MAX_AGE = {
+    "/anisong/themes": int(os.getenv("THEMES_MAX_AGE", "600")),
+    "/anisong/names": int(os.getenv("NAMES_MAX_AGE", "600")),
+    "/anisong/artists": int(os.getenv("ARTISTS_MAX_AGE", "600")),
+    "/anisong/criteria": int(os.getenv("CRITERIA_MAX_AGE", "600"))
+}
+ETAG_CACHE_MAX_ENTRIES = int(os.getenv("ETAG_CACHE_MAX_ENTRIES", "10000"))
+
+# the ETag last sent per route and query, kept as long as the answer may be reused
+response_etags = {
+    path: AsyncTTLCache(ttl=max_age, max_entries=ETAG_CACHE_MAX_ENTRIES)
+    for path, max_age in ROUTE_MAX_AGE.items()
+}
+
+
+def make_etag(body: bytes) -> str:
+    return f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match compares weakly, a CDN that compressed the body may send W/"..." back
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or any(tag.removeprefix("W/") == etag for tag in tags)
+
+
+def cache_control(max_age: int) -> str:
+    return f"public, max-age={max_age}" if max_age > 0 else "no-cache"
+
+
+class ConditionalGetMiddleware:
+    # ETag, Cache-Control and 304 answers for the GET /anisong listings.
+    # An If-None-Match that matches a recent ETag is answered before the route runs, so nothing goes upstream
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path")
+        if scope["type"] != "http" or scope["method"] != "GET" or path not in response_etags:
+            return await self.app(scope, receive, send)
+        request = Request(scope)
+        # streamed answers go out as they are produced, there is no body to hash up front
+        if stream_format(request):
+            return await self.app(scope, receive, send)
+
+        etags = response_etags[path]
+        max_age = ROUTE_MAX_AGE[path]
+        key = tuple(sorted(parse_qsl(scope.get("query_string", b"").decode(), keep_blank_values=True)))
+        if_none_match = request.headers.get("if-none-match")
+
+        if if_none_match:
+            hit, etag = etags.get(key)
+            if hit and etag_matches(if_none_match, etag):
+                etags.hits += 1
+                return await self._not_modified(send, etag, max_age)
+            etags.misses += 1
+
+        start = None
+        chunks = []
+
+        async def send_tagged(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                if message["status"] != 200:
+                    # errors and 202 job answers go through untouched
+                    return await send(message)
+                start = message
+                return
+            if start is None:
+                return await send(message)
+
+            chunks.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+
+            body = b"".join(chunks)
+            etag = make_etag(body)
+            etags.set(key, etag)
+            if if_none_match and etag_matches(if_none_match, etag):
+                return await self._not_modified(send, etag, max_age)
+
+            headers = MutableHeaders(raw=list(start.get("headers", [])))
+            headers["etag"] = etag
+            headers["cache-control"] = cache_control(max_age)
+            headers.append("vary", "Accept")
+            await send({**start, "headers": headers.raw})
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_tagged)
+
+    async def _not_modified(self, send, etag: str, max_age: int):
+        await send({
+            "type": "http.response.start",
+            "status": 304,
+            "headers": [
+                (b"etag", etag.encode()),
+                (b"cache-control", cache_control(max_age).encode()),
+                (b"vary", b"Accept")
+            ]
+        })
+        await send({"type": "http.response.body", "body": b""})
@@ -0,0 +1,117 @@
+from dotenv import load_dotenv
+from importlib.util import find_spec
+from typing import Optional
+from src.utils.metrics import upstream_request_seconds
+from src.utils.timing import record
+import asyncio
+import os
+import time
+import httpx
+
+load_dotenv()
+
+UPSTREAMS = ("animethemes", "youtube", "spotify")
+
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "10"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "false").lower() in ("1", "true", "yes")
+
+
+def _upstream_setting(name: str, key: str, default: float) -> float:
+    # per upstream override, e.g. SPOTIFY_HTTP_TIMEOUT=5
+    return float(os.getenv(f"{name.upper()}_HTTP_{key}", default))
+
+
+def create_client(name: str, transport: Optional[httpx.AsyncBaseTransport] = None) -> httpx.AsyncClient:
+    timeout = httpx.Timeout(
+        _upstream_setting(name, "TIMEOUT", HTTP_TIMEOUT),
+        connect=_upstream_setting(name, "CONNECT_TIMEOUT", HTTP_CONNECT_TIMEOUT)
+    )
+    limits = httpx.Limits(
+        max_connections=int(_upstream_setting(name, "MAX_CONNECTIONS", HTTP_MAX_CONNECTIONS)),
+        max_keepalive_connections=int(_upstream_setting(name, "MAX_KEEPALIVE", HTTP_MAX_KEEPALIVE)),
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+    )
+    if transport is None:
+        # http2 needs the optional h2 package, fall back to http/1.1 keep-alive without it
+        http2 = HTTP2_ENABLED and find_spec("h2") is not None
+        transport = httpx.AsyncHTTPTransport(limits=limits, http2=http2)
+
+    return httpx.AsyncClient(timeout=timeout, transport=TimedTransport(name, transport))
+
+
+class TimedTransport(httpx.AsyncBaseTransport):
+    # latency and status of every upstream call, the body is read after the clock stops
+    def __init__(self, name: str, transport: httpx.AsyncBaseTransport):
+        self.name = name
+        self.transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        started = time.perf_counter()
+        status = "error"
+        try:
+            response = await self.transport.handle_async_request(request)
+            status = str(response.status_code)
+            return response
+        except asyncio.CancelledError:
+            # hedged and raced lookups cancel the slower calls
+            status = "cancelled"
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            upstream_request_seconds.observe(elapsed, self.name, status)
+            record(self.name, elapsed)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+class UpstreamClients:
+    def __init__(self, transport: Optional[httpx.AsyncBaseTransport] = None):
+        self._transport = transport
+        self._clients: dict[str, httpx.AsyncClient] = {}
+
+    def open(self):
+        for name in UPSTREAMS:
+            self.get(name)
+
+    def get(self, name: str) -> httpx.AsyncClient:
+        if name not in UPSTREAMS:
+            raise KeyError(f"Unknown upstream: {name}")
+
+        client = self._clients.get(name)
+        if client is None or client.is_closed:
+            client = create_client(name, self._transport)
+            self._clients[name] = client
+        return client
+
+    @property
+    def animethemes(self) -> httpx.AsyncClient:
+        return self.get("animethemes")
+
+    @property
+    def youtube(self) -> httpx.AsyncClient:
+        return self.get("youtube")
+
+    @property
+    def spotify(self) -> httpx.AsyncClient:
+        return self.get("spotify")
+
+    async def aclose(self):
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.aclose()
+
+
+clients = UpstreamClients()
+
+
+def get_client(name: str) -> httpx.AsyncClient:
+    return clients.get(name)
+
+
+def get_http_clients() -> UpstreamClients:
+    return clients
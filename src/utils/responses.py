@@ -0,0 +1,19 @@
+from fastapi.responses import JSONResponse
+from importlib.util import find_spec
+import json
+
+# orjson is optional, without it the stdlib encoder writes the same JSON more slowly
+if find_spec("orjson") is not None:
+    import orjson
+
+    def dumps(content) -> bytes:
+        return orjson.dumps(content, default=str, option=orjson.OPT_NON_STR_KEYS)
+else:
+    def dumps(content) -> bytes:
+        return json.dumps(content, default=str, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+class FastJSONResponse(JSONResponse):
+    # routes that return one directly also skip FastAPI's jsonable_encoder pass over the content
+    def render(self, content) -> bytes:
+        return dumps(content)
@@ -1,12 +1,155 @@
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from functools import partial
+from typing import Optional
+from sqlalchemy import event, inspect
 from sqlmodel import SQLModel, create_engine, Session
+from src.utils.metrics import sqlite_transaction_seconds
+from src.utils.timing import phase, record
+import asyncio
+import contextvars
+import os
+import time
+
+load_dotenv()
 
 sqlite_url = "sqlite:///./app.db"
-engine = create_engine(sqlite_url, echo=False)
+
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", "5"))
+SQLITE_MAX_OVERFLOW = int(os.getenv("SQLITE_MAX_OVERFLOW", "5"))
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", "4"))
+
+def create_sqlite_engine(url: str):
+    engine = create_engine(
+        url,
+        echo=False,
+        connect_args={"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000},
+        pool_size=SQLITE_POOL_SIZE,
+        max_overflow=SQLITE_MAX_OVERFLOW
+    )
+
+    @event.listens_for(engine, "connect")
+    def tune_connection(dbapi_connection, _):
+        # WAL lets readers run next to the writer, NORMAL only fsyncs at checkpoints
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.close()
+
+    @event.listens_for(engine, "begin")
+    def transaction_started(connection):
+        connection.info["transaction_started"] = time.perf_counter()
+
+    def transaction_ended(outcome: str):
+        def observe(connection):
+            started = connection.info.pop("transaction_started", None)
+            if started is not None:
+                elapsed = time.perf_counter() - started
+                sqlite_transaction_seconds.observe(elapsed, outcome)
+                if outcome == "commit":
+                    record("db_commit", elapsed)
+        return observe
+
+    event.listen(engine, "commit", transaction_ended("commit"))
+    event.listen(engine, "rollback", transaction_ended("rollback"))
+
+    return engine
+
+engine = create_sqlite_engine(sqlite_url)
+
+def _merge_duplicate_preferences(connection):
+    # older databases can hold several rows for one (user_id, tag), fold them into one row
+    connection.exec_driver_sql("""
+        UPDATE userpreference SET weight = (
+            SELECT SUM(p.weight) FROM userpreference p
+            WHERE p.user_id = userpreference.user_id AND p.tag = userpreference.tag
+        )
+        WHERE id IN (SELECT MIN(id) FROM userpreference GROUP BY user_id, tag HAVING COUNT(*) > 1)
+    """)
+    connection.exec_driver_sql("""
+        DELETE FROM userpreference
+        WHERE id NOT IN (SELECT MIN(id) FROM userpreference GROUP BY user_id, tag)
+    """)
+
+def _merge_duplicate_anisongs(connection):
+    # the old per row insert could save one (title, artist) twice. the oldest row keeps its id and
+    # takes the newest non-empty value of each column, like the upsert would have
+    latest = """(
+        SELECT d.{column} FROM anisongdb d
+        WHERE d.title = anisongdb.title AND d.artist = anisongdb.artist AND d.{column} IS NOT NULL
+        ORDER BY d.id DESC LIMIT 1
+    )"""
+    columns = ("anime", "spotify_url", "spotify_popularity", "youtube_url")
+    connection.exec_driver_sql(f"""
+        UPDATE anisongdb SET {", ".join(f"{column} = {latest.format(column=column)}" for column in columns)}
+        WHERE id IN (SELECT MIN(id) FROM anisongdb GROUP BY title, artist HAVING COUNT(*) > 1)
+    """)
+    connection.exec_driver_sql("""
+        UPDATE userhistory SET song_id = (
+            SELECT MIN(d.id) FROM anisongdb d JOIN anisongdb s ON d.title = s.title AND d.artist = s.artist
+            WHERE s.id = userhistory.song_id
+        )
+        WHERE song_id NOT IN (SELECT MIN(id) FROM anisongdb GROUP BY title, artist)
+    """)
+    connection.exec_driver_sql("""
+        DELETE FROM anisongdb
+        WHERE id NOT IN (SELECT MIN(id) FROM anisongdb GROUP BY title, artist)
+    """)
+    # cached lists can still name the removed ids
+    connection.exec_driver_sql("DELETE FROM recommendationcacheentry")
+
+# data fixes that have to run before a unique index can be added to an existing table
+INDEX_MIGRATIONS = {
+    "uq_userpreference_user_tag": _merge_duplicate_preferences,
+    "uq_anisongdb_title_artist": _merge_duplicate_anisongs
+}
 
 def create_db_and_tables():
     SQLModel.metadata.create_all(engine)
-    
+    # create_all skips tables that already exist, indexes added to a model later are created here
+    inspector = inspect(engine)
+    for table in SQLModel.metadata.sorted_tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            with engine.begin() as connection:
+                migrate = INDEX_MIGRATIONS.get(index.name)
+                if migrate:
+                    migrate(connection)
+                index.create(connection)
+
 def get_session():
     with Session(engine) as session:
         yield session
-        
\ No newline at end of file
+
+_db_executor: Optional[ThreadPoolExecutor] = None
+
+def get_db_executor() -> ThreadPoolExecutor:
+    global _db_executor
+    if _db_executor is None:
+        _db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+    return _db_executor
+
+def shutdown_db_executor():
+    global _db_executor
+    executor, _db_executor = _db_executor, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+async def run_in_db(func, *args, **kwargs):
+    # blocking sqlite work runs on the db threads so commits never stall the event loop,
+    # with the caller's context so request timings see what happened there
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    with phase("db"):
+        return await loop.run_in_executor(get_db_executor(), partial(context.run, func, *args, **kwargs))
+
+async def run_db(func, *args, **kwargs):
+    # func(session, *args) with a session that is opened and closed on the db thread
+    def call():
+        with Session(engine) as session:
+            return func(session, *args, **kwargs)
+    return await run_in_db(call)
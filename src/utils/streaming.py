@@ -0,0 +1,65 @@
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+from typing import AsyncIterator, Callable, Optional
+from src.utils.responses import dumps
+import time
+
+# opt-in through the Accept header, everything else gets the usual JSON body
+STREAM_MEDIA_TYPES = {
+    "application/x-ndjson": "ndjson",
+    "text/event-stream": "sse"
+}
+
+
+def stream_format(request: Request) -> Optional[str]:
+    for media_type in request.headers.get("accept", "").split(","):
+        stream = STREAM_MEDIA_TYPES.get(media_type.split(";")[0].strip().lower())
+        if stream:
+            return stream
+    return None
+
+
+def encode_frame(stream: str, event: str, data: dict) -> bytes:
+    if stream == "sse":
+        return b"event: " + event.encode() + b"\ndata: " + dumps(data) + b"\n\n"
+    return dumps({"type": event, **data}) + b"\n"
+
+
+async def _frames(
+    stream: str,
+    results: AsyncIterator[tuple[int, dict]],
+    summary: Optional[dict],
+    shape: Optional[Callable[[dict], dict]]
+):
+    started = time.perf_counter()
+    first_result_ms = None
+    count = 0
+    async for index, song in results:
+        if first_result_ms is None:
+            first_result_ms = round((time.perf_counter() - started) * 1000, 1)
+        count += 1
+        if shape is not None and song is not None:
+            song = shape(song)
+        yield encode_frame(stream, "result", {"index": index, "song": song})
+
+    yield encode_frame(stream, "summary", {
+        "count": count,
+        "first_result_ms": first_result_ms,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+        **(summary or {})
+    })
+
+
+def stream_results(
+    stream: str,
+    results: AsyncIterator[tuple[int, dict]],
+    summary: Optional[dict] = None,
+    shape: Optional[Callable[[dict], dict]] = None
+) -> StreamingResponse:
+    # one frame per song as soon as it is enriched, then a summary frame
+    media_type = "text/event-stream" if stream == "sse" else "application/x-ndjson"
+    return StreamingResponse(
+        _frames(stream, results, summary, shape),
+        media_type=media_type,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
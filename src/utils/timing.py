@@ -0,0 +1,72 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+import threading
+import time
+
+# the current request's phases, child tasks and db threads see the same object
+_timings: ContextVar[Optional["Timings"]] = ContextVar("timings", default=None)
+
+
+class Timings:
+    def __init__(self):
+        # name -> [seconds, count], concurrent phases overlap so they can add up past the total
+        self.phases: dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float):
+        with self._lock:
+            entry = self.phases.setdefault(name, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += 1
+
+    def header(self, total: float) -> str:
+        with self._lock:
+            phases = list(self.phases.items())
+        parts = [f'{name};dur={seconds * 1000:.1f};desc="{count}x"' for name, (seconds, count) in phases]
+        parts.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(parts)
+
+
+def record(name: str, seconds: float):
+    timings = _timings.get()
+    if timings is not None:
+        timings.add(name, seconds)
+
+
+@contextmanager
+def phase(name: str):
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - started)
+
+
+class ServerTimingMiddleware:
+    # adds a Server-Timing header with the time spent per phase until the headers went out
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        timings = Timings()
+        token = _timings.set(timings)
+
+        async def send_timed(message):
+            if message["type"] == "http.response.start":
+                header = timings.header(time.perf_counter() - started)
+                message["headers"] = list(message.get("headers", [])) + [(b"server-timing", header.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            _timings.reset(token)